@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Measures the throughput and latency of JabberChatter through a local stand-in XMPP server (nicobot.fakexmpp) :
+    a client sends numbered messages to the bot, which echoes them back through the whole
+    JabberChatter -> Bot.onMessage -> JabberChatter.send path.
+
+    - plain : messages go both ways in clear text, so only XMPP and the bot's plumbing are measured
+    - omemo : messages are encrypted both ways, as in production
+
+    Run from the project's root with : python3 -m benchmarks.jabber_throughput [--messages N] [--window W] [--mode plain|omemo|all]
+"""
+
+import argparse
+import asyncio
+import logging
+import shutil
+import statistics
+import tempfile
+import time
+
+from nicobot.fakexmpp import FakeXmpp
+from nicobot.jabber import SliXmppClient, JabberChatter, HANDLER_WORKERS
+
+
+BOT = 'bot@localhost'
+PEER = 'me@localhost'
+PASSWORD = 'password'
+# Seconds to wait for a missing answer before giving up
+TIMEOUT = 10
+
+
+class EchoBot:
+
+    def __init__( self, chatter ):
+        self.chatter = chatter
+
+    def onMessage( self, message ):
+        self.chatter.send( "echo %s" % message )
+
+
+async def plain_send_many( xmpp, body, targets ):
+    # Same as SliXmppClient.encrypted_send_many, without encryption
+    for jid, type in targets:
+        msg = xmpp.make_message( mto=jid, mtype=type )
+        msg['body'] = body
+        msg.send()
+
+
+async def connected( client ):
+    started = asyncio.Event()
+    client.add_event_handler( 'session_start', lambda event: started.set() )
+    client.connect()
+    await asyncio.wait_for( started.wait(), TIMEOUT )
+
+
+async def published( server, jids ):
+    """
+        Returns True once all the given JIDs have published their OMEMO devices
+    """
+    node = 'eu.siacs.conversations.axolotl.devicelist'
+    start = time.monotonic()
+    while time.monotonic() - start < TIMEOUT / 2:
+        if all( (jid,node) in server.nodes for jid in jids ):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def exchange( send, answers, count, window ):
+    """
+        Sends 'count' messages, at most 'window' of them waiting for their answer at the same time.
+        Returns the elapsed time and the latency of each answered message
+    """
+    sent = {}
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count + window):
+        if i >= window:
+            try:
+                body = await asyncio.wait_for( answers.get(), TIMEOUT )
+            except asyncio.TimeoutError:
+                print( "Timeout : %d messages were not answered" % (count - len(latencies)) )
+                break
+            latencies.append( time.perf_counter() - sent.pop( int(body.split()[1]) ) )
+        if i < count:
+            sent[i] = time.perf_counter()
+            send( str(i) )
+    return time.perf_counter() - start, latencies
+
+
+def bench( mode, server, messages, window, workers ):
+
+    bot_dir = tempfile.mkdtemp()
+    peer_dir = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        address = "%s:%d" % server.address
+        chatter = JabberChatter( BOT, PASSWORD, recipients=[PEER], data_dir=bot_dir, server=address, tls=False, handler_workers=workers )
+        chatter.bot = EchoBot(chatter)
+        answers = asyncio.Queue()
+        peer = SliXmppClient( PEER, PASSWORD, lambda msg, body: answers.put_nowait(body), peer_dir, prewarm=[BOT], server=server.address, tls=False )
+        if mode == 'plain':
+            chatter.xmpp.encrypted_send_many = lambda body, targets: plain_send_many( chatter.xmpp, body, targets )
+            send = lambda body: peer.make_message( mto=BOT, mbody=body, mtype='chat' ).send()
+        else:
+            send = lambda body: asyncio.ensure_future( peer.encrypted_send( body, BOT ) )
+
+        chatter.connect()
+        loop.run_until_complete( connected(peer) )
+        if mode == 'omemo' and not loop.run_until_complete( published( server, [BOT,PEER] ) ):
+            print( "%-6s skipped : the OMEMO plugin could not publish its keys (is the installed 'omemo' library compatible with 'slixmpp-omemo' ?)" % mode )
+            return
+        # Warms up the connections and the keys
+        loop.run_until_complete( exchange( send, answers, 1, 1 ) )
+
+        elapsed, latencies = loop.run_until_complete( exchange( send, answers, messages, window ) )
+        if latencies:
+            latencies.sort()
+            print( "%-6s %6d messages in %6.3f s : %7.1f msg/s\tlatency (ms) p50 %6.2f  p95 %6.2f  max %6.2f" % (
+                mode, len(latencies), elapsed, len(latencies) / elapsed,
+                statistics.median(latencies) * 1000, latencies[ int(len(latencies) * 0.95) ] * 1000, latencies[-1] * 1000 ) )
+        loop.run_until_complete( chatter.shutdown() )
+        peer.abort()
+    finally:
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete( asyncio.gather( *tasks, return_exceptions=True ) )
+        loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(bot_dir)
+        shutil.rmtree(peer_dir)
+
+
+def run( args=None ):
+
+    parser = argparse.ArgumentParser(description="JabberChatter throughput benchmark")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of messages to send")
+    parser.add_argument("--window", type=int, default=10, help="Number of messages waiting for their answer at the same time")
+    parser.add_argument("--mode", choices=['plain','omemo','all'], default='all', help="Whether messages are encrypted")
+    parser.add_argument("--handler-workers", type=int, default=HANDLER_WORKERS, help="Number of threads running the bot's handlers")
+    parser.add_argument('--verbosity', '-v', default="CRITICAL", help="Log level")
+    args = parser.parse_args(args)
+
+    logging.basicConfig( level=args.verbosity )
+    server = FakeXmpp( accounts={ BOT:PASSWORD, PEER:PASSWORD } ).start()
+    try:
+        for mode in ( ['plain','omemo'] if args.mode == 'all' else [args.mode] ):
+            bench( mode, server, args.messages, args.window, args.handler_workers )
+    finally:
+        server.stop()
+    print( "Server : %r" % server.stats )
+
+
+if __name__ == '__main__':
+    run()
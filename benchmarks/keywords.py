@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Compares the keyword matching of TransBot :
+    the former single alternation regular expression vs. the KeywordIndex.
+
+    Run from the project's root with : python3 -m benchmarks.keywords [--variants N] [--messages N]
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+
+from nicobot.keywords import KeywordIndex
+from nicobot.transbot import sanitizeNotPattern
+
+
+# A few alphabets to generate keywords in different scripts
+ALPHABETS = [
+    string.ascii_lowercase,
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+    "αβγδεζηθικλμνξοπρστυφχψω",
+    "אבגדהוזחטיכלמנסעפצקרשת",
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほ",
+    "กขคงจฉชซญดตถทนบปผพฟมยรลวศสหอ",
+]
+
+
+def randomWord( rand, alphabet, min_length=3, max_length=10 ):
+    return ''.join( rand.choice(alphabet) for _ in range(rand.randint(min_length,max_length)) )
+
+
+def generate( variants_count, messages_count, hit_ratio, seed=0 ):
+    """
+        Returns a list of keyword variants and a list of messages,
+        'hit_ratio' of them containing one of the variants
+    """
+    rand = random.Random(seed)
+    variants = [ randomWord(rand,rand.choice(ALPHABETS)).capitalize() for _ in range(variants_count) ]
+    messages = []
+    for _ in range(messages_count):
+        words = [ randomWord(rand,string.ascii_lowercase) for _ in range(rand.randint(3,15)) ]
+        if rand.random() < hit_ratio:
+            words.insert( rand.randint(0,len(words)), rand.choice(variants) )
+        messages.append( ' '.join(words) )
+    return variants, messages
+
+
+def bench( name, build, match, messages ):
+
+    start = time.perf_counter()
+    matcher = build()
+    built = time.perf_counter()
+    hits = sum( 1 for message in messages if match(matcher,message) )
+    end = time.perf_counter()
+    print( "%-8s build: %8.3f s\tmatch: %8.3f s (%8.1f µs/message)\thits: %d" % (
+        name, built - start, end - built, (end - built) * 1000000 / len(messages), hits ) )
+    return hits
+
+
+def run( args=None ):
+
+    parser = argparse.ArgumentParser(description="Keyword matching benchmark")
+    parser.add_argument("--variants", type=int, default=10000, help="Number of keyword variants (keywords and their translations)")
+    parser.add_argument("--messages", type=int, default=2000, help="Number of messages to match")
+    parser.add_argument("--hit-ratio", type=float, default=0.2, help="Ratio of messages that contain a keyword")
+    args = parser.parse_args(args)
+
+    variants, messages = generate( args.variants, args.messages, args.hit_ratio )
+    print( "%d variants, %d messages" % (len(variants),len(messages)) )
+
+    def buildRegex():
+        # This is how TransBot used to build its keywords pattern
+        pattern = r'\b%s\b' % sanitizeNotPattern(variants[0])
+        for keyword in variants[1:]:
+            pattern = pattern + r'|\b%s\b' % sanitizeNotPattern(keyword)
+        return pattern
+
+    def buildIndex():
+        index = KeywordIndex()
+        for variant in variants:
+            index.add(variant)
+        # Forces the automaton to be built now rather than on the first search
+        index.search("")
+        return index
+
+    bench( "regex", buildRegex, lambda pattern, message: re.search(pattern,message,flags=re.IGNORECASE), messages )
+    bench( "index", buildIndex, lambda index, message: index.search(message), messages )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Compares the OMEMO storage backends : one JSON file per item (slixmpp_omemo's default) vs. a single SQLite database.
+
+    Measures the time to write the sessions of many devices, to load them again after a restart
+    and to update random sessions (as done after each message sent or received).
+
+    Run from the project's root with : python3 -m benchmarks.omemo_storage [--contacts N] [--devices D] [--updates U]
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from omemo.implementations import JSONFileStorage
+
+from nicobot.omemostorage import SQLiteStorage, SQLITE_FILE
+
+
+def session( rand ):
+    # About the size of a serialized double ratchet session
+    key = lambda: base64.b64encode( rand.randbytes(32) ).decode('ascii')
+    return { 'super': { 'root_chain': { 'key': key(), 'length': rand.randint(0,100) }, 'skipped_mks': [ [ key(), key(), i ] for i in range(5) ] },
+        'ad': key() + key(), 'other_ik': key(), 'version': '1.0.0' }
+
+
+def contacts( count ):
+    return [ 'contact%d@example.com' % i for i in range(count) ]
+
+
+async def write( storage, jids, devices, rand ):
+    await storage.storeOwnData( 'bot@example.com', 1 )
+    await storage.storeState( { 'ik': session(rand) } )
+    for jid in jids:
+        await storage.storeActiveDevices( jid, list(range(devices)) )
+        for device in range(devices):
+            await storage.storeSession( jid, device, session(rand) )
+            await storage.storeTrust( jid, device, { 'key': 'key', 'trusted': True } )
+
+
+async def load( storage, jids ):
+    # What is needed to encrypt a message for everyone
+    await storage.loadOwnData()
+    await storage.loadState()
+    sessions = 0
+    for jid in jids:
+        devices = await storage.loadActiveDevices(jid)
+        loaded = await storage.loadSessions( jid, devices )
+        await storage.loadTrusts( jid, devices )
+        sessions += len([ s for s in loaded.values() if s is not None ])
+    return sessions
+
+
+async def update( storage, jids, devices, updates, rand ):
+    for i in range(updates):
+        await storage.storeSession( rand.choice(jids), rand.randrange(devices), session(rand) )
+
+
+def bench( name, factory, jids, devices, updates ):
+    """
+        factory: returns a new instance of the storage to measure (each call stands for a restart)
+    """
+
+    rand = random.Random(0)
+    storage = factory()
+    start = time.perf_counter()
+    asyncio.run( write( storage, jids, devices, rand ) )
+    written = time.perf_counter() - start
+    close(storage)
+
+    start = time.perf_counter()
+    storage = factory()
+    sessions = asyncio.run( load( storage, jids ) )
+    loaded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run( update( storage, jids, devices, updates, rand ) )
+    updated = time.perf_counter() - start
+    close(storage)
+
+    print( "%-8s write: %7.3f s\tstartup: %7.3f s (%d sessions)\tupdates: %7.0f /s" % ( name, written, loaded, sessions, updates / updated ) )
+
+
+def close( storage ):
+    if isinstance(storage,SQLiteStorage):
+        storage.close()
+
+
+def run( args=None ):
+
+    parser = argparse.ArgumentParser(description="OMEMO storage benchmark")
+    parser.add_argument("--contacts", type=int, default=500, help="Number of contacts")
+    parser.add_argument("--devices", type=int, default=4, help="Number of devices of each contact")
+    parser.add_argument("--updates", type=int, default=2000, help="Number of session updates")
+    args = parser.parse_args(args)
+
+    jids = contacts(args.contacts)
+    print( "%d contacts, %d devices" % (len(jids),len(jids)*args.devices) )
+    json_dir = tempfile.mkdtemp()
+    sqlite_dir = tempfile.mkdtemp()
+    try:
+        bench( "json", lambda: JSONFileStorage(json_dir), jids, args.devices, args.updates )
+        bench( "sqlite", lambda: SQLiteStorage(os.path.join(sqlite_dir,SQLITE_FILE)), jids, args.devices, args.updates )
+        # From the files written above
+        migrated = SQLiteStorage(os.path.join(sqlite_dir,"migrated.sqlite"))
+        start = time.perf_counter()
+        count = migrated.migrate(json_dir)
+        print( "Migration of %d files : %.3f s" % ( count, time.perf_counter() - start ) )
+        migrated.close()
+    finally:
+        shutil.rmtree(json_dir)
+        shutil.rmtree(sqlite_dir)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Compares the handling of signal-cli's JSON output :
+    parsing every line (the former behaviour) vs. pre-filtering lines with EnvelopeFilter.
+
+    Run from the project's root with : python3 -m benchmarks.signal_envelopes [--lines N] [--messages-ratio R]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from nicobot.signalcli import EnvelopeFilter
+
+
+RECIPIENT = '+33200000000'
+OTHERS = [ '+3330000%04d' % i for i in range(20) ]
+
+
+def envelope( rand, timestamp, source ):
+    # Like signal-cli's output, all keys are present (and null when unused)
+    return { 'source':source, 'sourceDevice':rand.randint(1,3), 'timestamp':timestamp,
+        'isReceipt':False, 'dataMessage':None, 'syncMessage':None, 'callMessage':None, 'receiptMessage':None, 'typingMessage':None }
+
+
+def generate( lines_count, messages_ratio, seed=0 ):
+    """
+        Returns a list of JSON lines like signal-cli's : 'messages_ratio' of them are text messages,
+        the others are receipts, typing indicators and sync messages
+    """
+    rand = random.Random(seed)
+    lines = []
+    for i in range(lines_count):
+        source = RECIPIENT if rand.random() < 0.5 else rand.choice(OTHERS)
+        event = envelope( rand, 1600000000000 + i, source )
+        kind = rand.random()
+        if kind < messages_ratio:
+            text = ' '.join( rand.choice(["hello","how","are","you","doing","today","?"]) for _ in range(rand.randint(1,20)) )
+            event['dataMessage'] = { 'timestamp':event['timestamp'], 'message':text, 'expiresInSeconds':0, 'attachments':[], 'groupInfo':None }
+        elif kind < 0.6:
+            event['isReceipt'] = True
+            event['receiptMessage'] = { 'when':event['timestamp'], 'isDelivery':True, 'isRead':False, 'timestamps':[event['timestamp']-1000] }
+        elif kind < 0.8:
+            event['typingMessage'] = { 'action':rand.choice(['STARTED','STOPPED']), 'timestamp':event['timestamp'], 'groupId':None }
+        else:
+            event['syncMessage'] = { 'sentMessage':None, 'blockedNumbers':None, 'readMessages':[ { 'sender':source, 'timestamp':event['timestamp']-2000 } ] }
+        lines.append( (json.dumps({ 'envelope':event })+"\n").encode('utf-8') )
+    return lines
+
+
+def isForMe( event ):
+    # What SignalChatter.filterMessages checks after parsing
+    dataMessage = event['envelope'].get('dataMessage')
+    return bool( dataMessage and dataMessage.get('message') and event['envelope'].get('source') == RECIPIENT )
+
+
+def bench( name, parse, lines ):
+
+    start = time.perf_counter()
+    kept = 0
+    for line in lines:
+        event = parse(line)
+        if event is not None and isForMe(event):
+            kept += 1
+    end = time.perf_counter()
+    print( "%-10s %8.3f s (%6.2f µs/line)\tmessages: %d" % ( name, end - start, (end - start) * 1000000 / len(lines), kept ) )
+    return kept
+
+
+def run( args=None ):
+
+    parser = argparse.ArgumentParser(description="signal-cli output filtering benchmark")
+    parser.add_argument("--lines", type=int, default=100000, help="Number of lines output by signal-cli")
+    parser.add_argument("--messages-ratio", type=float, default=0.1, help="Ratio of lines that are text messages")
+    args = parser.parse_args(args)
+
+    lines = generate( args.lines, args.messages_ratio )
+    print( "%d lines, %d bytes" % (len(lines),sum(len(l) for l in lines)) )
+
+    bench( "json", json.loads, lines )
+    envelopes = EnvelopeFilter( recipients={RECIPIENT:None} )
+    bench( "prefilter", envelopes.parse, lines )
+    print( "Discarded : %r" % envelopes.stats )
+
+
+if __name__ == '__main__':
+    run()
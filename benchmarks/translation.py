@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Measures TransBot's throughput and response time when answering keywords,
+    against a local fake IBM Cloud (no network access required).
+
+    Run from the project's root with : python3 -m benchmarks.translation [--messages N] [--latency S] ...
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import random
+import statistics
+import time
+
+import i18n
+
+from nicobot.cache import TranslationCache
+from nicobot.chatter import Chatter
+from nicobot.fakecloud import FakeCloud
+from nicobot.glossary import GlossaryTranslator
+from nicobot.ibmcloud import IbmCloudTranslator
+from nicobot.transbot import TransBot
+
+
+GLOSSARY_FILE = "tests/fixtures/glossary.json"
+LIKELY_SUBTAGS_FILE = "tests/transbot-sample-conf/likelySubtags.json"
+
+
+class NullChatter(Chatter):
+    """
+        Counts sent messages instead of sending them
+    """
+    def __init__( self ):
+        self.sent = 0
+    def send( self, message ):
+        self.sent = self.sent + 1
+
+
+def percentile( values, p ):
+    values = sorted(values)
+    return values[ min( len(values)-1, int(len(values)*p) ) ]
+
+
+def run( args=None ):
+
+    parser = argparse.ArgumentParser(description="TransBot translation benchmark")
+    parser.add_argument("--messages", type=int, default=200, help="Number of messages to answer")
+    parser.add_argument("--threads", type=int, default=1, help="Number of messages handled concurrently")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of the fake service in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Random extra latency of the fake service in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Ratio of failing requests (503)")
+    parser.add_argument("--hedge-fanout", type=int, default=5, help="See TransBot")
+    parser.add_argument("--hedge-delay", type=float, default=0, help="See TransBot")
+    parser.add_argument("--cache", action="store_true", help="Enable the translation cache (disabled by default to measure the service)")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    i18n.add_translation('all_messages',r'%{message}')
+
+    glossary = GlossaryTranslator(file=GLOSSARY_FILE)
+    cloud = FakeCloud( glossary, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=0 ).start()
+    chatter = NullChatter()
+    bot = TransBot(
+        chatter, ibmcloud_url=cloud.url, ibmcloud_apikey="bench",
+        keywords=[], languages=glossary.identifiableLanguages()['languages'],
+        languages_likely=LIKELY_SUBTAGS_FILE, locale=['en'],
+        cache=TranslationCache(max_size=1000 if args.cache else 0),
+        translator=IbmCloudTranslator(cloud.url,"bench",pool_size=args.threads*args.hedge_fanout,backoff_factor=0.01),
+        hedge_fanout=args.hedge_fanout, hedge_delay=args.hedge_delay )
+    bot.keywords.add("Hello")
+
+    rand = random.Random(0)
+    words = [ "my", "cat", "friend", "world", "Hello", "thank you" ]
+    messages = [ "Hello " + ' '.join( rand.choice(words) for _ in range(rand.randint(1,4)) ) for _ in range(args.messages) ]
+
+    def answer( message ):
+        start = time.perf_counter()
+        bot.onMessage(message)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+        latencies = list( executor.map(answer,messages) )
+    elapsed = time.perf_counter() - start
+
+    print( "%d messages in %.2fs : %.1f messages/s, %d answered" % (len(messages),elapsed,len(messages)/elapsed,chatter.sent) )
+    print( "response time : mean %.1f ms, p50 %.1f ms, p95 %.1f ms, max %.1f ms" % (
+        statistics.mean(latencies)*1000, percentile(latencies,0.5)*1000, percentile(latencies,0.95)*1000, max(latencies)*1000 ) )
+    print( "service : %r" % cloud.stats )
+    bot.executor.shutdown()
+    cloud.stop()
+
+
+if __name__ == '__main__':
+    run()
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
 import atexit
+import concurrent.futures
+import contextvars
 import logging
 import os
 import signal
@@ -62,6 +65,42 @@ class Bot:
 
 
 
+class AsyncBot:
+    """
+        Asynchronous bot foundation : messages are handled by a coroutine, so several of them can be handled at the same time
+    """
+
+    async def onMessage( self, message ):
+        """
+            Awaited by an AsyncChatter whenever a message has arrived.
+
+            message: A plain text message
+            Returns nothing
+        """
+        pass
+
+
+
+class SyncBotAdapter(AsyncBot):
+    """
+        Makes a (blocking) Bot usable as an AsyncBot : each message is handled in a thread of a pool,
+        so up to 'workers' messages are handled at the same time without blocking the event loop
+    """
+
+    def __init__( self, bot, workers=1 ):
+        self.bot = bot
+        self.executor = concurrent.futures.ThreadPoolExecutor( max_workers=workers, thread_name_prefix="bot" )
+
+    async def onMessage( self, message ):
+        # Runs in the current context so the handler knows the message's conversation (see nicobot.chatter.conversation)
+        context = contextvars.copy_context()
+        await asyncio.get_event_loop().run_in_executor( self.executor, context.run, self.bot.onMessage, message )
+
+    def close( self ):
+        self.executor.shutdown(wait=True)
+
+
+
 class ArgsHelper:
 
     """
@@ -119,17 +158,30 @@ class ArgsHelper:
         if not args.jabber_password:
             raise ValueError("Missing --jabber-password")
         recipients = args.jabber_recipients + args.recipients
-        if len(recipients)==0:
-            raise ValueError("Missing --jabber-recipient")
+        rooms = args.jabber_rooms
+        if len(recipients)==0 and len(rooms)==0:
+            raise ValueError("Either --jabber-recipient or --jabber-room must be provided")
         data_dir = args.jabber_config_dir
         if not data_dir:
             data_dir = os.path.join(args.config_dirs[0],".omemo")
         logging.debug("Using this directory for jabber config : %s",data_dir)
-        # TODO allow multiple recipients
         return JabberChatter(
             jid=username,
             password=args.jabber_password,
-            recipient=recipients[0],
+            recipients=recipients,
+            rooms=rooms,
+            nick=args.jabber_nick,
+            send_queue_size=args.jabber_send_queue,
+            send_overflow=args.jabber_send_overflow,
+            send_workers=args.jabber_send_workers,
+            drain_timeout=args.jabber_drain_timeout,
+            handler_workers=args.jabber_handler_workers,
+            unknown_senders=args.jabber_unknown_senders,
+            sender_rate=args.jabber_sender_rate,
+            sender_burst=args.jabber_sender_burst,
+            omemo_storage=args.jabber_omemo_storage,
+            server=args.jabber_server,
+            tls=args.jabber_tls,
             data_dir=data_dir
             )
 
@@ -145,22 +197,34 @@ class ArgsHelper:
         if not username:
             raise ValueError("Missing --signal-username")
         recipients = args.signal_recipients + args.recipients
-        if len(recipients)==0 and not args.signal_group:
+        groups = args.signal_groups
+        # 'signal_group' (a single group) may still be set in configuration files
+        if getattr(args,'signal_group',None):
+            groups = groups + [ args.signal_group ]
+        if len(recipients)==0 and len(groups)==0:
             raise ValueError("Either --signal-recipient or --signal-group must be provided")
         config_dir = args.signal_config_dir
         if not config_dir:
             config_dir = os.path.join(args.config_dirs[0],".signal-cli")
         logging.debug("Using this directory for signal config : %s",config_dir)
-        # TODO allow multiple recipients
+        cursor_file = args.signal_cursor_file
+        if not cursor_file:
+            cursor_file = os.path.join(args.config_dirs[0],".signal-cursor.json")
         return SignalChatter(
             username=username,
-            recipient=recipients[0],
-            group=args.signal_group,
+            recipients=recipients,
+            groups=groups,
             signal_cli=args.signal_cli,
             stealth=args.signal_stealth,
-            config_dir=config_dir
+            daemon=args.signal_daemon,
+            receive_timeout=args.signal_receive_timeout,
+            receive_timeout_max=args.signal_receive_timeout_max,
+            send_queue_size=args.signal_send_queue,
+            send_overflow=args.signal_send_overflow,
+            send_coalesce=args.signal_send_coalesce,
+            config_dir=config_dir,
+            cursor_file=cursor_file
             )
-        # TODO  :timeout=args.timeout
 
 
     def chatter( args ):
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Caching helpers
+"""
+
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+
+# Default maximum number of translations kept in memory
+CACHE_SIZE = 1000
+# Default maximum number of translations kept on disk
+CACHE_FILE_SIZE = 100000
+# Default time-to-live of a cached translation, in seconds (None or <= 0 for no expiry)
+CACHE_TTL = 30 * 24 * 3600
+
+# Returned by TranslationCache.get() when nothing is cached for the given key
+# (None is a valid cached value : it means that no translation exists)
+MISS = object()
+
+
+log = logging.getLogger(__name__)
+
+
+class TranslationCache:
+    """
+        Two-level cache of translations keyed by (text, source, target) :
+
+        1. an in-memory LRU layer limited to 'max_size' entries
+        2. an optional on-disk layer (a SQLite database) limited to 'max_file_size' entries
+
+        Entries older than 'ttl' seconds are evicted from both layers.
+        It is safe to use it from several threads.
+    """
+
+    def __init__( self, max_size=CACHE_SIZE, ttl=CACHE_TTL, file=None, max_file_size=CACHE_FILE_SIZE ):
+        """
+            max_size: maximum number of entries in memory (0 disables the memory layer)
+            ttl: time-to-live of each entry, in seconds (None or <= 0 for no expiry)
+            file: SQLite database file to use as a second layer ; no on-disk layer if None
+            max_file_size: maximum number of entries in the database (None or <= 0 for no limit)
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self.file = file
+        self.max_file_size = max_file_size if max_file_size and max_file_size > 0 else None
+
+        # Maps a key to a (value,timestamp) tuple ; most recently used entries are at the end
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.stats = {
+            'hits': 0,
+            'file_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evicted': 0,
+            }
+
+        self.db = None
+        if file:
+            self._openFile(file)
+
+
+    def _openFile( self, file ):
+
+        log.debug("Opening translation cache %s",file)
+        self.db = sqlite3.connect( file, check_same_thread=False )
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS translations (
+                    text TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    translation TEXT,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (text, source, target)
+                )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS translations_accessed ON translations (accessed)")
+        self.purge()
+
+
+    def _key( self, text, target, source ):
+        # SQLite primary keys cannot hold NULL so an empty string stands for "unknown source language"
+        return ( text, source or '', target )
+
+
+    def _isExpired( self, timestamp, now ):
+        return self.ttl is not None and now - timestamp > self.ttl
+
+
+    def _remember( self, key, value, timestamp ):
+        """
+            Stores an entry in the memory layer, evicting the least recently used entries if needed
+        """
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (value,timestamp)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+
+    def get( self, text, target, source=None ):
+        """
+            Returns the cached translation of 'text' into 'target'
+            (which may be None if it is known that there is no translation)
+            or MISS if it is not in the cache.
+        """
+
+        key = self._key(text,target,source)
+        now = time.time()
+        with self.lock:
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, timestamp = entry
+                if not self._isExpired(timestamp,now):
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                del self.entries[key]
+                self.stats['expired'] += 1
+
+            if self.db:
+                row = self.db.execute(
+                    "SELECT translation, created FROM translations WHERE text=? AND source=? AND target=?",
+                    key ).fetchone()
+                if row:
+                    value, timestamp = row
+                    with self.db:
+                        if not self._isExpired(timestamp,now):
+                            self.db.execute(
+                                "UPDATE translations SET accessed=? WHERE text=? AND source=? AND target=?",
+                                (now,) + key )
+                            self._remember(key,value,timestamp)
+                            self.stats['file_hits'] += 1
+                            return value
+                        self.db.execute( "DELETE FROM translations WHERE text=? AND source=? AND target=?", key )
+                        self.stats['expired'] += 1
+
+            self.stats['misses'] += 1
+            return MISS
+
+
+    def put( self, text, target, value, source=None ):
+        """
+            Stores the translation 'value' of 'text' into 'target' ;
+            'value' may be None to remember that there is no translation.
+        """
+
+        key = self._key(text,target,source)
+        now = time.time()
+        with self.lock:
+            self._remember(key,value,now)
+            if self.db:
+                with self.db:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO translations (text, source, target, translation, created, accessed) VALUES (?,?,?,?,?,?)",
+                        key + (value,now,now) )
+                    if self.max_file_size:
+                        # Evicts the least recently accessed entries beyond the limit
+                        cursor = self.db.execute(
+                            "DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                            (self.max_file_size,) )
+                        self.stats['evicted'] += max(cursor.rowcount,0)
+
+
+    def purge( self ):
+        """
+            Removes all expired entries from both layers
+        """
+
+        if self.ttl is None:
+            return
+        now = time.time()
+        with self.lock:
+            expired = [ key for key, (value,timestamp) in self.entries.items() if self._isExpired(timestamp,now) ]
+            for key in expired:
+                del self.entries[key]
+            self.stats['expired'] += len(expired)
+            if self.db:
+                with self.db:
+                    cursor = self.db.execute( "DELETE FROM translations WHERE created < ?", (now - self.ttl,) )
+                    self.stats['expired'] += max(cursor.rowcount,0)
+
+
+    def close( self ):
+
+        with self.lock:
+            log.debug("Translation cache statistics : %r",self.stats)
+            if self.db:
+                self.db.close()
+                self.db = None
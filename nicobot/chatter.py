@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import contextvars
+
+
+# The conversation of the message being handled, set by chatters that serve several conversations :
+# answers sent while handling a message go back to its conversation
+conversation = contextvars.ContextVar( 'conversation', default=None )
+
 
 class Chatter:
     """
@@ -36,3 +44,76 @@ class Chatter:
             Stops waiting for messages and exits the engine
         """
         pass
+
+
+
+class AsyncChatter:
+    """
+        Asynchronous bot engine interface
+
+        Same contract as Chatter, with coroutines : receiving, handling and sending messages can overlap on a single event loop.
+    """
+
+    async def connect( self ):
+        """
+            Connects / initializes the connection with the underlying protocol/network if required.
+        """
+        pass
+
+    async def start( self, bot ):
+        """
+            Waits for messages and awaits the 'onMessage' coroutine of the given AsyncBot for each one
+        """
+        pass
+
+    async def send( self, message ):
+        """
+            Sends the given message using the underlying implemented chat protocol
+        """
+        pass
+
+    async def stop( self ):
+        """
+            Stops waiting for messages and exits the engine
+        """
+        pass
+
+
+
+class _ThreadBot:
+    """
+        Bot given to a blocking Chatter running in a thread : hands each message to an AsyncBot on the event loop
+        and only waits until it has been taken
+    """
+
+    def __init__( self, bot, loop ):
+        self.bot = bot
+        self.loop = loop
+
+    def onMessage( self, message ):
+        asyncio.run_coroutine_threadsafe( self.bot.onMessage(message), self.loop ).result()
+
+
+
+class SyncChatterAdapter(AsyncChatter):
+    """
+        Makes a (blocking) Chatter usable as an AsyncChatter : its methods run in threads so they don't block the event loop
+    """
+
+    def __init__( self, chatter ):
+        self.chatter = chatter
+
+    async def _call( self, method, *args ):
+        return await asyncio.get_event_loop().run_in_executor( None, method, *args )
+
+    async def connect( self ):
+        return await self._call( self.chatter.connect )
+
+    async def start( self, bot ):
+        return await self._call( self.chatter.start, _ThreadBot(bot,asyncio.get_event_loop()) )
+
+    async def send( self, message ):
+        return await self._call( self.chatter.send, message )
+
+    async def stop( self ):
+        return await self._call( self.chatter.stop )
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Dispatching of messages to commands
+"""
+
+import logging
+import re
+import time
+
+from .helpers import *
+
+
+log = logging.getLogger(__name__)
+
+
+class Command:
+    """
+        A named command : a way to recognize a message and what to do with it
+    """
+
+    def __init__( self, name, handler, matchers, priority ):
+        """
+            name: unique name of this command
+            handler: a Callable( message, match ) ; 'match' is what the matcher returned
+            matchers: a list of Callable( text ) returning something that evaluates to True if the command matches
+            priority: commands with the lowest priority are tried first
+        """
+        self.name = name
+        self.handler = handler
+        self.matchers = matchers
+        self.priority = priority
+        self.stats = {
+            'tried': 0,
+            'matched': 0,
+            # Cumulated times in seconds
+            'match_time': 0,
+            'handle_time': 0,
+            }
+
+    def match( self, text ):
+        """
+            Returns the result of the first matcher that matches 'text' or None
+        """
+        start = time.perf_counter()
+        try:
+            for matcher in self.matchers:
+                found = matcher(text)
+                if found:
+                    return found
+            return None
+        finally:
+            self.stats['tried'] += 1
+            self.stats['match_time'] += time.perf_counter() - start
+
+    def handle( self, message, found ):
+        start = time.perf_counter()
+        try:
+            return self.handler(message,found)
+        finally:
+            self.stats['matched'] += 1
+            self.stats['handle_time'] += time.perf_counter() - start
+
+
+
+class CommandRouter:
+    """
+        Runs the first matching command for each message.
+
+        Regular expressions are compiled once, when commands are registered.
+        All matchers see the same normalized copy of the message (leading and trailing spaces removed).
+    """
+
+    def __init__( self ):
+        self.commands = []
+
+    def register( self, name, handler, patterns=[], matcher=None, priority=0, flags=re.IGNORECASE ):
+        """
+            Adds a command.
+
+            name: unique name of the command (replaces any command with the same name)
+            handler: a Callable( message, match ) called with the original message and the result of the matcher
+            patterns: a list of regular expression patterns (e.g. one per locale) ; their 'search' method will be used as matchers
+            matcher: an additional Callable( text ) returning a value that evaluates to True if the message matches
+            priority: commands with the lowest priority are tried first ; registration order is kept for equal priorities
+            flags: flags to compile patterns with
+        """
+
+        matchers = []
+        # Removes duplicate patterns (several locales may share the same ones) but keeps their order
+        for pattern in dict.fromkeys( p for p in patterns if p ):
+            log.log(TRACE,"Compiling pattern %r for command %s",pattern,name)
+            matchers.append( re.compile(pattern,flags).search )
+        if matcher:
+            matchers.append(matcher)
+        if not matchers:
+            raise ValueError("No pattern nor matcher given for command %s" % name)
+
+        self.unregister(name)
+        self.commands.append( Command(name,handler,matchers,priority) )
+        # sort() is stable so commands with the same priority stay in registration order
+        self.commands.sort( key=lambda c: c.priority )
+        log.debug("Registered command %s with %d matcher(s)",name,len(matchers))
+
+    def unregister( self, name ):
+        self.commands = [ c for c in self.commands if c.name != name ]
+
+    def dispatch( self, message ):
+        """
+            Calls the handler of the first command matching 'message'.
+
+            Returns the name of the command that was run or None if none matched.
+        """
+
+        text = message.strip()
+        for command in self.commands:
+            found = command.match(text)
+            if found:
+                log.debug("Message matched command %s",command.name)
+                command.handle(message,found)
+                return command.name
+        return None
+
+    def stats( self ):
+        """
+            Returns the matching and handling statistics of each command, by command name
+        """
+        return { c.name: dict(c.stats) for c in self.commands }
@@ -2,6 +2,7 @@
 
 import logging
 import sys
+import threading
 
 from .chatter import Chatter
 
@@ -16,6 +17,8 @@ class ConsoleChatter(Chatter):
         self.input = input
         self.output = output
         self.exit = False
+        # Messages may be sent from several threads (see nicobot.bot.SyncBotAdapter)
+        self.lock = threading.Lock()
 
     def start( self, bot ):
         # TODO Do it asynchronous (rather than testing self.exit between each instruction)
@@ -30,7 +33,8 @@ class ConsoleChatter(Chatter):
                 return
 
     def send( self, message ):
-        print(message, file = self.output, flush=True)
+        with self.lock:
+            print(message, file = self.output, flush=True)
 
     def stop( self ):
         self.exit = True
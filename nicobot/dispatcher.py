@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Concurrent handling of incoming messages
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+
+from .bot import AsyncBot
+from .helpers import *
+
+
+# Number of messages handled at the same time
+WORKERS = 4
+# Maximum number of messages waiting to be handled ; when full, the chatter waits before reading more
+QUEUE_SIZE = 100
+
+
+log = logging.getLogger(__name__)
+
+
+class Dispatcher(AsyncBot):
+    """
+        Queues the messages of a chatter and hands them to an AsyncBot, with a fixed number of concurrent handlers.
+
+        Receiving a message only waits for a place in the queue, not for the previous messages to be handled.
+        It is an AsyncBot itself, to be given to AsyncChatter.start().
+    """
+
+    def __init__( self, bot, workers=WORKERS, queue_size=QUEUE_SIZE ):
+        """
+            bot: the AsyncBot that handles messages
+            workers: number of messages handled at the same time
+            queue_size: maximum number of messages waiting to be handled (0 for no limit)
+        """
+
+        self.bot = bot
+        self.workers = max(1,workers)
+        self.queue_size = queue_size
+        # Created in start(), on the event loop
+        self.queue = None
+        self.tasks = []
+        self.stats = {
+            'received': 0,
+            'handled': 0,
+            'errors': 0,
+            'max_queued': 0,
+            # Cumulated time in seconds messages waited in the queue
+            'wait_time': 0,
+            }
+
+
+    async def onMessage( self, message ):
+        """
+            Queues the message ; waits if the queue is full
+        """
+        self.stats['received'] += 1
+        # The message is handled in the context it was received in (e.g. to know its conversation)
+        await self.queue.put( (message,time.perf_counter(),contextvars.copy_context()) )
+        self.stats['max_queued'] = max( self.stats['max_queued'], self.queue.qsize() )
+
+
+    async def _work( self ):
+
+        while True:
+            message, queued, context = await self.queue.get()
+            try:
+                self.stats['wait_time'] += time.perf_counter() - queued
+                # Tasks run in a copy of the context that was current when they were created
+                await context.run( asyncio.ensure_future, self.bot.onMessage(message) )
+                self.stats['handled'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                log.exception("Error handling message %r",message)
+            finally:
+                self.queue.task_done()
+
+
+    def start( self ):
+        """
+            Starts the handlers ; must be called from the event loop
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [ asyncio.ensure_future(self._work()) for _ in range(self.workers) ]
+        log.debug("Started %d message handlers",self.workers)
+
+
+    async def stop( self, drain=True ):
+        """
+            Stops the handlers
+
+            drain: if True, waits for the queued messages to be handled first ; else discards them
+        """
+        if drain:
+            await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather( *self.tasks, return_exceptions=True )
+        self.tasks = []
+        log.debug("Dispatcher statistics : %r",self.stats)
+
+
+
+async def serve( bot, chatter, workers=WORKERS, queue_size=QUEUE_SIZE ):
+    """
+        Runs an AsyncChatter until it stops, handling its messages with an AsyncBot in up to 'workers' concurrent tasks.
+
+        Returns the statistics of the Dispatcher.
+    """
+
+    dispatcher = Dispatcher( bot, workers=workers, queue_size=queue_size )
+    dispatcher.start()
+    try:
+        await chatter.start(dispatcher)
+    finally:
+        await dispatcher.stop()
+    return dispatcher.stats
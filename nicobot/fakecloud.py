@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Local HTTP stand-in for the /v3 endpoints of IBM Watson™ Language Translator.
+
+    It answers with any Translator (a GlossaryTranslator by default) and can simulate latency and errors,
+    so TransBot can be tested and load-tested on a single machine :
+
+        python3 -m nicobot.fakecloud --glossary-file tests/fixtures/glossary.json --port 8080 --latency 0.2 --error-rate 0.05
+        transbot --ibmcloud-url http://localhost:8080 --ibmcloud-apikey test ...
+"""
+
+import argparse
+import base64
+import http.server
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+from .helpers import *
+from .glossary import GlossaryTranslator
+
+
+log = logging.getLogger(__name__)
+
+
+class FakeCloudHandler(http.server.BaseHTTPRequestHandler):
+
+    # Allows keep-alive connections
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately : don't let them wait for each other
+    disable_nagle_algorithm = True
+
+    def log_message( self, format, *args ):
+        log.log(TRACE,"%s - %s",self.address_string(),format%args)
+
+    def _reply( self, status, body=None ):
+        data = json.dumps(body if body is not None else {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error( self, status, message ):
+        self._reply( status, { 'code':status, 'error':message } )
+
+    def _read( self ):
+        length = int(self.headers.get('Content-Length',0))
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _handle( self, method ):
+        cloud = self.server.cloud
+        path = urllib.parse.urlparse(self.path).path
+        # Reads the body first so the connection can be reused even when replying with an error
+        body = self._read() if method == 'POST' else b''
+        cloud.count('requests')
+
+        if cloud.apikey is not None:
+            expected = 'Basic ' + base64.b64encode( ('apikey:%s' % cloud.apikey).encode() ).decode()
+            if self.headers.get('Authorization') != expected:
+                cloud.count('errors')
+                return self._error( 401, "Unauthorized" )
+
+        cloud.wait()
+        if cloud.error_rate and cloud.random.random() < cloud.error_rate:
+            cloud.count('errors')
+            return self._error( cloud.error_status, "Simulated error" )
+
+        try:
+            if method == 'GET' and path.endswith('/v3/identifiable_languages'):
+                return self._reply( 200, cloud.translator.identifiableLanguages() )
+
+            elif method == 'POST' and path.endswith('/v3/identify'):
+                return self._reply( 200, cloud.translator.identify(body.decode('utf-8')) )
+
+            elif method == 'POST' and path.endswith('/v3/translate'):
+                request = json.loads(body)
+                source = request.get('source')
+                target = request.get('target')
+                if request.get('model_id'):
+                    source, target = request['model_id'].split('-',1)
+                if not target or not request.get('text'):
+                    return self._error( 400, "A target language and a text are required" )
+                translation = cloud.translator.translate( request['text'], target=target, source=source )
+                if translation is None:
+                    return self._error( 404, "Unable to translate into %s" % target )
+                return self._reply( 200, translation )
+
+            else:
+                return self._error( 404, "Not found : %s %s" % (method,path) )
+        except Exception as e:
+            log.exception("Error handling %s %s",method,path)
+            cloud.count('errors')
+            return self._error( 500, repr(e) )
+
+    def do_GET( self ):
+        self._handle('GET')
+
+    def do_POST( self ):
+        self._handle('POST')
+
+
+
+class FakeCloud:
+    """
+        Runs the stand-in HTTP server in a background thread
+    """
+
+    def __init__( self, translator, host='127.0.0.1', port=0, apikey=None,
+        latency=0, jitter=0, error_rate=0, error_status=503, seed=None ):
+        """
+            translator: the Translator that answers requests
+            host, port: where to listen ; port 0 picks a free port
+            apikey: if given, requests must authenticate with it (like IBM Cloud)
+            latency: seconds to wait before answering each request
+            jitter: random extra seconds (up to this value) to wait before answering
+            error_rate: ratio of requests (0 to 1) answered with 'error_status'
+            error_status: the HTTP status of simulated errors (e.g. 429 or 503)
+            seed: seed for the random generator, to reproduce the same errors
+        """
+
+        self.translator = translator
+        self.apikey = apikey
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = { 'requests': 0, 'errors': 0 }
+
+        self.server = http.server.ThreadingHTTPServer( (host,port), FakeCloudHandler )
+        self.server.daemon_threads = True
+        self.server.cloud = self
+        self.thread = None
+
+    @property
+    def url( self ):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host,port)
+
+    def count( self, name ):
+        with self.lock:
+            self.stats[name] += 1
+
+    def wait( self ):
+        delay = self.latency
+        if self.jitter:
+            with self.lock:
+                delay = delay + self.random.uniform(0,self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def start( self ):
+        self.thread = threading.Thread( target=self.server.serve_forever, name="fakecloud", daemon=True )
+        self.thread.start()
+        log.debug("Fake IBM Cloud listening on %s",self.url)
+        return self
+
+    def stop( self ):
+        self.server.shutdown()
+        self.server.server_close()
+        log.debug("Fake IBM Cloud statistics : %r",self.stats)
+
+
+
+def run( args=sys.argv[1:] ):
+
+    parser = argparse.ArgumentParser( description="Serves a fake IBM Watson™ Language Translator API from a local glossary" )
+    parser.add_argument("--glossary-file", dest="glossary_file", required=True, help="JSON glossary file (see nicobot.glossary)")
+    parser.add_argument("--host", dest="host", default='127.0.0.1', help="Address to listen to")
+    parser.add_argument("--port", dest="port", type=int, default=8080, help="Port to listen to")
+    parser.add_argument("--apikey", dest="apikey", default=None, help="API key that clients must use (any if not given)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0, help="Seconds to wait before answering each request")
+    parser.add_argument("--jitter", dest="jitter", type=float, default=0, help="Random extra seconds to wait before answering each request")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0, help="Ratio of requests (0 to 1) that will fail")
+    parser.add_argument("--error-status", dest="error_status", type=int, default=503, help="HTTP status of failed requests")
+    parser.add_argument('--verbosity', '-v', dest='verbosity', default="INFO", help="Log level")
+    args = parser.parse_args(args)
+
+    configure_logging(args.verbosity)
+    cloud = FakeCloud(
+        GlossaryTranslator(file=args.glossary_file),
+        host=args.host, port=args.port, apikey=args.apikey,
+        latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, error_status=args.error_status )
+    log.info("Listening on %s",cloud.url)
+    try:
+        cloud.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cloud.server.server_close()
+
+
+if __name__ == '__main__':
+    run()
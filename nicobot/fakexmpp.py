@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Local stand-in for an XMPP server, with just enough of the protocol for a few clients to chat :
+    SASL PLAIN authentication (without TLS), resource binding, roster, presence and message routing,
+    and personal eventing (PEP) where OMEMO clients publish their device lists and bundles.
+
+    So JabberChatter can be tested and load-tested on a single machine :
+
+        python3 -m nicobot.fakexmpp --port 5222 --account bot@localhost:password --account me@localhost:password
+        transbot -b jabber --jabber-server localhost:5222 --jabber-no-tls --jabber-username bot@localhost ...
+"""
+
+import argparse
+import asyncio
+import base64
+import copy
+import itertools
+import logging
+import sys
+import threading
+import xml.etree.ElementTree as ET
+
+from .helpers import *
+
+
+log = logging.getLogger(__name__)
+
+
+STREAM_NS = 'http://etherx.jabber.org/streams'
+CLIENT_NS = 'jabber:client'
+SASL_NS = 'urn:ietf:params:xml:ns:xmpp-sasl'
+BIND_NS = 'urn:ietf:params:xml:ns:xmpp-bind'
+SESSION_NS = 'urn:ietf:params:xml:ns:xmpp-session'
+STANZAS_NS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+ROSTER_NS = 'jabber:iq:roster'
+PING_NS = 'urn:xmpp:ping'
+DISCO_INFO_NS = 'http://jabber.org/protocol/disco#info'
+PUBSUB_NS = 'http://jabber.org/protocol/pubsub'
+PUBSUB_EVENT_NS = 'http://jabber.org/protocol/pubsub#event'
+
+ET.register_namespace( 'stream', STREAM_NS )
+
+
+def bare( jid ):
+    return jid.split('/',1)[0] if jid else jid
+
+
+def element( tag, attributes={}, *children, text=None ):
+    """
+        Returns a new Element ; 'tag' is namespaced like '{namespace}name'
+    """
+    e = ET.Element( tag, { k: v for k, v in attributes.items() if v is not None } )
+    e.extend(children)
+    e.text = text
+    return e
+
+
+def serialize( stanza ):
+    # Namespaces get generated prefixes (e.g. <ns0:message xmlns:ns0="jabber:client">), which XML parsers don't mind
+    return ET.tostring( stanza, encoding='utf-8', xml_declaration=False )
+
+
+
+class FakeXmppSession(asyncio.Protocol):
+    """
+        A client's connection : parses its stream and handles each stanza
+    """
+
+    def __init__( self, server ):
+        self.server = server
+        self.transport = None
+        # Bare and full JIDs once authenticated and bound
+        self.user = None
+        self.jid = None
+        self.available = False
+
+    def connection_made( self, transport ):
+        self.transport = transport
+        self.server.count('connections')
+        self.restart()
+
+    def restart( self ):
+        # A new stream starts after authentication
+        self.parser = ET.XMLPullParser( events=('start','end') )
+        self.depth = 0
+        self.root = None
+
+    def write( self, data ):
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def send( self, stanza ):
+        self.write( serialize(stanza) )
+
+    def data_received( self, data ):
+        parser = self.parser
+        try:
+            parser.feed(data)
+            for event, e in parser.read_events():
+                if event == 'start':
+                    self.depth += 1
+                    if self.depth == 1:
+                        self.root = e
+                        self.openStream()
+                    continue
+                self.depth -= 1
+                if self.depth == 0:
+                    self.write(b"</stream:stream>")
+                    self.transport.close()
+                    return
+                if self.depth == 1:
+                    self.root.remove(e)
+                    self.server.count('stanzas')
+                    self.handle(e)
+                    # Events that were parsed before the restart belong to the previous stream
+                    if parser is not self.parser:
+                        return
+        except ET.ParseError:
+            log.warning("Invalid XML from %s",self.jid,exc_info=True)
+            self.transport.close()
+
+    def connection_lost( self, exc ):
+        if self.jid and self.server.sessions.get(self.jid) is self:
+            del self.server.sessions[self.jid]
+            if self.available:
+                self.broadcast( element( '{%s}presence' % CLIENT_NS, { 'from':self.jid, 'type':'unavailable' } ) )
+
+    def openStream( self ):
+        self.write( ( "<?xml version='1.0'?><stream:stream xmlns='%s' xmlns:stream='%s' from='%s' id='%d' version='1.0' xml:lang='en'>"
+            % ( CLIENT_NS, STREAM_NS, self.server.domain, next(self.server.ids) ) ).encode('utf-8') )
+        if self.user:
+            features = "<bind xmlns='%s'/><session xmlns='%s'><optional/></session>" % (BIND_NS,SESSION_NS)
+        else:
+            features = "<mechanisms xmlns='%s'><mechanism>PLAIN</mechanism></mechanisms>" % SASL_NS
+        self.write( ("<stream:features>%s</stream:features>" % features).encode('utf-8') )
+
+    def handle( self, stanza ):
+        if stanza.tag == '{%s}auth' % SASL_NS:
+            return self.authenticate(stanza)
+        if not self.user:
+            log.debug("Closing unauthenticated stream")
+            return self.transport.close()
+        if stanza.tag == '{%s}iq' % CLIENT_NS:
+            return self.iq(stanza)
+        if not self.jid:
+            return self.transport.close()
+        stanza.set( 'from', self.jid )
+        if stanza.tag == '{%s}message' % CLIENT_NS:
+            self.server.count('messages')
+            return self.route(stanza)
+        if stanza.tag == '{%s}presence' % CLIENT_NS:
+            return self.presence(stanza)
+        log.debug("Ignoring %s",stanza.tag)
+
+    def authenticate( self, auth ):
+        try:
+            authzid, user, password = base64.b64decode(auth.text or '').decode('utf-8').split('\0')
+        except ValueError:
+            user, password = None, None
+        user = "%s@%s" % ( user, self.server.domain )
+        if auth.get('mechanism') == 'PLAIN' and self.server.authorize( user, password ):
+            self.user = user
+            self.write( ("<success xmlns='%s'/>" % SASL_NS).encode('utf-8') )
+            self.restart()
+        else:
+            self.server.count('auth_failures')
+            self.write( ("<failure xmlns='%s'><not-authorized/></failure>" % SASL_NS).encode('utf-8') )
+
+    def iq( self, iq ):
+        to = iq.get('to')
+        payload = iq[0] if len(iq) else None
+        if payload is not None and payload.tag == '{%s}bind' % BIND_NS:
+            return self.bind( iq, payload )
+        if not self.jid:
+            return self.transport.close()
+        iq.set( 'from', self.jid )
+        if to and '/' in to and to != self.jid:
+            # Between clients
+            return self.route(iq)
+        if iq.get('type') not in ('get','set') or payload is None:
+            return
+        if payload.tag == '{%s}pubsub' % PUBSUB_NS:
+            return self.pubsub( iq, bare(to) if to else self.user, payload )
+        if to in (None, self.server.domain, self.user):
+            if payload.tag == '{%s}session' % SESSION_NS or payload.tag == '{%s}ping' % PING_NS:
+                return self.reply(iq)
+            if payload.tag == '{%s}query' % ROSTER_NS:
+                return self.roster(iq)
+            if payload.tag == '{%s}query' % DISCO_INFO_NS:
+                return self.reply( iq, element( '{%s}query' % DISCO_INFO_NS, {},
+                    element( '{%s}identity' % DISCO_INFO_NS, { 'category':'server' if to == self.server.domain else 'account', 'type':'im' if to == self.server.domain else 'registered' } ),
+                    element( '{%s}feature' % DISCO_INFO_NS, { 'var':PUBSUB_NS } ) ) )
+        self.error( iq, 'service-unavailable' )
+
+    def bind( self, iq, bind ):
+        resource = bind.findtext( '{%s}resource' % BIND_NS ) or "fake%d" % next(self.server.ids)
+        self.jid = "%s/%s" % ( self.user, resource )
+        previous = self.server.sessions.get(self.jid)
+        if previous:
+            log.debug("Replacing the session of %s",self.jid)
+            previous.transport.close()
+        self.server.sessions[self.jid] = self
+        self.server.count('sessions')
+        self.reply( iq, element( '{%s}bind' % BIND_NS, {}, element( '{%s}jid' % BIND_NS, text=self.jid ) ) )
+
+    def roster( self, iq ):
+        # Everybody knows everybody
+        if iq.get('type') == 'set':
+            return self.reply(iq)
+        items = [ element( '{%s}item' % ROSTER_NS, { 'jid':jid, 'subscription':'both' } ) for jid in sorted(self.server.users()) if jid != self.user ]
+        self.reply( iq, element( '{%s}query' % ROSTER_NS, {}, *items ) )
+
+    def presence( self, presence ):
+        if presence.get('to'):
+            return self.route(presence)
+        self.available = presence.get('type') != 'unavailable'
+        self.server.presences[self.jid] = presence
+        self.broadcast(presence)
+        # The others' presence
+        for jid, session in self.server.sessions.items():
+            if session is not self and session.available:
+                self.send( self.server.presences[jid] )
+
+    def pubsub( self, iq, owner, pubsub ):
+        action = pubsub[0] if len(pubsub) else None
+        node = action.get('node') if action is not None else None
+        if action is None or not node:
+            return self.error( iq, 'bad-request', type='modify' )
+        if action.tag == '{%s}publish' % PUBSUB_NS:
+            if owner != self.user:
+                return self.error( iq, 'forbidden', type='auth' )
+            item = action.find( '{%s}item' % PUBSUB_NS )
+            if item is None:
+                return self.error( iq, 'bad-request', type='modify' )
+            if not item.get('id'):
+                item.set( 'id', str(next(self.server.ids)) )
+            self.server.count('published')
+            self.server.nodes.setdefault( (owner,node), {} )[item.get('id')] = item
+            self.reply( iq, element( '{%s}pubsub' % PUBSUB_NS, {}, element( '{%s}publish' % PUBSUB_NS, { 'node':node }, element( '{%s}item' % PUBSUB_NS, { 'id':item.get('id') } ) ) ) )
+            # The contacts are notified of the new item
+            event = copy.deepcopy(item)
+            event.tag = '{%s}item' % PUBSUB_EVENT_NS
+            for session in list(self.server.sessions.values()):
+                session.send( element( '{%s}message' % CLIENT_NS, { 'from':owner, 'to':session.jid, 'type':'headline' },
+                    element( '{%s}event' % PUBSUB_EVENT_NS, {}, element( '{%s}items' % PUBSUB_EVENT_NS, { 'node':node }, copy.deepcopy(event) ) ) ) )
+        elif action.tag == '{%s}items' % PUBSUB_NS:
+            self.server.count('fetched')
+            items = self.server.nodes.get( (owner,node) )
+            if items is None:
+                return self.error( iq, 'item-not-found' )
+            wanted = [ i.get('id') for i in action.findall( '{%s}item' % PUBSUB_NS ) ]
+            found = [ items[id] for id in wanted if id in items ] if wanted else list(items.values())
+            if action.get('max_items'):
+                found = found[-int(action.get('max_items')):]
+            self.reply( iq, element( '{%s}pubsub' % PUBSUB_NS, {}, element( '{%s}items' % PUBSUB_NS, { 'node':node }, *found ) ) )
+        else:
+            # Subscriptions and node configuration are implicit
+            self.reply(iq)
+
+    def route( self, stanza ):
+        to = stanza.get('to')
+        if not to:
+            return
+        if '/' in to and to in self.server.sessions:
+            targets = [ self.server.sessions[to] ]
+        else:
+            targets = [ s for s in self.server.sessions.values() if s.user == bare(to) ]
+        if not targets:
+            self.server.count('dropped')
+            log.debug("Nobody to deliver to %s",to)
+            if stanza.tag == '{%s}iq' % CLIENT_NS and stanza.get('type') in ('get','set'):
+                self.error( stanza, 'service-unavailable' )
+            return
+        data = serialize(stanza)
+        for target in targets:
+            target.write(data)
+
+    def broadcast( self, stanza ):
+        data = serialize(stanza)
+        for session in list(self.server.sessions.values()):
+            if session is not self:
+                session.write(data)
+
+    def reply( self, iq, *payload ):
+        self.send( element( '{%s}iq' % CLIENT_NS, { 'type':'result', 'id':iq.get('id'), 'to':self.jid, 'from':iq.get('to') }, *payload ) )
+
+    def error( self, iq, condition, type='cancel' ):
+        self.send( element( '{%s}iq' % CLIENT_NS, { 'type':'error', 'id':iq.get('id'), 'to':self.jid or iq.get('from'), 'from':iq.get('to') },
+            element( '{%s}error' % CLIENT_NS, { 'type':type }, element( '{%s}%s' % (STANZAS_NS,condition) ) ) ) )
+
+
+
+class FakeXmpp:
+    """
+        Runs the stand-in XMPP server in a background thread with its own event loop
+    """
+
+    def __init__( self, domain='localhost', accounts=None, host='127.0.0.1', port=0 ):
+        """
+            domain: the domain of the users' JIDs
+            accounts: { bare JID : password } of the users allowed to log in ; anyone with any password if None
+            host, port: where to listen ; port 0 picks a free port
+        """
+
+        self.domain = domain
+        self.accounts = accounts
+        self.host = host
+        self.port = port
+        self.ids = itertools.count(1)
+        # Sessions by full JID
+        self.sessions = {}
+        # Last presence of each session
+        self.presences = {}
+        # PEP items by (owner's bare JID, node) and id
+        self.nodes = {}
+        self.stats = {
+            'connections': 0,
+            'auth_failures': 0,
+            'sessions': 0,
+            'stanzas': 0,
+            'messages': 0,
+            'dropped': 0,
+            'published': 0,
+            'fetched': 0,
+            }
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def address( self ):
+        return (self.host,self.port)
+
+    def count( self, name ):
+        # Only called from the server's thread
+        self.stats[name] += 1
+
+    def authorize( self, user, password ):
+        return self.accounts is None or self.accounts.get(user) == password
+
+    def users( self ):
+        return set(self.accounts) if self.accounts is not None else set( s.user for s in self.sessions.values() )
+
+    async def listen( self ):
+        self.server = await asyncio.get_event_loop().create_server( lambda: FakeXmppSession(self), self.host, self.port )
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.debug("Fake XMPP server listening on %s:%d",self.host,self.port)
+
+    def start( self ):
+        ready = threading.Event()
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.listen())
+            ready.set()
+            self.loop.run_forever()
+            self.loop.close()
+        self.thread = threading.Thread( target=serve, name="fakexmpp", daemon=True )
+        self.thread.start()
+        ready.wait()
+        return self
+
+    async def close( self ):
+        self.server.close()
+        for session in list(self.sessions.values()):
+            session.transport.close()
+        await self.server.wait_closed()
+
+    def stop( self ):
+        asyncio.run_coroutine_threadsafe( self.close(), self.loop ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        log.debug("Fake XMPP server statistics : %r",self.stats)
+
+
+
+def run( args=sys.argv[1:] ):
+
+    parser = argparse.ArgumentParser( description="Serves a fake XMPP server for local tests (no TLS, no persistence)" )
+    parser.add_argument("--domain", dest="domain", default='localhost', help="Domain of the users' JIDs")
+    parser.add_argument("--account", dest="accounts", action='append', default=[], help="An account allowed to log in, as 'jid:password' (anyone can log in if none is given) ; may be given several times")
+    parser.add_argument("--host", dest="host", default='127.0.0.1', help="Address to listen to")
+    parser.add_argument("--port", dest="port", type=int, default=5222, help="Port to listen to")
+    parser.add_argument('--verbosity', '-v', dest='verbosity', default="INFO", help="Log level")
+    args = parser.parse_args(args)
+
+    configure_logging(args.verbosity)
+    accounts = dict( a.split(':',1) for a in args.accounts ) if args.accounts else None
+    server = FakeXmpp( domain=args.domain, accounts=accounts, host=args.host, port=args.port )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.listen())
+    log.info("Listening on %s:%d",server.host,server.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        log.info("Statistics : %r",server.stats)
+
+
+if __name__ == '__main__':
+    run()
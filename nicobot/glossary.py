@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Offline translation service backed by a local glossary
+"""
+
+import json
+import logging
+import re
+import unicodedata
+
+from .translator import Translator
+
+
+log = logging.getLogger(__name__)
+
+
+# Splits a text into words and separators
+RE_TOKENS = re.compile( r'(\w+)', re.UNICODE )
+
+
+def _normalize( text ):
+    return unicodedata.normalize('NFKC',text).strip().casefold()
+
+
+class GlossaryTranslator(Translator):
+    """
+        Translates text without network access, looking up whole messages then single words in a glossary.
+
+        Meant for tests and load tests : it is fast and deterministic but only knows the words from its glossary.
+
+        The glossary is a JSON structure like :
+
+            {
+                "languages": [ {"language":"en", "name":"English"}, {"language":"fr", "name":"French"} ],
+                "glossary": [
+                    { "en": "Hello", "fr": "Bonjour" },
+                    { "en": "world", "fr": "monde" }
+                ]
+            }
+
+        Each entry of "glossary" is the same term in several languages.
+        "languages" is optional : it defaults to all the languages found in the glossary.
+    """
+
+    def __init__( self, glossary=None, file=None ):
+        """
+            glossary: the glossary as a dict (see above)
+            file: a JSON file to read the glossary from, if 'glossary' is not given
+        """
+
+        if glossary is None:
+            log.debug("Reading glossary from %s...",file)
+            with open(file,'r') as f:
+                glossary = json.load(f)
+
+        self.entries = glossary.get('glossary',[])
+        # Maps each language code to a dict of { normalized term : index of the entry }
+        self.terms = {}
+        for i, entry in enumerate(self.entries):
+            for language, term in entry.items():
+                self.terms.setdefault(language,{})[_normalize(term)] = i
+        self.languages = glossary.get('languages') or [ {'language':l, 'name':l} for l in sorted(self.terms) ]
+        log.debug("Loaded %d glossary entries in %d languages",len(self.entries),len(self.languages))
+
+
+    def _lookup( self, text, source, target ):
+        """
+            Returns the translation of a single term or None
+        """
+        i = self.terms.get(source,{}).get(_normalize(text))
+        if i is None:
+            return None
+        return self.entries[i].get(target)
+
+
+    def translate( self, messages, target, source=None ):
+
+        translations = []
+        for message in messages:
+            lang = source
+            if not lang:
+                identified = self.identify(message)['languages']
+                lang = identified[0]['language'] if identified else None
+            # Like IBM Cloud, refuses to translate into the same language
+            if not lang or lang == target:
+                return None
+            translation = self._lookup(message,lang,target)
+            if translation is None:
+                # Translates word by word, keeping unknown words and separators as is
+                tokens = RE_TOKENS.split(message)
+                found = False
+                for t in range(1,len(tokens),2):
+                    word = self._lookup(tokens[t],lang,target)
+                    if word is not None:
+                        tokens[t] = word
+                        found = True
+                if not found:
+                    return None
+                translation = ''.join(tokens)
+            translations.append({ 'translation': translation })
+        return {
+            'translations': translations,
+            'word_count': sum( len(RE_TOKENS.findall(m)) for m in messages ),
+            'character_count': sum( len(m) for m in messages ),
+            }
+
+
+    def identifiableLanguages( self ):
+
+        return { 'languages': self.languages }
+
+
+    def identify( self, text ):
+
+        words = [ _normalize(w) for w in RE_TOKENS.findall(text) ]
+        languages = []
+        if words:
+            for language, terms in self.terms.items():
+                known = sum( 1 for w in words if w in terms )
+                if _normalize(text) in terms:
+                    known = len(words)
+                if known > 0:
+                    languages.append({ 'language':language, 'confidence':known/len(words) })
+        languages.sort( key=lambda l: l['confidence'], reverse=True )
+        return { 'languages': languages }
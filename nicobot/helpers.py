@@ -7,6 +7,9 @@
 import logging
 import os
 import sys
+import tempfile
+import threading
+import time
 import yaml
 
 
@@ -59,6 +62,36 @@ def obfuscate( obj, keys=['ibmcloud_apikey','jabber_password'] ):
         return obj
 
 
+class RateLimiter:
+    """
+        Spaces out calls so that no more than 'rate' of them happen per second.
+
+        It is safe to share it between threads.
+    """
+
+    def __init__( self, rate ):
+        """
+            rate: maximum number of calls per second ; None or <= 0 means no limit
+        """
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def acquire( self ):
+        """
+            Blocks until the next call is allowed
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now,self.next) + self.interval
+        if wait > 0:
+            log.log(TRACE,"Rate limited : waiting %fs",wait)
+            time.sleep(wait)
+
+
 def filter_files( files, should_exist=False, fallback_to=None ):
     """
         files: a list of filenames / open files to filter
@@ -88,6 +121,25 @@ def filter_files( files, should_exist=False, fallback_to=None ):
     return found
 
 
+def write_atomically( file, text ):
+    """
+        Writes 'text' into 'file' so that readers either see the previous content or the new one, never a partial one
+        (even if the process crashes while writing)
+    """
+
+    dir = os.path.dirname(os.path.abspath(file))
+    fd, tmp = tempfile.mkstemp( dir=dir, prefix='.%s.' % os.path.basename(file), suffix='.tmp' )
+    try:
+        with os.fdopen(fd,'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp,file)
+    except:
+        os.remove(tmp)
+        raise
+
+
 def parse_args_2pass( parser, args, config ):
     """
         Wrapper around argparse's ArgumentParser.parse_args that makes two passes :
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Client for IBM Watson™ Language Translator
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .translator import Translator
+
+
+# Timeouts for requests in seconds
+# Note : More than 10s recommended (30s ?) for reading on IBM Cloud with a free account
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# Maximum number of connections kept alive to the service
+POOL_SIZE = 10
+# Number of retries on connection errors and on 429 / 5xx responses
+RETRIES = 3
+# Retries wait for {backoff factor} * (2 ** ({number of previous retries}))
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = ( 429, 500, 502, 503, 504 )
+
+API_VERSION = "2018-05-01"
+
+
+log = logging.getLogger(__name__)
+
+
+"""
+    TODO Find a better way to log requests.Response objects
+"""
+def _logResponse( r ):
+    log.debug("<<< Response : %s\tbody: %s", repr(r), r.content )
+
+
+def _retry( retries, backoff_factor ):
+    """
+        Returns a retry policy on 429 & 5xx responses for all methods
+        (POST on /v3/translate has no side effect so it can be retried)
+    """
+    options = {
+        'total': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': RETRY_STATUSES,
+        # Gives the last response back rather than raising an error
+        'raise_on_status': False,
+        }
+    try:
+        return Retry( allowed_methods=None, **options )
+    except TypeError:
+        # Before urllib3 1.26
+        return Retry( method_whitelist=False, **options )
+
+
+class IbmCloudTranslator(Translator):
+    """
+        Translates text with IBM Watson™ Language Translator (see API docs : https://cloud.ibm.com/apidocs/language-translator).
+
+        It keeps a pool of keep-alive connections to the service, so it is meant to be created once and reused.
+        It is safe to use it from several threads.
+    """
+
+    def __init__( self, url, apikey,
+        pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+        retries=RETRIES, backoff_factor=BACKOFF_FACTOR ):
+        """
+            url: IBM Cloud API base URL (e.g. 'https://api.eu-de.language-translator.watson.cloud.ibm.com/instances/xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxx')
+            apikey: IBM Cloud API key (e.g. 'dG90byBlc3QgZGFucyBsYSBwbGFjZQo')
+            pool_size: maximum number of connections kept alive
+            connect_timeout, read_timeout: timeouts in seconds
+            retries: number of retries on connection errors and 429 / 5xx responses
+            backoff_factor: base delay between retries (see urllib3's Retry)
+        """
+
+        self.url = url
+        self.timeout = ( connect_timeout, read_timeout )
+
+        self.session = requests.Session()
+        self.session.auth = ( 'apikey', apikey )
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'X-Watson-Learning-Opt-Out': 'true'
+            })
+        adapter = HTTPAdapter( pool_connections=1, pool_maxsize=pool_size, max_retries=_retry(retries,backoff_factor) )
+        self.session.mount( 'https://', adapter )
+        self.session.mount( 'http://', adapter )
+
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            # Latencies in seconds
+            'last_latency': None,
+            'max_latency': 0,
+            'total_latency': 0,
+            }
+
+
+    def _count( self, name ):
+        with self.lock:
+            self.stats[name] += 1
+
+
+    def _request( self, method, path, **kwargs ):
+        """
+            Sends a request to the service and measures its latency (including retries)
+        """
+
+        url = "%s%s" % (self.url,path)
+        log.debug(">>> %s %s %s", method, url, repr(kwargs))
+        start = time.perf_counter()
+        try:
+            r = self.session.request( method, url, params={'version':API_VERSION}, timeout=self.timeout, **kwargs )
+        except requests.RequestException:
+            self._count('errors')
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['last_latency'] = latency
+                self.stats['max_latency'] = max(self.stats['max_latency'],latency)
+                self.stats['total_latency'] += latency
+        log.debug("%s %s took %.3fs", method, path, latency)
+        # TODO Log full response when it's usefull (i.e. when a message is going to be answered)
+        _logResponse(r)
+        return r
+
+
+    def translate( self, messages, target, source=None ):
+        """
+            Translates a given list of messages.
+
+            target: Target language short code (e.g. 'en')
+            source: Source language short code ; if not given will try to guess
+
+            Returns the full JSON translation as per the IBM cloud service or None if no translation could be found.
+        """
+
+        # curl -X POST -u "apikey:{apikey}" --header "Content-Type: application/json" --data "{\"text\": [\"Hello, world! \", \"How are you?\"], \"model_id\":\"en-es\"}" "{url}/v3/translate?version=2018-05-01"
+        body = {
+            "text": messages,
+            "target": target
+            }
+        if source:
+            body['source'] = source
+        r = self._request( 'POST', "/v3/translate", json=body )
+        if r.status_code == requests.codes.ok:
+            return r.json()
+        # A 404 can happen if there is no translation available
+        elif r.status_code == requests.codes.not_found:
+            return None
+        else:
+            self._count('errors')
+            r.raise_for_status()
+
+
+    def identifiableLanguages( self ):
+        """
+            Returns the JSON list of languages as per the IBM cloud service (names are in english)
+        """
+
+        # curl --user apikey:{apikey} "{url}/v3/identifiable_languages?version=2018-05-01"
+        r = self._request( 'GET', "/v3/identifiable_languages" )
+        if r.status_code != requests.codes.ok:
+            self._count('errors')
+        r.raise_for_status()
+        return r.json()
+
+
+    def identify( self, text ):
+        """
+            Returns the JSON list of languages identified for the given text as per the IBM cloud service
+        """
+
+        # curl -X POST --user "apikey:{apikey}" --header "Content-Type: text/plain" --data "Language translator translates text from one language to another" "{url}/v3/identify?version=2018-05-01"
+        r = self._request( 'POST', "/v3/identify", data=text.encode('utf-8'), headers={'Content-Type':'text/plain; charset=utf-8'} )
+        if r.status_code != requests.codes.ok:
+            self._count('errors')
+        r.raise_for_status()
+        return r.json()
+
+
+    def averageLatency( self ):
+        if self.stats['requests'] == 0:
+            return None
+        return self.stats['total_latency'] / self.stats['requests']
+
+
+    def close( self ):
+
+        log.debug("Translator statistics : %r, average latency : %r", self.stats, self.averageLatency())
+        self.session.close()
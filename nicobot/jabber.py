@@ -2,9 +2,15 @@
 
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import copy
 import logging
 import os
+import random
 import time
+from collections import namedtuple
 
 from slixmpp import ClientXMPP, JID
 from slixmpp.exceptions import IqTimeout, IqError
@@ -15,12 +21,265 @@ from slixmpp_omemo import UndecidedException, UntrustedException, NoAvailableSes
 from omemo.exceptions import MissingBundleException
 
 # Own classes
-from .chatter import Chatter
+from .chatter import Chatter, conversation
 from .helpers import *
+from .loopmonitor import LagMonitor
+from .omemostorage import storage, STORAGE_JSON, STORAGE_BACKENDS
+from .sendqueue import AsyncSendQueue, SEND_QUEUE_SIZE, OVERFLOW_BLOCK, OVERFLOW_POLICIES, SEND_WORKERS, DRAIN_TIMEOUT
 
 log = logging.getLogger(__name__)
 
 
+# Seconds after which a recipient's OMEMO device list is fetched again before encrypting for it
+DEVICE_LIST_TTL = 3600
+# Seconds during which devices whose OMEMO bundle could not be fetched are not encrypted for
+BAD_DEVICE_TTL = 600
+# Seconds after which a message whose delivery receipt has not come is considered unacknowledged
+RECEIPT_TIMEOUT = 300
+# Seconds to wait before reconnecting after the connection is lost (doubled after each failed attempt, up to RECONNECT_DELAY_MAX)
+RECONNECT_DELAY = 1
+RECONNECT_DELAY_MAX = 120
+# Port of XMPP servers for clients
+XMPP_PORT = 5222
+# Number of threads running the bot's handlers (0 runs them on the event loop)
+HANDLER_WORKERS = 1
+# What to do with messages from senders that are neither a recipient nor a room
+UNKNOWN_DROP = 'drop'
+UNKNOWN_LIMIT = 'limit'
+UNKNOWN_POLICIES = [ UNKNOWN_DROP, UNKNOWN_LIMIT ]
+# Budget of each unknown sender when they are rate-limited : messages per minute, and at most this many in a row
+SENDER_RATE = 6
+SENDER_BURST = 3
+# Number of unknown senders whose budget is remembered (the least recent ones are forgotten first)
+SENDER_BUDGETS = 1000
+
+
+# A conversation with a person ('chat') or in a room ('groupchat')
+Conversation = namedtuple( 'Conversation', ['jid','type'] )
+
+
+
+class OmemoCache:
+
+    """
+        Remembers when the OMEMO device list of each recipient was fetched and which of its devices have no usable bundle,
+        so that sending a message doesn't cost IQ round trips each time.
+
+        Fetched bundles are kept by the OMEMO plugin itself. The plugin's fetching methods are wrapped to count IQ round trips.
+    """
+
+    def __init__( self, omemo, device_list_ttl=DEVICE_LIST_TTL, bad_device_ttl=BAD_DEVICE_TTL ):
+        """
+            omemo: the 'xep_0384' plugin of slixmpp_omemo
+        """
+
+        self.omemo = omemo
+        self.device_list_ttl = device_list_ttl
+        self.bad_device_ttl = bad_device_ttl
+        # Time each device list was last read, by bare JID
+        self.device_lists = {}
+        # Devices to skip, by bare JID : { device id : expiry time }
+        self.bad_devices = {}
+        self.stats = {
+            # Messages encrypted without any IQ round trip
+            'hits': 0,
+            'misses': 0,
+            'iq': 0,
+            # Cumulated seconds waiting for IQ responses
+            'iq_time': 0,
+            'bad_devices': 0,
+            }
+        omemo._fetch_bundle = self._counted(omemo._fetch_bundle)
+        omemo._fetch_device_list = self._counted(omemo._fetch_device_list)
+        # Also called when a contact publishes a new device list
+        read_device_list = omemo._read_device_list
+        async def _read_device_list( jid, items ):
+            self.device_lists[JID(jid).bare] = time.monotonic()
+            return await read_device_list( jid, items )
+        omemo._read_device_list = _read_device_list
+
+
+    def _counted( self, fetch ):
+
+        async def counted( *args, **kwargs ):
+            self.stats['iq'] += 1
+            start = time.monotonic()
+            try:
+                return await fetch( *args, **kwargs )
+            finally:
+                self.stats['iq_time'] += time.monotonic() - start
+        return counted
+
+
+    def problems( self, recipients ):
+        """
+            Returns the devices not to encrypt for, as expected by encrypt_message : { JID : [ device ids ] }
+        """
+
+        now = time.monotonic()
+        problems = {}
+        for jid in recipients:
+            bare = JID(jid).bare
+            devices = self.bad_devices.get(bare)
+            if devices:
+                for device, expiry in list(devices.items()):
+                    if expiry <= now:
+                        log.debug("Will try device %d of %s again",device,bare)
+                        del devices[device]
+                if devices:
+                    problems[JID(bare)] = list(devices)
+        return problems
+
+
+    def markBad( self, jid, device ):
+        """
+            Skips the given device for a while
+        """
+        self.stats['bad_devices'] += 1
+        self.bad_devices.setdefault( JID(jid).bare, {} )[device] = time.monotonic() + self.bad_device_ttl
+
+
+    def isFresh( self, jid ):
+        read = self.device_lists.get( JID(jid).bare )
+        return read is not None and time.monotonic() - read < self.device_list_ttl
+
+
+    async def refresh( self, recipients ):
+        """
+            Fetches the device lists that are too old (or were never fetched)
+        """
+
+        for jid in recipients:
+            if not self.isFresh(jid):
+                log.debug("Fetching the OMEMO devices of %s",jid)
+                try:
+                    await self.omemo._fetch_device_list( JID(jid) )
+                except (IqError, IqTimeout):
+                    log.warning("Could not fetch the OMEMO devices of %s",jid,exc_info=True)
+
+
+    async def prewarm( self, recipients ):
+        """
+            Fetches the device lists and bundles of the given recipients, so that the first message to them is sent quickly
+
+            It runs in the background : errors are logged, not raised (the keys will then be fetched when sending)
+        """
+
+        try:
+            await self.refresh(recipients)
+            devices = []
+            for jid in recipients:
+                bare = JID(jid).bare
+                known = self.omemo.bundles.get(bare,{})
+                devices += [ (bare,device) for device in self.omemo.get_device_list(JID(bare)) if device not in known ]
+        except Exception:
+            log.warning("Could not prewarm the OMEMO cache for %r",recipients,exc_info=True)
+            return
+        results = await asyncio.gather( *[ self._prefetch(jid,device) for jid, device in devices ], return_exceptions=True )
+        for (jid,device), result in zip(devices,results):
+            if isinstance(result,Exception):
+                log.warning("Could not fetch the keys of device %d of %s",device,jid,exc_info=result)
+        log.debug("OMEMO cache ready for %r : %r",recipients,self.stats)
+
+
+    async def _prefetch( self, jid, device ):
+
+        bundle = await self.omemo._fetch_bundle( jid, device )
+        if bundle is None:
+            log.warning('Could not find keys for device "%d" of recipient "%s". Skipping.', device, jid)
+            self.markBad( jid, device )
+        else:
+            self.omemo.bundles.setdefault(jid,{})[device] = bundle
+
+
+
+class SenderFilter:
+
+    """
+        Tells which incoming messages are worth processing by only looking at their sender and type,
+        before any OMEMO decryption : messages from the recipients and the rooms are always accepted,
+        the ones from unknown senders are either dropped or allowed within a budget per sender.
+    """
+
+    def __init__( self, recipients=[], rooms=[], unknown=UNKNOWN_DROP, rate=SENDER_RATE, burst=SENDER_BURST, budgets=SENDER_BUDGETS ):
+        """
+            recipients: bare JIDs of the persons to chat with
+            rooms: bare JIDs of the group chats
+            unknown: what to do with messages from other senders (one of UNKNOWN_POLICIES)
+            rate, burst: budget of each unknown sender with UNKNOWN_LIMIT (messages per minute, and in a row)
+            budgets: number of unknown senders whose budget is remembered
+        """
+
+        if unknown not in UNKNOWN_POLICIES:
+            raise ValueError("Unknown policy for unknown senders : %r" % unknown)
+        self.recipients = set( JID(r).bare for r in recipients )
+        self.rooms = set( JID(r).bare for r in rooms )
+        self.unknown = unknown
+        self.rate = rate / 60
+        self.burst = burst
+        self.budgets = budgets
+        # Remaining messages and time they were counted, by bare JID (least recent first)
+        self.senders = collections.OrderedDict()
+        self.stats = {
+            'recipient': 0,
+            'room': 0,
+            # Messages that can't be for the bot (errors, headlines...)
+            'ignored_type': 0,
+            'unknown_dropped': 0,
+            'unknown_allowed': 0,
+            'rate_limited': 0,
+            }
+
+
+    def decide( self, msg ):
+        """
+            Returns what to do with the given message, as the name of the counter to increment :
+            it is to be processed if it comes from a recipient, a room or is an allowed unknown sender
+        """
+
+        bare = msg['from'].bare
+        if msg['type'] == 'groupchat':
+            # The bot only sees rooms it has joined, but they can't be answered otherwise
+            return 'room' if bare in self.rooms else 'unknown_dropped'
+        if msg['type'] not in ('chat', 'normal'):
+            return 'ignored_type'
+        if bare in self.recipients:
+            return 'recipient'
+        if self.unknown == UNKNOWN_DROP:
+            return 'unknown_dropped'
+        return 'unknown_allowed' if self.spend(bare) else 'rate_limited'
+
+
+    def spend( self, jid ):
+        """
+            Takes a message from the budget of the given sender (a token bucket) ; returns False if it is exhausted
+        """
+
+        now = time.monotonic()
+        tokens, updated = self.senders.pop( jid, (self.burst, now) )
+        tokens = min( self.burst, tokens + (now - updated) * self.rate )
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.senders[jid] = (tokens, now)
+        while len(self.senders) > self.budgets:
+            self.senders.popitem(last=False)
+        return allowed
+
+
+    def accept( self, msg ):
+        """
+            Returns True if the given message is to be processed
+        """
+
+        decision = self.decide(msg)
+        self.stats[decision] += 1
+        if decision in ('unknown_dropped', 'rate_limited', 'ignored_type'):
+            log.debug("Discarding message (%s) from %s",decision,msg['from'])
+            return False
+        return True
+
+
 
 class SliXmppClient(ClientXMPP):
 
@@ -32,29 +291,47 @@ class SliXmppClient(ClientXMPP):
 
     eme_ns = 'eu.siacs.conversations.axolotl'
 
-    def __init__(self, jid, password, message_handler, data_dir):
+    def __init__(self, jid, password, message_handler, data_dir, prewarm=[], rooms=[], nick=None, senders=None, omemo_storage=STORAGE_JSON,
+        server=None, tls=True):
 
         """
             jid, password : valid account to send and receive messages
             message_handler : a Callable( original_message:Message, decrypted_body )
+            prewarm : JIDs whose OMEMO devices and bundles to fetch as soon as connected
+            rooms : JIDs of the group chats (MUC) to join
+            nick : nickname in the rooms (defaults to the local part of the JID)
+            senders : a SenderFilter telling which messages to process ; all of them if missing
+            omemo_storage : where to store OMEMO keys and sessions in data_dir (one of nicobot.omemostorage.STORAGE_BACKENDS)
+            server : ( host, port ) of the server to connect to ; found from the JID's domain if missing
+            tls : False to connect without encryption (e.g. to a local test server, see nicobot.fakexmpp)
         """
 
         ClientXMPP.__init__(self, jid, password)
 
         self.add_event_handler("session_start", self.session_start)
         self.add_event_handler("message", self.message)
+        self.add_event_handler("receipt_received", self.receipt_received)
+        self.add_event_handler("session_resumed", self.session_resumed)
+        self.add_event_handler("disconnected", self.on_disconnected)
+        self.add_event_handler("connection_failed", self.on_connection_failed)
 
         self.register_plugin('xep_0030') # Service Discovery
         self.register_plugin('xep_0199') # XMPP Ping
         self.register_plugin('xep_0380') # Explicit Message Encryption
+        self.register_plugin('xep_0184') # Message Delivery Receipts
+        self.register_plugin('xep_0198') # Stream Management (resumes the session after a disconnection)
+        if rooms:
+            self.register_plugin('xep_0045') # Multi-User Chat
 
         if not os.path.exists(data_dir):
             os.makedirs(data_dir)
+        self.omemo_storage = storage( omemo_storage, data_dir )
         try:
             self.register_plugin(
                 'xep_0384',
                 {
                     'data_dir': data_dir,
+                    'storage_backend': self.omemo_storage,
                 },
                 module=slixmpp_omemo,
             ) # OMEMO
@@ -62,12 +339,61 @@ class SliXmppClient(ClientXMPP):
             log.exception('And error occured when loading the omemo plugin.')
             sys.exit(1)
 
+        self.server_address = server
+        self.tls = tls
+        if not tls:
+            # Passwords are sent in clear text then
+            self['feature_mechanisms'].unencrypted_plain = True
+
         self.message_handler = message_handler
+        self.prewarm = prewarm
+        self.rooms = rooms
+        self.nick = nick if nick else JID(jid).user
+        self.senders = senders
+        self.omemo_cache = OmemoCache(self['xep_0384'])
+        # Time each message waiting for a delivery receipt was sent, by id (oldest first)
+        self.receipts = collections.OrderedDict()
+        self.delivery = {
+            'requested': 0,
+            'delivered': 0,
+            'unacknowledged': 0,
+            # Seconds between sending messages and receiving their receipts
+            'total_delivery_time': 0,
+            'max_delivery_time': 0,
+            }
+        # Set while the session is established : messages are only sent then
+        self.online = asyncio.Event()
+        # Set when disconnecting on purpose
+        self.stopping = False
+        # Reconnection attempts since the last established session
+        self.attempts = 0
+        self.disconnected_at = None
+        self.connection = {
+            'disconnections': 0,
+            'reconnects': 0,
+            'resumed': 0,
+            'failed_attempts': 0,
+            # Seconds without a session
+            'total_downtime': 0,
+            'max_downtime': 0,
+            }
+        self.decryption = {
+            'messages': 0,
+            # Seconds spent decrypting messages (on the event loop)
+            'total_time': 0,
+            'max_time': 0,
+            }
 
 
     def session_start(self, event):
+        self.online_again()
         self.send_presence()
         self.get_roster()
+        # So the first reply doesn't wait for the recipients' keys
+        if self.prewarm:
+            asyncio.ensure_future( self.omemo_cache.prewarm(self.prewarm) )
+        for room in self.rooms:
+            asyncio.ensure_future( self.join(room) )
 
         # Most get_*/set_* methods from plugins use Iq stanzas, which
         # can generate IqError and IqTimeout exceptions
@@ -83,6 +409,105 @@ class SliXmppClient(ClientXMPP):
         #     self.disconnect()
 
 
+    def session_resumed(self, event):
+        """
+            The previous session was resumed (XEP-0198) : the roster, presence, rooms and unacknowledged messages were kept
+        """
+        self.connection['resumed'] += 1
+        log.info("Session resumed")
+        self.online_again()
+
+
+    def online_again(self):
+
+        if self.disconnected_at is not None:
+            downtime = time.monotonic() - self.disconnected_at
+            self.connection['total_downtime'] += downtime
+            self.connection['max_downtime'] = max( self.connection['max_downtime'], downtime )
+            log.info("Connected again after %.1fs",downtime)
+            self.disconnected_at = None
+        self.attempts = 0
+        self.online.set()
+
+
+    def on_disconnected(self, reason):
+        """
+            Reconnects after a delay that grows with the number of failed attempts, with some randomness
+            so many clients don't reconnect to the server all at the same time
+        """
+
+        self.online.clear()
+        if self.stopping:
+            return
+        self.connection['disconnections'] += 1
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+        delay = min( RECONNECT_DELAY * 2 ** self.attempts, RECONNECT_DELAY_MAX )
+        delay = random.uniform( delay / 2, delay )
+        self.attempts += 1
+        log.warning("Disconnected (%s) : reconnecting in %.1fs",reason,delay)
+        self.loop.call_later( delay, self.reconnect_now )
+
+
+    def connect(self, address=None, **kwargs):
+        """
+            Connects to the given address, or the server given when created (also when reconnecting)
+        """
+        if not self.tls:
+            kwargs.update( force_starttls=False, disable_starttls=True )
+        return ClientXMPP.connect( self, address if address else self.server_address, **kwargs )
+
+
+    def reconnect_now(self):
+
+        if not self.stopping:
+            self.connection['reconnects'] += 1
+            self.connect()
+
+
+    def on_connection_failed(self, error):
+        # slixmpp tries again by itself
+        self.connection['failed_attempts'] += 1
+        log.warning("Connection failed : %s",error)
+
+
+    async def close(self):
+        """
+            Disconnects without reconnecting
+        """
+        self.stopping = True
+        await self.disconnect()
+        if self.omemo_storage:
+            self.omemo_storage.close()
+
+
+    async def join(self, room):
+        """
+            Joins a room (without its history) and fetches the OMEMO keys of its members
+        """
+        try:
+            await self['xep_0045'].join_muc_wait( JID(room), self.nick, maxstanzas=0 )
+            log.debug("Joined %s as %s",room,self.nick)
+        except Exception:
+            log.exception("Could not join room %s",room)
+            return
+        await self.omemo_cache.prewarm( self.members(room) )
+
+
+    def members(self, room):
+        """
+            Returns the bare JIDs of the other occupants of a room, when the room discloses them
+        """
+        muc = self['xep_0045']
+        jids = set()
+        if room in muc.rooms:
+            for nick in muc.get_roster(room):
+                jid = muc.get_jid_property(room, nick, 'jid')
+                if jid and JID(jid).bare != self.boundjid.bare:
+                    jids.add(JID(jid).bare)
+        return list(jids)
+
+
     async def message(self, msg: Message, allow_untrusted: bool = False) -> None:
         """
         Process incoming message stanzas. Be aware that this also
@@ -117,8 +542,21 @@ class SliXmppClient(ClientXMPP):
 
         log.debug("XMPP message received : %r",msg)
 
+        # Sorts messages out before any cryptographic work (it was already done when retrying an untrusted message)
+        if self.senders and not allow_untrusted and not self.senders.accept(msg):
+            return None
+
         # TODO ? with xmppy I used to allow the following types : ["message","chat","normal",None]
-        if msg['type'] not in ('chat', 'normal'):
+        mfrom = msg['from']
+        if msg['type'] == 'groupchat' and self.rooms:
+            room = mfrom.bare
+            if msg['mucnick'] == self['xep_0045'].our_nicks.get(room):
+                log.log(TRACE,"Discarding my own message in %s",room)
+                return None
+            # Messages are encrypted by the real JID of the member
+            mfrom = self['xep_0045'].get_jid_property(room, msg['mucnick'], 'jid')
+            mfrom = JID(mfrom) if mfrom else None
+        elif msg['type'] not in ('chat', 'normal'):
             log.debug("Discarding message of type %r",msg['type'])
             return None
 
@@ -127,10 +565,22 @@ class SliXmppClient(ClientXMPP):
             self.message_handler(msg,msg['body'])
             return None
 
+        if mfrom is None:
+            log.warning("Discarding encrypted message from a member of %s whose JID is not disclosed",msg['from'].bare)
+            return None
+
         try:
-            mfrom = msg['from']
             encrypted = msg['omemo_encrypted']
-            body = self['xep_0384'].decrypt_message(encrypted, mfrom, allow_untrusted)
+            # This stays on the event loop : the OMEMO sessions are also used there to encrypt messages,
+            # and the plugin schedules the publication of a new bundle on the loop
+            start = time.perf_counter()
+            try:
+                body = self['xep_0384'].decrypt_message(encrypted, mfrom, allow_untrusted)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.decryption['messages'] += 1
+                self.decryption['total_time'] += elapsed
+                self.decryption['max_time'] = max( self.decryption['max_time'], elapsed )
             # TODO Is it always UTF-8-encoded ?
             self.message_handler(msg,body.decode("utf8"))
             return None
@@ -195,11 +645,87 @@ class SliXmppClient(ClientXMPP):
     async def encrypted_send(self, body, recipient, type='chat'):
         """Helper to send encrypted messages"""
 
-        msg = self.make_message(mto=recipient, mtype=type)
-        msg['eme']['namespace'] = self.eme_ns
-        msg['eme']['name'] = self['xep_0380'].mechanisms[self.eme_ns]
+        return await self.encrypted_send_many( body, [ (recipient,type) ] )
 
-        expect_problems = {}  # type: Optional[Dict[JID, List[int]]]
+
+    async def encrypted_send_many(self, body, targets):
+        """
+            Sends the same encrypted message to several persons and rooms : it is encrypted only once,
+            for all the devices of all of them, then sent in one stanza per person or room.
+
+            targets : a list of ( JID, message type ) ; the type is 'groupchat' for rooms
+        """
+
+        recipients = set()
+        for jid, type in list(targets):
+            if type == 'groupchat':
+                members = self.members(jid)
+                if not members:
+                    log.warning("Not sending to %s : no member to encrypt for",jid)
+                    targets = [ t for t in targets if t[0] != jid ]
+                recipients.update(members)
+            else:
+                recipients.add(JID(jid).bare)
+        if not recipients:
+            return None
+
+        encrypted = await self.encrypt( body, [ JID(r) for r in sorted(recipients) ] )
+        if encrypted is None:
+            return None
+        for jid, type in targets:
+            msg = self.make_message(mto=jid, mtype=type)
+            msg['eme']['namespace'] = self.eme_ns
+            msg['eme']['name'] = self['xep_0380'].mechanisms[self.eme_ns]
+            msg.append(copy.copy(encrypted))
+            if type != 'groupchat':
+                self.requestReceipt(msg)
+            msg.send()
+        return None
+
+
+    def requestReceipt(self, msg):
+        """
+            Asks the recipient's client to acknowledge the delivery of this message (XEP-0184)
+        """
+
+        now = time.monotonic()
+        # Forgets the messages that will never be acknowledged (e.g. the recipient's client doesn't support receipts)
+        while self.receipts:
+            id, sent = next(iter(self.receipts.items()))
+            if now - sent < RECEIPT_TIMEOUT:
+                break
+            del self.receipts[id]
+            self.delivery['unacknowledged'] += 1
+        msg['id'] = self.new_id()
+        msg['request_receipt'] = True
+        self.receipts[msg['id']] = now
+        self.delivery['requested'] += 1
+
+
+    def receipt_received(self, msg):
+
+        sent = self.receipts.pop( msg['receipt'], None )
+        if sent is None:
+            log.log(TRACE,"Receipt for an unknown message : %r",msg)
+            return
+        elapsed = time.monotonic() - sent
+        self.delivery['delivered'] += 1
+        self.delivery['total_delivery_time'] += elapsed
+        self.delivery['max_delivery_time'] = max( self.delivery['max_delivery_time'], elapsed )
+        log.log(TRACE,"Message %s delivered in %.3fs",msg['receipt'],elapsed)
+
+
+    async def encrypt(self, body, recipients):
+        """
+            Returns the `<encrypted/>` element of the given text for all the devices of the given JIDs,
+            or None if some information about them could not be fetched
+        """
+
+        cache = self.omemo_cache
+        await cache.refresh(recipients)
+        # Devices known to have no usable bundle are not tried again
+        expect_problems = cache.problems(recipients)  # type: Optional[Dict[JID, List[int]]]
+        iq = cache.stats['iq']
 
         while True:
             try:
@@ -213,10 +739,10 @@ class SliXmppClient(ClientXMPP):
                 # allows you to encrypt for 1:1 as well as groupchats (MUC).
                 #
                 # `expect_problems`: See EncryptionPrepareException handling.
-                recipients = [JID(recipient)]
                 encrypt = await self['xep_0384'].encrypt_message(body, recipients, expect_problems)
-                msg.append(encrypt)
-                return msg.send()
+                # Approximate if other messages are being encrypted at the same time
+                cache.stats[ 'hits' if cache.stats['iq'] == iq else 'misses' ] += 1
+                return encrypt
             except UndecidedException as exn:
                 # The library prevents us from sending a message to an
                 # untrusted/undecided barejid, so we need to make a decision here.
@@ -240,14 +766,13 @@ class SliXmppClient(ClientXMPP):
                         # generic message. The receiving end-user at this
                         # point can bring up the issue if it happens.
                         log.warning('Could not find keys for device "%d" of recipient "%s". Skipping.', error.device, error.bare_jid)
-                        jid = JID(error.bare_jid)
-                        device_list = expect_problems.setdefault(jid, [])
-                        device_list.append(error.device)
+                        cache.markBad(error.bare_jid, error.device)
+                expect_problems = cache.problems(recipients)
             except (IqError, IqTimeout) as exn:
-                log.exception('An error occured while fetching information on %r', recipient)
+                log.exception('An error occured while fetching information on %r', recipients)
                 return None
             except Exception as exn:
-                log.exception('An error occured while attempting to encrypt to %r', recipient)
+                log.exception('An error occured while attempting to encrypt to %r', recipients)
                 raise
 
         return None
@@ -269,10 +794,54 @@ class JabberChatter(Chatter):
         It implements nicobot.Chatter by wrapping an internal slixmpp.ClientXMPP instance.
     """
 
-    def __init__( self, jid, password, recipient, data_dir ):
+    def __init__( self, jid, password, recipient=None, data_dir=None, recipients=[], rooms=[], nick=None,
+        send_queue_size=SEND_QUEUE_SIZE, send_overflow=OVERFLOW_BLOCK, send_workers=SEND_WORKERS, drain_timeout=DRAIN_TIMEOUT,
+        handler_workers=HANDLER_WORKERS, unknown_senders=UNKNOWN_DROP, sender_rate=SENDER_RATE, sender_burst=SENDER_BURST,
+        omemo_storage=STORAGE_JSON, server=None, tls=True ):
+        """
+            recipient, recipients: JIDs of the persons to chat with
+            rooms: JIDs of the group chats (MUC) to chat in ; their members' JIDs must be visible to encrypt messages for them
+            nick: the bot's nickname in the rooms
+            send_queue_size: maximum number of messages waiting to be sent ; 0 sends each one at once without limit
+            send_overflow: what to do with a new message when the send queue is full (see nicobot.sendqueue)
+            send_workers: number of messages encrypted and sent at the same time
+            drain_timeout: seconds to wait for the queued messages to be sent when stopping
+            handler_workers: number of threads running the bot's handlers, so they don't block the event loop
+                (0 runs them on the event loop) ; messages from the same sender are still handled one after the other
+            unknown_senders: what to do with messages from other senders than the recipients and rooms (see SenderFilter)
+            sender_rate, sender_burst: how many messages per minute (and in a row) each unknown sender may send with UNKNOWN_LIMIT
+            omemo_storage: 'json' to store OMEMO data in many small files in data_dir, 'sqlite' in a single database there
+                (the files are migrated to it the first time)
+            server: 'host[:port]' of the XMPP server ; found from the JID's domain if missing
+            tls: False to connect without encryption (only for local tests)
+        """
 
-        self.recipient = recipient
-        self.xmpp = SliXmppClient( jid, password, message_handler=self.on_xmpp_message, data_dir=data_dir )
+        recipients = list(dict.fromkeys( [ JID(r).bare for r in ([recipient] if recipient else []) + recipients ] ))
+        rooms = list(dict.fromkeys( JID(r).bare for r in rooms ))
+        if not recipients and not rooms:
+            raise ValueError("At least a recipient or a room must be given")
+        # Indexes conversations by the bare JID messages come from
+        self.recipients = { r: Conversation(r,'chat') for r in recipients }
+        self.rooms = { r: Conversation(r,'groupchat') for r in rooms }
+        self.conversations = list(self.recipients.values()) + list(self.rooms.values())
+        senders = SenderFilter( recipients, rooms, unknown=unknown_senders, rate=sender_rate, burst=sender_burst )
+        self.xmpp = SliXmppClient( jid, password, message_handler=self.on_xmpp_message, data_dir=data_dir, prewarm=recipients, rooms=rooms, nick=nick, senders=senders, omemo_storage=omemo_storage,
+            server=self.parseServer(server) if server else None, tls=tls )
+        self.outbox = None
+        if send_queue_size > 0:
+            self.outbox = AsyncSendQueue( self.sendNow, size=send_queue_size, overflow=send_overflow, workers=send_workers )
+        self.drain_timeout = drain_timeout
+        self.executor = None
+        if handler_workers > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor( max_workers=handler_workers, thread_name_prefix='jabber-handler' )
+        # The last task handling a message from each sender
+        self.handling = {}
+        self.lag = LagMonitor()
+
+    def parseServer( self, server ):
+
+        host, _, port = server.rpartition(':') if ':' in server else (server,None,None)
+        return ( host, int(port) if port else XMPP_PORT )
 
     def on_xmpp_message( self, original_message, decrypted_body ):
         """
@@ -284,7 +853,42 @@ class JabberChatter(Chatter):
 
         log.log(TRACE,"<<< %r",original_message)
         log.debug("<<< %r",decrypted_body)
-        self.bot.onMessage(decrypted_body)
+        jid = original_message['from'].bare
+        if original_message['type'] == 'groupchat':
+            found = self.rooms.get(jid)
+            if found is None:
+                # Answers would go to all conversations
+                log.warning("Dropping message from unknown room %s",jid)
+                return
+        else:
+            # Unknown senders (when allowed) get their answers too
+            found = self.recipients.get( jid, Conversation(jid,'chat') )
+        # Answers will go back to this conversation
+        token = conversation.set(found)
+        try:
+            if not self.executor:
+                self.bot.onMessage(decrypted_body)
+                return
+            context = contextvars.copy_context()
+        finally:
+            conversation.reset(token)
+        # In a room, the sender is the occupant
+        sender = str(original_message['from']) if original_message['type'] == 'groupchat' else jid
+        previous = self.handling.get(sender)
+        task = asyncio.ensure_future( self.handle( decrypted_body, context, previous ) )
+        self.handling[sender] = task
+        task.add_done_callback( lambda task: self.handling.pop(sender) if self.handling.get(sender) is task else None )
+
+    async def handle( self, message, context, previous ):
+        """
+            Runs the bot's handler in a thread, after the one of the previous message from the same sender
+        """
+        if previous:
+            await asyncio.wait([previous])
+        try:
+            await asyncio.get_event_loop().run_in_executor( self.executor, context.run, self.bot.onMessage, message )
+        except Exception:
+            log.exception("Error handling message %r",message)
 
     def connect(self):
 
@@ -307,23 +911,74 @@ class JabberChatter(Chatter):
         self.bot = bot
         # do some other stuff before running the event loop, e.g.
         # loop.run_until_complete(httpserver.init())
-        self.xmpp.process(forever=False)
+        self.xmpp.loop.call_soon(self.lag.start)
+        # Returns on each disconnection : the client reconnects by itself unless stopped
+        while not self.xmpp.stopping:
+            self.xmpp.process(forever=False)
         # FIXME Following error when exiting :
         # Task was destroyed but it is pending! task: <Task pending coro=<XMLStream.run_filters() running at /home/./.local/lib/python3.6/site-packages/slixmpp/xmlstream/xmlstream.py:972> wait_for=<Future pending cb=[<TaskWakeupMethWrapper object at 0x7fa91adc0fd8>()]>>
 
     def send( self, message ):
         """
-            Sends the given message using the underlying implemented chat protocol
+            Sends the given message to the conversation of the message being handled,
+            or to all conversations if not handling a message (e.g. a greeting)
         """
         log.debug(">>> %s",message)
-        # TODO use asyncio.make_task() in latest python
-        asyncio.ensure_future( self.xmpp.encrypted_send( body=message, recipient=self.recipient ) )
+        current = conversation.get()
+        targets = [ current ] if isinstance(current,Conversation) else self.conversations
+        if self.outbox:
+            coroutine = self.outbox.put( message, conversations=targets )
+        else:
+            coroutine = self.sendNow( message, targets )
+        if self._inLoop():
+            # Can't wait for a place in the queue here : tasks are started in order, so messages are queued in order
+            # TODO use asyncio.make_task() in latest python
+            asyncio.ensure_future(coroutine)
+        elif self.outbox:
+            # Called from another thread (e.g. a bot handling messages in a pool) : waits if the queue is full
+            asyncio.run_coroutine_threadsafe( coroutine, self.xmpp.loop ).result()
+        else:
+            asyncio.run_coroutine_threadsafe( coroutine, self.xmpp.loop )
+
+    async def sendNow( self, message, conversations ):
+        """
+            Encrypts and sends a message to the given conversations, as soon as connected
+        """
+        await self.xmpp.online.wait()
+        await self.xmpp.encrypted_send_many( body=message, targets=conversations )
 
     def stop( self ):
         """
-            Stops waiting for messages and exits the engine
+            Stops waiting for messages and exits the engine, after sending the queued messages
+        """
+        if self._inLoop():
+            asyncio.ensure_future(self.shutdown())
+        else:
+            asyncio.run_coroutine_threadsafe( self.shutdown(), self.xmpp.loop )
+
+    async def shutdown( self ):
+
+        if self.outbox:
+            await self.outbox.stop( drain=True, timeout=self.drain_timeout )
+        log.debug("OMEMO cache statistics : %r",self.xmpp.omemo_cache.stats)
+        log.debug("Delivery statistics : %r",self.xmpp.delivery)
+        log.debug("Connection statistics : %r",self.xmpp.connection)
+        log.debug("Decryption statistics : %r",self.xmpp.decryption)
+        log.debug("Sender filter statistics : %r",self.xmpp.senders.stats)
+        self.lag.stop()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        await self.xmpp.close()
+
+    def _inLoop( self ):
         """
-        self.xmpp.disconnect()
+            Returns True if called from the thread running the XMPP client's event loop
+        """
+        try:
+            return asyncio.get_event_loop() is self.xmpp.loop
+        except RuntimeError:
+            # No event loop in this thread
+            return False
 
 
 
@@ -336,8 +991,21 @@ def arg_parser():
 
     # Jabber-specific arguments
     parser.add_argument('--jabber-username', '--jabberid', '--jid', dest='jabber_username', help="Username when using the Jabber/XMPP backend (overrides --username)")
-    parser.add_argument('--jabber-recipient', dest='jabber_recipients', action='append', default=[], help="Recipient when using the Jabber/XMPP backend (overrides --recipient)")
+    parser.add_argument('--jabber-recipient', dest='jabber_recipients', action='append', default=[], help="Recipient when using the Jabber/XMPP backend (overrides --recipient) ; may be given several times")
+    parser.add_argument('--jabber-room', dest='jabber_rooms', action='append', default=[], help="Group chat (MUC) to chat in (e.g. 'myroom@conference.myserver.im') ; may be given several times")
+    parser.add_argument('--jabber-nick', dest='jabber_nick', default=None, help="Nickname in group chats (defaults to the local part of the JabberID)")
     parser.add_argument('--jabber-password', dest='jabber_password', help="Senders's password")
+    parser.add_argument('--jabber-server', dest='jabber_server', default=None, help="Server to connect to, as 'host[:port]' (found from the JabberID's domain if not given)")
+    parser.add_argument('--jabber-no-tls', dest='jabber_tls', action='store_false', default=True, help="Connect without encryption : the password is sent in clear text, only use it with a local test server (see nicobot.fakexmpp)")
     parser.add_argument('--jabber-config-dir', dest='jabber_config_dir', default=None, help='Directory where to store OMEMO keys')
+    parser.add_argument('--jabber-omemo-storage', dest='jabber_omemo_storage', choices=STORAGE_BACKENDS, default=STORAGE_JSON, help="Where to store OMEMO keys and sessions : one JSON file each, or a single SQLite database (the JSON files are migrated to it the first time)")
+    parser.add_argument('--jabber-send-queue', dest='jabber_send_queue', type=int, default=SEND_QUEUE_SIZE, help="Maximum number of messages waiting to be sent (0 to send each one at once, without limit)")
+    parser.add_argument('--jabber-send-overflow', dest='jabber_send_overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_BLOCK, help="What to do with a new message when the send queue is full")
+    parser.add_argument('--jabber-send-workers', dest='jabber_send_workers', type=int, default=SEND_WORKERS, help="Number of messages encrypted and sent at the same time")
+    parser.add_argument('--jabber-handler-workers', dest='jabber_handler_workers', type=int, default=HANDLER_WORKERS, help="Number of threads running the bot's handlers (0 runs them on the XMPP event loop)")
+    parser.add_argument('--jabber-unknown-senders', dest='jabber_unknown_senders', choices=UNKNOWN_POLICIES, default=UNKNOWN_DROP, help="What to do with messages from other senders than the recipients and rooms : drop them before decrypting them, or answer them within a budget per sender")
+    parser.add_argument('--jabber-sender-rate', dest='jabber_sender_rate', type=float, default=SENDER_RATE, help="Messages per minute each unknown sender may send with --jabber-unknown-senders=limit")
+    parser.add_argument('--jabber-sender-burst', dest='jabber_sender_burst', type=int, default=SENDER_BURST, help="Messages in a row each unknown sender may send with --jabber-unknown-senders=limit")
+    parser.add_argument('--jabber-drain-timeout', dest='jabber_drain_timeout', type=float, default=DRAIN_TIMEOUT, help="Seconds to wait for the queued messages to be sent when stopping")
 
     return parser
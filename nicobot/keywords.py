@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Multi-pattern keyword matching
+"""
+
+import collections
+import functools
+import logging
+import threading
+import unicodedata
+
+
+log = logging.getLogger(__name__)
+
+
+# Result of KeywordIndex.search()
+# keyword: the original keyword
+# language: the language of the variant that matched (None if unknown)
+# variant: the text that was indexed for this keyword (the keyword itself or one of its translations)
+# start, end: position of the match in the normalized text
+KeywordMatch = collections.namedtuple( 'KeywordMatch', ['keyword','language','variant','start','end'] )
+
+
+# Unicode blocks of scripts that don't separate words with spaces :
+# word boundaries cannot be checked for them
+# See https://unicode.org/reports/tr29/#Word_Boundaries
+UNSPACED_RANGES = [
+    (0x0E00, 0x0EFF),   # Thai, Lao
+    (0x0F00, 0x0FFF),   # Tibetan
+    (0x1000, 0x109F),   # Myanmar
+    (0x1780, 0x17FF),   # Khmer
+    (0x2E80, 0x2FDF),   # CJK radicals
+    (0x3000, 0x30FF),   # CJK symbols, Hiragana, Katakana
+    (0x3100, 0x31FF),   # Bopomofo, Katakana extensions
+    (0x3400, 0x4DBF),   # CJK extension A
+    (0x4E00, 0x9FFF),   # CJK unified ideographs
+    (0xF900, 0xFAFF),   # CJK compatibility ideographs
+    (0xFF66, 0xFF9F),   # Halfwidth Katakana
+    (0x20000, 0x2FA1F), # CJK extensions B to F
+]
+
+
+def normalize( text ):
+    """
+        Returns the form of 'text' used to compare keywords : NFKC-normalized and casefolded
+    """
+    return unicodedata.normalize('NFKC',text).casefold()
+
+
+@functools.lru_cache(maxsize=4096)
+def isWordChar( char ):
+    """
+        Same as the regular expression '\\w' class
+    """
+    return char.isalnum() or char == '_'
+
+
+@functools.lru_cache(maxsize=4096)
+def needsBoundary( char ):
+    """
+        Returns True if 'char' is a word character from a script where words are separated (by spaces, punctuation, ...)
+    """
+    if not isWordChar(char):
+        return False
+    code = ord(char)
+    for low, high in UNSPACED_RANGES:
+        if low <= code <= high:
+            return False
+    return True
+
+
+def _strip( text ):
+    """
+        Removes leading and trailing punctuation and spaces
+        (translations often come with a final '.', '!' or '?' that is not part of the keyword)
+    """
+    start = 0
+    end = len(text)
+    while start < end and unicodedata.category(text[start])[0] in 'PZ':
+        start = start + 1
+    while end > start and unicodedata.category(text[end-1])[0] in 'PZ':
+        end = end - 1
+    return text[start:end]
+
+
+class KeywordIndex:
+    """
+        Finds keywords (and their translations) in a text with an Aho-Corasick automaton.
+
+        Variants are matched on casefolded, NFKC-normalized text.
+        Like '\\b' in a regular expression, they only match on whole words,
+        except for scripts that don't separate words (CJK, Thai, ...).
+
+        Variants must all be added before the first search ; searches can then run in several threads.
+    """
+
+    def __init__( self ):
+
+        # The automaton : each node has a dict of transitions, a failure link and a list of outputs
+        self.goto = [ {} ]
+        self.fail = [ 0 ]
+        # Each output is a tuple (length of the normalized variant,list of KeywordMatch templates)
+        self.output = [ None ]
+        # Link to the next node with an output along the failure chain
+        self.dict_link = [ 0 ]
+        self.built = True
+        self.size = 0
+        # Only one thread builds the automaton
+        self.lock = threading.Lock()
+
+
+    def add( self, variant, keyword=None, language=None ):
+        """
+            Indexes 'variant' so that it will be reported as 'keyword' in 'language'.
+
+            variant: the text to look for
+            keyword: the original keyword this variant stands for ; defaults to 'variant' itself
+            language: language code of the variant if known
+        """
+
+        text = _strip(normalize(variant))
+        if not text:
+            log.debug("Ignoring empty keyword %r",variant)
+            return
+        if keyword is None:
+            keyword = variant
+
+        node = 0
+        for char in text:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][char] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+            node = child
+        if self.output[node] is None:
+            self.output[node] = ( len(text), [] )
+        self.output[node][1].append( KeywordMatch(keyword,language,variant,None,None) )
+        self.size = self.size + 1
+        self.built = False
+
+
+    def build( self ):
+        """
+            Prepares the automaton for searching, once all variants have been added.
+            Called by the first search otherwise.
+        """
+
+        with self.lock:
+            if not self.built:
+                self._build()
+
+
+    def _build( self ):
+        """
+            Computes the failure links (breadth-first)
+        """
+
+        # Searches only read the new links once they are complete
+        fail = list(self.fail)
+        dict_link = [ 0 ] * len(self.goto)
+        queue = collections.deque()
+        for child in self.goto[0].values():
+            fail[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in self.goto[state]:
+                    state = fail[state]
+                link = self.goto[state].get(char,0)
+                fail[child] = link
+                dict_link[child] = link if self.output[link] is not None else dict_link[link]
+        self.fail = fail
+        self.dict_link = dict_link
+        self.built = True
+
+
+    def finditer( self, text ):
+        """
+            Yields a KeywordMatch for each keyword found in 'text' (in the order they end in the text)
+        """
+
+        if not self.built:
+            self.build()
+
+        text = normalize(text)
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        dict_link = self.dict_link
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char,0)
+            match = node if output[node] is not None else dict_link[node]
+            while match:
+                length, templates = output[match]
+                start = i + 1 - length
+                if self._isBounded(text,start,i+1):
+                    for template in templates:
+                        yield template._replace(start=start,end=i+1)
+                match = dict_link[match]
+
+
+    def _isBounded( self, text, start, end ):
+        """
+            Checks that text[start:end] is a whole word, where it makes sense
+        """
+        if start > 0 and needsBoundary(text[start]) and isWordChar(text[start-1]):
+            return False
+        if end < len(text) and needsBoundary(text[end-1]) and isWordChar(text[end]):
+            return False
+        return True
+
+
+    def search( self, text ):
+        """
+            Returns the first KeywordMatch found in 'text' or None
+        """
+        return next( self.finditer(text), None )
+
+
+    def __len__( self ):
+        return self.size
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Languages lookup
+"""
+
+import bisect
+import difflib
+import json
+import logging
+import re
+import unicodedata
+
+# Provides an easy way to get the unicode sequence for country flags
+import flag
+
+from .helpers import *
+
+
+log = logging.getLogger(__name__)
+
+
+# Common alternative names of languages (keys are in folded form, see fold())
+ALIASES = {
+    'farsi': 'fa',
+    'mandarin': 'zh',
+    'castilian': 'es',
+    'castellano': 'es',
+    'flemish': 'nl',
+    'brazilian': 'pt',
+    'deutsch': 'de',
+    'english': 'en',
+    'espanol': 'es',
+    'francais': 'fr',
+    'italiano': 'it',
+    'nederlands': 'nl',
+    'portugues': 'pt',
+    'russkiy': 'ru',
+    'nihongo': 'ja',
+    'hangul': 'ko',
+}
+
+# Flag of languages with no known country
+DEFAULT_FLAG = "🏳️‍🌈"
+
+# Prefixes shorter than this are not looked up (too many candidates)
+MIN_PREFIX_LENGTH = 3
+# Similarity ratio (0 to 1) above which a name is considered a typo of a known one
+FUZZY_CUTOFF = 0.8
+
+
+def fold( text ):
+    """
+        Returns the form of a language name used for lookups : casefolded, without accents nor surrounding spaces
+    """
+    decomposed = unicodedata.normalize( 'NFKD', text.strip().casefold() )
+    return ''.join( c for c in decomposed if not unicodedata.combining(c) )
+
+
+class LanguageIndex:
+    """
+        Finds a language code from a code, a name (in any of the indexed locales) or an alias.
+
+        Exact lookups are O(1) ; prefix lookups are O(log n) ; fuzzy lookups (for typos) are only tried last.
+    """
+
+    def __init__( self, languages=[], aliases=ALIASES ):
+        """
+            languages: list of known languages, like [ {'language':'fr', 'name':'French'}, ... ]
+            aliases: dict of { alternative name : language code } ; aliases of unknown languages are ignored
+        """
+
+        # Maps each folded code, name or alias to its language code
+        self.keys = {}
+        self.codes = set()
+        for language in languages:
+            code = language['language']
+            self.codes.add(code)
+            self._add( code, code )
+        self.addNames(languages)
+        for alias, code in aliases.items():
+            if code in self.codes:
+                self._add( alias, code, replace=False )
+        self._sort()
+
+
+    def _add( self, key, code, replace=True ):
+        key = fold(key)
+        if key and ( replace or key not in self.keys ):
+            self.keys[key] = code
+
+
+    def _sort( self ):
+        self.sorted_keys = sorted(self.keys)
+
+
+    def addNames( self, languages ):
+        """
+            Indexes the names of the given languages (e.g. the same list of languages in another locale)
+
+            Names of languages not in this index are ignored.
+        """
+        for language in languages:
+            code = language['language']
+            if code in self.codes and language.get('name'):
+                # A name must not override a code (e.g. some language named 'En' would hide english)
+                self._add( language['name'], code, replace=False )
+        self._sort()
+
+
+    def resolve( self, name ):
+        """
+            Returns the language code matching 'name' or None :
+
+            1. if it's a code, a full name or an alias
+            2. else if it's the beginning of a single name (or else of the shortest one)
+            3. else if it's close to a name (typo)
+        """
+
+        key = fold(name)
+        if not key:
+            return None
+
+        code = self.keys.get(key)
+        if code:
+            return code
+
+        if len(key) >= MIN_PREFIX_LENGTH:
+            start = bisect.bisect_left( self.sorted_keys, key )
+            end = bisect.bisect_left( self.sorted_keys, key + '￿', lo=start )
+            if start < end:
+                candidates = self.sorted_keys[start:end]
+                log.log(TRACE,"Languages starting with %r : %r",key,candidates)
+                return self.keys[ min(candidates,key=len) ]
+
+        close = difflib.get_close_matches( key, self.sorted_keys, n=1, cutoff=FUZZY_CUTOFF )
+        if close:
+            log.debug("Guessed %r for language %r",close[0],name)
+            return self.keys[close[0]]
+
+        return None
+
+
+
+class FlagTable:
+    """
+        Maps language codes to their most likely country code and its flag emoji.
+
+        It is built once from Unicode's likely subtags for the languages the bot can target,
+        then saved as a small JSON file like : { "fr": ["FR","🇫🇷"], "ja": ["JP","🇯🇵"], ... }
+        Unknown languages are resolved once (from their code only) and memoized.
+    """
+
+    def __init__( self, table={} ):
+        """
+            table: dict of { language code : [ country code, flag ] }
+        """
+        self.table = dict(table)
+        # Resolved unknown languages ; not saved
+        self.fallbacks = {}
+
+
+    def covers( self, languages ):
+        """
+            Returns True if all the given language codes are in the table
+        """
+        return all( l in self.table for l in languages )
+
+
+    def update( self, languages, likelySubtags ):
+        """
+            Adds the given language codes to the table, using a Likely Subtags JSON structure
+            (see https://unicode.org/reports/tr35/#Likely_Subtags)
+        """
+        subtags = likelySubtags.get('supplemental',{}).get('likelySubtags',{}) if likelySubtags else {}
+        for lang in languages:
+            aa_Bbbb_CC = subtags.get(lang)
+            if aa_Bbbb_CC:
+                # The last part is the ISO 3361 country code
+                country = re.split( r'[_-]', aa_Bbbb_CC )[-1]
+                self.table[lang] = [ country, _flag(country) ]
+            else:
+                log.debug("No likely subtags for language %s",lang)
+                self.table[lang] = list(self._fallback(lang))
+
+
+    def _fallback( self, lang ):
+        # A region in the code (e.g. 'zh-TW') is the best guess ; else keeps the code itself
+        parts = re.split( r'[_-]', lang )
+        country = parts[-1].upper() if len(parts) > 1 else lang
+        return ( country, _flag(country) )
+
+
+    def lookup( self, lang ):
+        """
+            Returns a tuple ( country code, flag ) for the given language code
+        """
+        found = self.table.get(lang)
+        if found:
+            return found
+        found = self.fallbacks.get(lang)
+        if found is None:
+            log.debug("Language %s is not in the flags table",lang)
+            found = self.fallbacks[lang] = self._fallback(lang)
+        return found
+
+
+    def country( self, lang ):
+        return self.lookup(lang)[0]
+
+
+    def flag( self, lang ):
+        return self.lookup(lang)[1]
+
+
+    def load( self, file ):
+        """
+            Reads the table from a JSON file ; returns False if it could not be read
+        """
+        try:
+            with open(file,'r') as f:
+                self.table = json.load(f)
+            log.debug("Loaded %d flags from %s",len(self.table),file)
+            return True
+        except Exception:
+            log.debug("Could not read flags from %s",file,exc_info=True)
+            return False
+
+
+    def save( self, file ):
+        try:
+            log.debug("Saving flags to %s...",file)
+            with open(file,'w') as f:
+                json.dump(self.table,f,ensure_ascii=False)
+        except Exception:
+            log.exception("Could not save the flags table to %s",file)
+
+
+
+def _flag( country ):
+    try:
+        return flag.flag(country)
+    except ValueError:
+        log.debug("No flag for %s",country,exc_info=True)
+        return DEFAULT_FLAG
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Monitoring of an asyncio event loop
+"""
+
+import asyncio
+import logging
+
+from .helpers import *
+
+
+# Seconds between two measures of the event loop's lag
+LAG_INTERVAL = 1
+# Lag in seconds above which a warning is logged
+LAG_WARNING = 0.5
+
+
+log = logging.getLogger(__name__)
+
+
+class LagMonitor:
+    """
+        Measures how late the event loop runs a task that sleeps at regular intervals :
+        while some code blocks the loop, nothing else runs on it (e.g. keepalives, incoming stanzas).
+    """
+
+    def __init__( self, interval=LAG_INTERVAL, warning=LAG_WARNING ):
+        """
+            interval: seconds between two measures
+            warning: lag in seconds above which a warning is logged
+        """
+
+        self.interval = interval
+        self.warning = warning
+        self.task = None
+        self.stats = {
+            'samples': 0,
+            'total_lag': 0,
+            'max_lag': 0,
+            # Number of times the lag was above 'warning'
+            'stalls': 0,
+            }
+
+
+    def start( self ):
+        """
+            Starts measuring ; must be called from the event loop (does nothing if already started)
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._measure())
+
+
+    async def _measure( self ):
+
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max( 0, loop.time() - start - self.interval )
+            self.stats['samples'] += 1
+            self.stats['total_lag'] += lag
+            self.stats['max_lag'] = max( self.stats['max_lag'], lag )
+            if lag > self.warning:
+                self.stats['stalls'] += 1
+                log.warning("The event loop was blocked for %.3fs",lag)
+            else:
+                log.log(TRACE,"Event loop lag : %.3fs",lag)
+
+
+    def averageLag( self ):
+        return self.stats['total_lag'] / self.stats['samples'] if self.stats['samples'] else 0
+
+
+    def stop( self ):
+
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        log.debug("Event loop lag statistics : %r (average : %.3fs)",self.stats,self.averageLag())
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+    OMEMO storage backends
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from omemo.storage import Storage
+from omemo.implementations import JSONFileStorage
+
+
+# Name of the SQLite database in the OMEMO data directory
+SQLITE_FILE = 'omemo.sqlite'
+# Supported storage backends
+STORAGE_JSON = 'json'
+STORAGE_SQLITE = 'sqlite'
+STORAGE_BACKENDS = [ STORAGE_JSON, STORAGE_SQLITE ]
+
+
+log = logging.getLogger(__name__)
+
+
+class SQLiteStorage(Storage):
+    """
+        Stores the OMEMO state, sessions, device lists and trust in a single SQLite database,
+        instead of one JSON file for each of them (see omemo.implementations.JSONFileStorage).
+
+        Each write is a transaction ; sessions and trusts of several devices are loaded with a single indexed query.
+        Contacts are identified by the same hash of their bare JID as JSONFileStorage, so it can be migrated as is.
+    """
+
+    SCHEMA = [
+        # own_data, state
+        "CREATE TABLE IF NOT EXISTS data ( name TEXT PRIMARY KEY, value TEXT NOT NULL ) WITHOUT ROWID",
+        # 'kind' is either 'active' or 'inactive'
+        "CREATE TABLE IF NOT EXISTS devices ( jid TEXT NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (jid,kind) ) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS sessions ( jid TEXT NOT NULL, device INTEGER NOT NULL, value TEXT NOT NULL, PRIMARY KEY (jid,device) ) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS trust ( jid TEXT NOT NULL, device INTEGER NOT NULL, value TEXT NOT NULL, PRIMARY KEY (jid,device) ) WITHOUT ROWID",
+        ]
+
+    # Files written by JSONFileStorage in a contact's directory
+    SESSION_FILE = re.compile( r'^session_(\d+)\.json$' )
+    TRUST_FILE = re.compile( r'^trust_(\d+)\.json$' )
+
+    def __init__( self, file ):
+        """
+            file: path to the database ; it is created if missing
+        """
+
+        self.file = file
+        self.db = sqlite3.connect(file)
+        # The write-ahead log makes each transaction a single append instead of rewriting pages in place
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+
+    def close( self ):
+        self.db.close()
+
+
+    def migrate( self, directory ):
+        """
+            Imports the files of a JSONFileStorage from the given directory, in a single transaction.
+            Does nothing if this database already holds data, so it can be called on each start.
+            The files are left as they are.
+
+            Returns the number of imported files
+        """
+
+        if self._loadValue("SELECT value FROM data WHERE name='own_data'") is not None:
+            return 0
+        if not os.path.isdir(directory):
+            return 0
+        count = 0
+        with self.db:
+            for name in ('own_data','state'):
+                value = self._readFile( os.path.join(directory,name+".json") )
+                if value is not None:
+                    self.db.execute( "INSERT OR REPLACE INTO data VALUES (?,?)", (name,value) )
+                    count += 1
+            for jid in os.listdir(directory):
+                path = os.path.join(directory,jid)
+                if not os.path.isdir(path):
+                    continue
+                for file in os.listdir(path):
+                    value = self._readFile( os.path.join(path,file) )
+                    if value is None:
+                        continue
+                    session = self.SESSION_FILE.match(file)
+                    trust = self.TRUST_FILE.match(file)
+                    if session:
+                        self.db.execute( "INSERT OR REPLACE INTO sessions VALUES (?,?,?)", (jid,int(session.group(1)),value) )
+                    elif trust:
+                        self.db.execute( "INSERT OR REPLACE INTO trust VALUES (?,?,?)", (jid,int(trust.group(1)),value) )
+                    elif file in ('active_devices.json','inactive_devices.json'):
+                        self.db.execute( "INSERT OR REPLACE INTO devices VALUES (?,?,?)", (jid,file.split('_')[0],value) )
+                    else:
+                        log.warning("Not migrating unknown OMEMO file %s",os.path.join(path,file))
+                        continue
+                    count += 1
+        log.info("Migrated %d OMEMO files from %s to %s",count,directory,self.file)
+        return count
+
+
+    def _readFile( self, path ):
+        """
+            Returns the JSON content of the given file (checked but not parsed), or None if it can't be read
+        """
+        try:
+            with open(path,'rt') as f:
+                text = f.read()
+        except OSError:
+            return None
+        try:
+            json.loads(text)
+        except ValueError:
+            log.warning("Not migrating invalid OMEMO file %s",path)
+            return None
+        return text
+
+
+    def _loadValue( self, query, parameters=(), default=None ):
+
+        row = self.db.execute(query,parameters).fetchone()
+        return json.loads(row[0]) if row else default
+
+
+    def _loadValues( self, table, bare_jid, device_ids ):
+
+        device_ids = list(device_ids)
+        values = dict.fromkeys(device_ids)
+        jid = JSONFileStorage.getHashForBareJID(bare_jid)
+        # Stays below SQLite's limit of parameters in a query
+        for start in range(0,len(device_ids),500):
+            chunk = device_ids[start:start+500]
+            query = "SELECT device, value FROM %s WHERE jid=? AND device IN (%s)" % ( table, ','.join('?'*len(chunk)) )
+            for device, value in self.db.execute( query, [jid] + chunk ):
+                values[device] = json.loads(value)
+        return values
+
+
+    def _store( self, query, parameters ):
+
+        with self.db:
+            self.db.execute(query,parameters)
+
+
+    def _dumps( self, value ):
+        return json.dumps( value, allow_nan=False )
+
+
+    async def loadOwnData(self):
+        return self._loadValue( "SELECT value FROM data WHERE name='own_data'" )
+
+    async def storeOwnData(self, own_bare_jid, own_device_id):
+        self._store( "INSERT OR REPLACE INTO data VALUES ('own_data',?)", (self._dumps({ "own_bare_jid":own_bare_jid, "own_device_id":own_device_id }),) )
+
+    async def loadState(self):
+        return self._loadValue( "SELECT value FROM data WHERE name='state'" )
+
+    async def storeState(self, state):
+        self._store( "INSERT OR REPLACE INTO data VALUES ('state',?)", (self._dumps(state),) )
+
+    async def loadSession(self, bare_jid, device_id):
+        return self._loadValue( "SELECT value FROM sessions WHERE jid=? AND device=?", (JSONFileStorage.getHashForBareJID(bare_jid),device_id) )
+
+    async def loadSessions(self, bare_jid, device_ids):
+        return self._loadValues( 'sessions', bare_jid, device_ids )
+
+    async def storeSession(self, bare_jid, device_id, session):
+        self._store( "INSERT OR REPLACE INTO sessions VALUES (?,?,?)", (JSONFileStorage.getHashForBareJID(bare_jid),device_id,self._dumps(session)) )
+
+    async def deleteSession(self, bare_jid, device_id):
+        self._store( "DELETE FROM sessions WHERE jid=? AND device=?", (JSONFileStorage.getHashForBareJID(bare_jid),device_id) )
+
+    async def loadActiveDevices(self, bare_jid):
+        return set( self._loadValue( "SELECT value FROM devices WHERE jid=? AND kind='active'", (JSONFileStorage.getHashForBareJID(bare_jid),), [] ) )
+
+    async def loadInactiveDevices(self, bare_jid):
+        devices = self._loadValue( "SELECT value FROM devices WHERE jid=? AND kind='inactive'", (JSONFileStorage.getHashForBareJID(bare_jid),), {} )
+        return { int(device): timestamp for device, timestamp in devices.items() }
+
+    async def storeActiveDevices(self, bare_jid, devices):
+        self._store( "INSERT OR REPLACE INTO devices VALUES (?,'active',?)", (JSONFileStorage.getHashForBareJID(bare_jid),self._dumps(list(devices))) )
+
+    async def storeInactiveDevices(self, bare_jid, devices):
+        self._store( "INSERT OR REPLACE INTO devices VALUES (?,'inactive',?)", (JSONFileStorage.getHashForBareJID(bare_jid),self._dumps(devices)) )
+
+    async def loadTrust(self, bare_jid, device_id):
+        return self._loadValue( "SELECT value FROM trust WHERE jid=? AND device=?", (JSONFileStorage.getHashForBareJID(bare_jid),device_id) )
+
+    async def loadTrusts(self, bare_jid, device_ids):
+        return self._loadValues( 'trust', bare_jid, device_ids )
+
+    async def storeTrust(self, bare_jid, device_id, trust):
+        self._store( "INSERT OR REPLACE INTO trust VALUES (?,?,?)", (JSONFileStorage.getHashForBareJID(bare_jid),device_id,self._dumps(trust)) )
+
+    async def listJIDs(self):
+        # Like JSONFileStorage, returns the hashes of the JIDs
+        return [ jid for jid, in self.db.execute( "SELECT DISTINCT jid FROM devices" ) ]
+
+    async def deleteJID(self, bare_jid):
+        jid = JSONFileStorage.getHashForBareJID(bare_jid)
+        with self.db:
+            for table in ('devices','sessions','trust'):
+                self.db.execute( "DELETE FROM %s WHERE jid=?" % table, (jid,) )
+
+
+def storage( backend, data_dir ):
+    """
+        Returns the OMEMO storage to give to the 'xep_0384' plugin for the given backend (one of STORAGE_BACKENDS),
+        or None for its default one (JSON files in data_dir)
+    """
+
+    if backend == STORAGE_SQLITE:
+        sqlite = SQLiteStorage( os.path.join(data_dir,SQLITE_FILE) )
+        sqlite.migrate(data_dir)
+        return sqlite
+    if backend != STORAGE_JSON:
+        raise ValueError("Unknown OMEMO storage : %r" % backend)
+    return None
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Sending messages in the background
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from .helpers import *
+
+
+# Maximum number of messages waiting to be sent
+SEND_QUEUE_SIZE = 100
+# What to do with a new message when the queue is full
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_POLICIES = ( OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST )
+# Seconds to wait for more messages to the same conversation, to send them at once (0 disables it)
+COALESCE_WINDOW = 0
+# Number of messages an AsyncSendQueue sends at the same time
+SEND_WORKERS = 4
+# Seconds to wait for the queued messages to be sent when stopping
+DRAIN_TIMEOUT = 10
+
+
+log = logging.getLogger(__name__)
+
+
+class SendQueue:
+    """
+        Sends messages one after the other from a dedicated thread, so callers don't wait for them to be sent.
+
+        Messages are sent in the order they were queued (hence in order for each conversation).
+        Messages queued within 'coalesce_window' seconds for the same conversation can be merged into a single one.
+    """
+
+    def __init__( self, send, size=SEND_QUEUE_SIZE, overflow=OVERFLOW_BLOCK, coalesce_window=COALESCE_WINDOW, separator="\n" ):
+        """
+            send: a Callable( message, conversation ) that really sends a message
+            size: maximum number of messages waiting to be sent (0 for no limit)
+            overflow: what to do with a new message when the queue is full : one of OVERFLOW_POLICIES
+            coalesce_window: seconds to wait for more messages to the same conversation after the first one (0 to send each message alone)
+            separator: text between coalesced messages
+        """
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r : must be one of %r" % (overflow,OVERFLOW_POLICIES))
+
+        self.send = send
+        self.size = size
+        self.overflow = overflow
+        self.coalesce_window = coalesce_window
+        self.separator = separator
+
+        # Entries are ( conversation, message )
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.sending = False
+        self.stopping = False
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'errors': 0,
+            }
+        self.thread = threading.Thread( target=self._work, name="send-queue", daemon=True )
+        self.thread.start()
+
+
+    def put( self, message, conversation=None ):
+        """
+            Queues a message ; returns False if it was dropped
+        """
+
+        with self.condition:
+            if self.stopping:
+                raise ValueError("The send queue is stopped")
+            if self.size and len(self.queue) >= self.size:
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    log.warning("Send queue is full : dropping message %r",message)
+                    self.stats['dropped'] += 1
+                    return False
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    dropped = self.queue.popleft()
+                    log.warning("Send queue is full : dropping message %r",dropped[1])
+                    self.stats['dropped'] += 1
+                else:
+                    self.condition.wait_for( lambda: len(self.queue) < self.size or self.stopping )
+                    if self.stopping:
+                        raise ValueError("The send queue is stopped")
+            self.queue.append( (conversation,message) )
+            self.stats['queued'] += 1
+            self.condition.notify_all()
+            return True
+
+
+    def _take( self ):
+        """
+            Waits for the next message(s) to send and returns them as ( conversation, [messages] ) or None when stopped
+        """
+
+        with self.condition:
+            self.condition.wait_for( lambda: self.queue or self.stopping )
+            if not self.queue:
+                return None
+            conversation, message = self.queue.popleft()
+            messages = [ message ]
+            self.sending = True
+            # Only merges the messages that immediately follow, so the order is kept
+            deadline = time.monotonic() + self.coalesce_window
+            while self.coalesce_window > 0:
+                while self.queue and self.queue[0][0] == conversation:
+                    messages.append( self.queue.popleft()[1] )
+                # Another conversation is waiting, or we're asked to stop : don't delay it
+                remaining = deadline - time.monotonic()
+                if self.queue or self.stopping or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            # Frees places for blocked callers
+            self.condition.notify_all()
+            return conversation, messages
+
+
+    def _work( self ):
+
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            conversation, messages = taken
+            try:
+                if len(messages) > 1:
+                    log.debug("Coalescing %d messages to %r",len(messages),conversation)
+                    self.stats['coalesced'] += len(messages) - 1
+                self.send( self.separator.join(messages), conversation )
+                self.stats['sent'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                log.exception("Could not send %r to %r",messages,conversation)
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+
+    def flush( self, timeout=None ):
+        """
+            Waits until all queued messages have been sent ; returns False on timeout
+        """
+        with self.condition:
+            return self.condition.wait_for( lambda: not self.queue and not self.sending, timeout=timeout )
+
+
+    def stop( self, drain=True, timeout=None ):
+        """
+            Stops the sending thread
+
+            drain: if True, sends the queued messages first (waiting at most 'timeout' seconds) ; else drops them
+        """
+        if drain and not self.flush(timeout):
+            log.warning("Could not send all messages in %ss",timeout)
+        with self.condition:
+            self.stopping = True
+            if self.queue:
+                self.stats['dropped'] += len(self.queue)
+                self.queue.clear()
+            self.condition.notify_all()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        log.debug("Send queue statistics : %r",self.stats)
+
+
+
+class AsyncSendQueue:
+    """
+        Sends messages in the background with coroutines, on an event loop.
+
+        Up to 'workers' messages are being sent at the same time (e.g. encrypted then sent),
+        but a message to a conversation is only sent once the previous ones to this conversation have been.
+        A message can be sent to several conversations at once.
+    """
+
+    def __init__( self, send, size=SEND_QUEUE_SIZE, overflow=OVERFLOW_BLOCK, workers=SEND_WORKERS ):
+        """
+            send: a coroutine function( message, conversations ) that really sends a message
+            size: maximum number of messages waiting to be sent (0 for no limit)
+            overflow: what to do with a new message when the queue is full : one of OVERFLOW_POLICIES
+            workers: number of messages sent at the same time
+        """
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r : must be one of %r" % (overflow,OVERFLOW_POLICIES))
+
+        self.send = send
+        self.size = size
+        self.overflow = overflow
+        self.workers = max(1,workers)
+        # Created in start(), on the event loop
+        self.queue = None
+        self.slots = None
+        self.dispatcher = None
+        # The last task sending to each conversation
+        self.last = {}
+        self.tasks = set()
+        self.stopping = False
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'errors': 0,
+            'max_queued': 0,
+            # Seconds between queuing and sending messages
+            'total_send_time': 0,
+            'max_send_time': 0,
+            }
+
+
+    def start( self ):
+        """
+            Starts sending messages ; must be called from the event loop (does nothing if already started)
+        """
+        if self.dispatcher is None and not self.stopping:
+            self.queue = asyncio.Queue(maxsize=self.size)
+            self.slots = asyncio.Semaphore(self.workers)
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+
+
+    async def put( self, message, conversations=[None] ):
+        """
+            Queues a message (starting the queue if needed) ; returns False if it was dropped
+        """
+
+        if self.stopping:
+            raise ValueError("The send queue is stopped")
+        self.start()
+        item = ( message, list(conversations), time.perf_counter() )
+        if self.queue.full():
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                log.warning("Send queue is full : dropping message %r",message)
+                self.stats['dropped'] += 1
+                return False
+            elif self.overflow == OVERFLOW_DROP_OLDEST:
+                dropped = self.queue.get_nowait()
+                self.queue.task_done()
+                log.warning("Send queue is full : dropping message %r",dropped[0])
+                self.stats['dropped'] += 1
+        await self.queue.put(item)
+        self.stats['queued'] += 1
+        self.stats['max_queued'] = max( self.stats['max_queued'], self.queue.qsize() )
+        return True
+
+
+    async def _dispatch( self ):
+
+        while True:
+            message, conversations, queued = await self.queue.get()
+            await self.slots.acquire()
+            previous = { self.last[c] for c in conversations if c in self.last }
+            task = asyncio.ensure_future( self._send(message,conversations,queued,previous) )
+            for c in conversations:
+                self.last[c] = task
+            self.tasks.add(task)
+            task.add_done_callback( lambda task, conversations=conversations: self._done(task,conversations) )
+
+
+    async def _send( self, message, conversations, queued, previous ):
+
+        if previous:
+            await asyncio.wait(previous)
+        try:
+            await self.send( message, conversations )
+            self.stats['sent'] += 1
+            elapsed = time.perf_counter() - queued
+            self.stats['total_send_time'] += elapsed
+            self.stats['max_send_time'] = max( self.stats['max_send_time'], elapsed )
+        except Exception:
+            self.stats['errors'] += 1
+            log.exception("Could not send %r to %r",message,conversations)
+
+
+    def _done( self, task, conversations ):
+
+        for c in conversations:
+            if self.last.get(c) is task:
+                del self.last[c]
+        self.tasks.discard(task)
+        self.slots.release()
+        self.queue.task_done()
+
+
+    async def stop( self, drain=True, timeout=DRAIN_TIMEOUT ):
+        """
+            Stops sending messages
+
+            drain: if True, sends the queued messages first (waiting at most 'timeout' seconds) ; else drops them
+        """
+        self.stopping = True
+        if self.dispatcher is None:
+            return
+        if drain:
+            try:
+                await asyncio.wait_for( self.queue.join(), timeout )
+            except asyncio.TimeoutError:
+                log.warning("Could not send all messages in %ss",timeout)
+        tasks = list(self.tasks)
+        self.stats['dropped'] += self.queue.qsize() + len(tasks)
+        self.dispatcher.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather( self.dispatcher, *tasks, return_exceptions=True )
+        self.dispatcher = None
+        self.tasks = set()
+        log.debug("Send queue statistics : %r",self.stats)
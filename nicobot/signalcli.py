@@ -3,6 +3,7 @@
 
 import argparse
 import atexit
+import collections
 import i18n
 import json
 import locale
@@ -11,18 +12,539 @@ import os
 import re
 import shutil
 import signal
+import queue
 import subprocess
 import sys
+import threading
 import time
+import concurrent.futures
 
-from .chatter import Chatter
+from .chatter import Chatter, conversation
 from .helpers import *
+from .sendqueue import SendQueue, SEND_QUEUE_SIZE, OVERFLOW_BLOCK, OVERFLOW_POLICIES, COALESCE_WINDOW
+
+try:
+    # Optional : parses signal-cli's output several times faster
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 
 # Generic timeout for signal-cli commands to return (actually only 'send' because 'receive' uses its own timeout)
 SEND_TIMEOUT = 30
-# Custom timeout to pass to signal-cli when receiving messages (negative values disable timeout)
+# Custom timeout to pass to signal-cli when receiving messages
+# Negative values disable timeout : a single 'receive' process then streams messages as they arrive,
+# but it holds the account so 'send' can't run : only in stealth mode (the daemon mode both streams and sends)
 RECEIVE_TIMEOUT = 5
+# When polling, the longest receive timeout used when there is no traffic (see ReceiveScheduler)
+RECEIVE_TIMEOUT_MAX = 60
+# Timeout after the first empty poll, when the shortest one is 0
+RECEIVE_TIMEOUT_STEP = 1
+# Maximum number of received messages waiting to be handled by the bot (when streaming)
+RECEIVE_BUFFER = 100
+# Seconds to wait before restarting a crashed signal-cli daemon (doubled after each failed start, up to RESTART_DELAY_MAX)
+RESTART_DELAY = 1
+RESTART_DELAY_MAX = 60
+
+
+# Number of recently processed envelopes remembered to skip duplicates
+DEDUP_WINDOW = 1000
+# Envelopes are accepted if sent up to this number of seconds before the last processed one
+# (timestamps are set by the senders, so they may not arrive in order) ; duplicates are recognized by the dedup window
+CURSOR_TOLERANCE = 60
+
+
+# Reasons why received events are discarded, counted in EnvelopeFilter.stats
+DISCARD_INVALID = 'invalid'
+DISCARD_NO_DATA = 'no_data'
+DISCARD_NO_TEXT = 'no_text'
+DISCARD_UNKNOWN_CONVERSATION = 'unknown_conversation'
+DISCARD_REASONS = ( DISCARD_INVALID, DISCARD_NO_DATA, DISCARD_NO_TEXT, DISCARD_UNKNOWN_CONVERSATION )
+
+
+# A 1-to-1 conversation (with 'recipient') or a group conversation (with 'group')
+Conversation = collections.namedtuple( 'Conversation', ['recipient','group'] )
+
+
+
+class SignalCliError(Exception):
+    """
+        An error returned by signal-cli in JSON-RPC mode
+    """
+
+    def __init__( self, message, code=None ):
+        super().__init__(message)
+        self.code = code
+
+
+
+class ReceiveCursor:
+    """
+        Remembers which envelopes have been processed, even across restarts, so each one is processed once.
+
+        It keeps the timestamp of the last processed envelope and the IDs of the most recent ones (the dedup window),
+        and saves them into a file after each envelope.
+    """
+
+    def __init__( self, file=None, window=DEDUP_WINDOW, tolerance=CURSOR_TOLERANCE ):
+        """
+            file: JSON file where to save the cursor ; if None it only lives in memory
+            window: number of recent envelopes remembered to skip duplicates
+            tolerance: seconds ; envelopes sent before the last processed one minus this delay are discarded
+        """
+
+        self.file = file
+        self.tolerance = tolerance * 1000
+        # Timestamp of the last processed envelope, in milliseconds since the epoch like Signal's
+        self.timestamp = None
+        # The dedup window : a set for O(1) lookups and a ring buffer to forget the oldest IDs
+        self.seen = set()
+        self.recent = collections.deque(maxlen=window)
+        self.stats = {
+            'accepted': 0,
+            'duplicates': 0,
+            'too_old': 0,
+            }
+        self.lock = threading.Lock()
+        if file:
+            self.load()
+
+
+    def load( self ):
+
+        try:
+            with open(self.file,'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            logging.debug("No receive cursor in %s yet",self.file)
+            return
+        except Exception:
+            logging.warning("Could not read the receive cursor from %s",self.file,exc_info=True)
+            return
+        self.timestamp = saved.get('timestamp')
+        for id in saved.get('recent',[]):
+            self._remember( tuple(id) )
+        logging.debug("Resuming after envelope %r (%d recent envelopes)",self.timestamp,len(self.recent))
+
+
+    def save( self ):
+
+        if self.file:
+            write_atomically( self.file, json.dumps({ 'timestamp':self.timestamp, 'recent':list(self.recent) }) )
+
+
+    def start( self ):
+        """
+            Without a saved cursor, starts from now : older envelopes are discarded
+        """
+        if self.timestamp is None:
+            self.timestamp = time.time() * 1000
+            self.tolerance = 0
+
+
+    def _id( self, envelope ):
+        # An envelope is identified by its sender, the sender's device and the sender's timestamp
+        return ( envelope.get('source'), envelope.get('sourceDevice'), envelope.get('timestamp') )
+
+
+    def _remember( self, id ):
+
+        if len(self.recent) == self.recent.maxlen:
+            self.seen.discard( self.recent[0] )
+        self.recent.append(id)
+        self.seen.add(id)
+
+
+    def accept( self, envelope ):
+        """
+            Returns True if this envelope has not been processed yet
+        """
+
+        timestamp = envelope.get('timestamp') or 0
+        with self.lock:
+            if self._id(envelope) in self.seen:
+                self.stats['duplicates'] += 1
+                return False
+            if self.timestamp is not None and timestamp <= self.timestamp - self.tolerance:
+                self.stats['too_old'] += 1
+                return False
+            self.stats['accepted'] += 1
+            return True
+
+
+    def commit( self, envelope ):
+        """
+            Records that this envelope has been processed
+        """
+
+        with self.lock:
+            self._remember( self._id(envelope) )
+            self.timestamp = max( self.timestamp or 0, envelope.get('timestamp') or 0 )
+            try:
+                self.save()
+            except Exception:
+                logging.exception("Could not save the receive cursor into %s",self.file)
+
+
+
+class EnvelopeFilter:
+    """
+        Tells from the raw JSON lines output by signal-cli which events can't be messages for the bot,
+        without parsing them : most of them are receipts, typing indicators and sync messages.
+
+        The pre-scan only looks for a few JSON keys in the line, so it never discards a line it can't classify :
+        the full checks are still made on the parsed events (and counted here too).
+    """
+
+    # A data message is the only kind of event that can contain a text
+    DATA_PATTERN = re.compile( rb'"dataMessage"\s*:\s*\{' )
+    # A text message has a string value ; messages without text (e.g. only attachments) have null
+    TEXT_PATTERN = re.compile( rb'"message"\s*:\s*"' )
+    # The quotes in values are escaped, so these keys can't be found inside a message's text
+    SOURCE_PATTERN = re.compile( rb'"source"\s*:\s*"([^"\\]*)"' )
+    GROUP_PATTERN = re.compile( rb'"groupId"\s*:\s*"([^"\\]*)"' )
+
+    def __init__( self, recipients={}, groups={} ):
+        """
+            recipients: the sources of the messages to keep
+            groups: the IDs of the groups whose messages to keep
+        """
+
+        self.recipients = recipients
+        self.groups = groups
+        self.stats = { 'lines': 0, 'parsed': 0 }
+        self.stats.update( (reason,0) for reason in DISCARD_REASONS )
+
+
+    def scan( self, line ):
+        """
+            Returns the reason why this line can be discarded, or None if it may be a message for the bot
+        """
+
+        if not self.DATA_PATTERN.search(line):
+            return DISCARD_NO_DATA
+        if not self.TEXT_PATTERN.search(line):
+            return DISCARD_NO_TEXT
+        # Messages in a group come from one of its members : the group is the conversation
+        found = self.GROUP_PATTERN.search(line)
+        if found:
+            if found.group(1).decode('utf-8','replace') not in self.groups:
+                return DISCARD_UNKNOWN_CONVERSATION
+        else:
+            found = self.SOURCE_PATTERN.search(line)
+            if found and found.group(1).decode('utf-8','replace') not in self.recipients:
+                return DISCARD_UNKNOWN_CONVERSATION
+        return None
+
+
+    def accept( self, line ):
+        """
+            Returns True if this line may be a message for the bot and should be parsed
+        """
+
+        self.stats['lines'] += 1
+        reason = self.scan(line)
+        if reason:
+            self.discard(reason)
+            logging.log(TRACE,"Discarding line (%s) : %r",reason,line)
+            return False
+        return True
+
+
+    def parse( self, line ):
+        """
+            Returns the event in this line, or None if it was discarded
+        """
+
+        if not self.accept(line):
+            return None
+        try:
+            event = loads(line)
+        except ValueError:
+            self.discard(DISCARD_INVALID)
+            logging.warning("Ignoring invalid line : %r",line)
+            return None
+        self.stats['parsed'] += 1
+        return event
+
+
+    def discard( self, reason ):
+        self.stats[reason] += 1
+
+
+
+class ReceiveScheduler:
+    """
+        Chooses the timeout of each 'receive' command from the recent traffic, when not streaming.
+
+        signal-cli's timeout is an idle timeout : a 'receive' only exits after that many seconds without a new message.
+        Its messages are only handed to the bot once it has exited (see SignalChatter.pollMessages),
+        because a 'send' can't run while a 'receive' holds the account.
+
+        While messages are coming or answers are being sent, the shortest timeout is used so messages are answered quickly.
+        After each empty poll the timeout is doubled, up to the longest one,
+        so an idle bot doesn't start a new signal-cli (and JVM) every few seconds.
+    """
+
+    def __init__( self, min_timeout, max_timeout=RECEIVE_TIMEOUT_MAX ):
+        """
+            min_timeout: seconds to wait for messages during a conversation
+            max_timeout: seconds to wait for messages when idle
+        """
+
+        self.min_timeout = min_timeout
+        self.max_timeout = max(min_timeout,max_timeout)
+        # The timeout of the next poll
+        self.timeout = min_timeout
+        self.stats = {
+            'polls': 0,
+            'empty_polls': 0,
+            'messages': 0,
+            # Cumulated seconds between the sending of messages and their reception
+            'total_delay': 0,
+            }
+
+
+    def watch( self, events ):
+        """
+            Yields the events of a single poll and adapts the next timeout when they are exhausted
+        """
+
+        self.stats['polls'] += 1
+        count = 0
+        for event in events:
+            count += 1
+            # Timestamps are in milliseconds since the epoch, set by the sender
+            timestamp = ( event.get('envelope') or {} ).get('timestamp')
+            if timestamp:
+                self.stats['total_delay'] += max( 0, time.time() - timestamp / 1000 )
+            yield event
+        self.stats['messages'] += count
+        if count:
+            self.timeout = self.min_timeout
+        else:
+            self.stats['empty_polls'] += 1
+            self.timeout = min( self.timeout * 2 if self.timeout > 0 else RECEIVE_TIMEOUT_STEP, self.max_timeout )
+        logging.log(TRACE,"Received %d events : next timeout is %ss",count,self.timeout)
+
+
+    def reset( self ):
+        """
+            Uses the shortest timeout for the next poll
+        """
+        self.timeout = self.min_timeout
+
+
+    def averageDelay( self ):
+        """
+            Returns the average number of seconds between the sending of messages and their reception
+        """
+        return self.stats['total_delay'] / self.stats['messages'] if self.stats['messages'] else 0
+
+
+
+class SignalCliDaemon:
+    """
+        Keeps a single signal-cli process running in JSON-RPC mode (signal-cli 0.9+)
+        and talks to it over its standard input / output.
+
+        Requests are matched to their responses by id, so several threads can send requests at the same time.
+        Notifications (e.g. received messages) are given to a callback.
+        The process is restarted if it exits unexpectedly.
+
+        See https://github.com/AsamK/signal-cli/blob/master/man/signal-cli-jsonrpc.5.adoc
+    """
+
+    def __init__( self, username, signal_cli=shutil.which("signal-cli"), config_dir=None, on_notification=None,
+        request_timeout=SEND_TIMEOUT, restart_delay=RESTART_DELAY, prefilter=None ):
+        """
+            username: the account to use
+            signal_cli: path to the signal-cli command
+            config_dir: signal-cli's configuration directory
+            on_notification: a Callable( method, params ) called from the reader thread for each notification ; it should not block
+            request_timeout: seconds to wait for the response of a request
+            restart_delay: seconds to wait before restarting a crashed process
+            prefilter: a Callable( line ) telling whether a notification's raw line must be parsed (e.g. EnvelopeFilter.accept)
+        """
+
+        self.username = username
+        self.signal_cli = signal_cli
+        self.config_dir = config_dir
+        self.on_notification = on_notification
+        self.request_timeout = request_timeout
+        self.restart_delay = restart_delay
+        self.prefilter = prefilter
+
+        self.process = None
+        self.reader = None
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.next_id = 0
+        # Futures of the requests waiting for a response, by id
+        self.pending = {}
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'notifications': 0,
+            'restarts': 0,
+            }
+
+
+    def command( self ):
+
+        cmd = [ self.signal_cli ]
+        if self.config_dir:
+            cmd = cmd + [ "--config", self.config_dir ]
+        return cmd + [ "-u", self.username, "jsonRpc" ]
+
+
+    def _launch( self ):
+
+        cmd = self.command()
+        logging.debug("Starting signal-cli daemon : %r",cmd)
+        self.process = subprocess.Popen( cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE )
+
+
+    def start( self ):
+        """
+            Starts the process and the thread reading its output
+        """
+
+        self.stopping = False
+        self._launch()
+        self.reader = threading.Thread( target=self._read, name="signal-cli-reader", daemon=True )
+        self.reader.start()
+        return self
+
+
+    def _read( self ):
+        """
+            Reads responses and notifications until stopped, restarting the process when it exits
+        """
+
+        delay = self.restart_delay
+        while True:
+            process = self.process
+            started = time.monotonic()
+            for line in iter(process.stdout.readline, b''):
+                self._handle(line)
+            code = process.wait()
+            self._failPending( SignalCliError("signal-cli exited with status %s" % code) )
+            if self.stopping:
+                return
+            # Only backs off if the process keeps crashing right after starting
+            delay = self.restart_delay if time.monotonic() - started > RESTART_DELAY_MAX else min( delay * 2, RESTART_DELAY_MAX )
+            logging.warning("signal-cli exited unexpectedly with status %s : restarting in %ss",code,delay)
+            time.sleep(delay)
+            if self.stopping:
+                return
+            with self.lock:
+                self.stats['restarts'] += 1
+                try:
+                    self._launch()
+                except OSError:
+                    logging.exception("Could not restart signal-cli")
+                    return
+
+
+    def _handle( self, line ):
+
+        logging.log(TRACE,"Read line : %r",line)
+        # Responses are never filtered ; the quotes in values are escaped so this key can't come from a message's text
+        if self.prefilter and b'"id"' not in line and not self.prefilter(line):
+            self.stats['notifications'] += 1
+            return
+        try:
+            message = loads(line)
+        except ValueError:
+            # signal-cli may also print logs
+            logging.debug("Ignoring non-JSON output : %r",line)
+            return
+
+        if 'id' in message and ( 'result' in message or 'error' in message ):
+            with self.lock:
+                future = self.pending.pop( message['id'], None )
+            if future is None:
+                logging.debug("Ignoring response to unknown request : %r",message)
+            elif 'error' in message:
+                error = message['error'] or {}
+                future.set_exception( SignalCliError( error.get('message',repr(error)), code=error.get('code') ) )
+            else:
+                future.set_result( message['result'] )
+        elif 'method' in message:
+            self.stats['notifications'] += 1
+            if self.on_notification:
+                try:
+                    self.on_notification( message['method'], message.get('params') )
+                except Exception:
+                    logging.exception("Error handling notification %r",message)
+        else:
+            logging.debug("Ignoring unknown message : %r",message)
+
+
+    def _failPending( self, error ):
+
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for future in pending.values():
+            future.set_exception(error)
+
+
+    def request( self, method, params=None, timeout=None ):
+        """
+            Sends a request and waits for its result
+
+            Raises a SignalCliError if signal-cli returned an error or exited, or a TimeoutError if it did not answer in time.
+        """
+
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.next_id += 1
+            id = str(self.next_id)
+            self.pending[id] = future
+            self.stats['requests'] += 1
+            request = { 'jsonrpc':'2.0', 'method':method, 'id':id }
+            if params:
+                request['params'] = params
+            logging.debug(">>> %r",request)
+            try:
+                self.process.stdin.write( json.dumps(request).encode('utf-8') + b'\n' )
+                self.process.stdin.flush()
+            except (OSError, ValueError) as e:
+                # The process is dead or being restarted
+                self.pending.pop(id,None)
+                self.stats['errors'] += 1
+                raise SignalCliError("Could not write to signal-cli : %r" % e)
+
+        try:
+            return future.result( timeout=timeout if timeout else self.request_timeout )
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                self.pending.pop(id,None)
+                self.stats['errors'] += 1
+            raise TimeoutError("No response from signal-cli to request %s" % id)
+        except SignalCliError:
+            with self.lock:
+                self.stats['errors'] += 1
+            raise
+
+
+    def stop( self ):
+
+        logging.debug("Stopping signal-cli daemon... (statistics : %r)",self.stats)
+        self.stopping = True
+        if self.process:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait( timeout=self.request_timeout )
+            except subprocess.TimeoutExpired:
+                self.process.terminate()
+        if self.reader and self.reader is not threading.current_thread():
+            self.reader.join( timeout=self.request_timeout )
 
 
 class SignalChatter(Chatter):
@@ -30,22 +552,40 @@ class SignalChatter(Chatter):
         A signal bot relying on signal-cli
     """
 
-    def __init__( self, username, recipient=None, group=None, signal_cli=shutil.which("signal-cli"), stealth=False, send_timeout=SEND_TIMEOUT, receive_timeout=RECEIVE_TIMEOUT, config_dir=None ):
+    def __init__( self, username, recipient=None, group=None, recipients=[], groups=[], signal_cli=shutil.which("signal-cli"), stealth=False, send_timeout=SEND_TIMEOUT, receive_timeout=RECEIVE_TIMEOUT, receive_timeout_max=RECEIVE_TIMEOUT_MAX, receive_buffer=RECEIVE_BUFFER, config_dir=None, daemon=False, cursor_file=None, dedup_window=DEDUP_WINDOW,
+        send_queue_size=SEND_QUEUE_SIZE, send_overflow=OVERFLOW_BLOCK, send_coalesce=COALESCE_WINDOW ):
 
         """
+            recipient, recipients: phone numbers of the persons to chat with
+            group, groups: IDs of the groups to chat in
             stealth: if True, will connect and listen to messages but instead of sending answers, will print them
+            receive_timeout: seconds each 'receive' command waits for messages ; if negative, a single 'receive' process streams them
+                (only in stealth mode : signal-cli locks the account, so nothing could be sent meanwhile ; use the daemon mode instead)
+            receive_timeout_max: when polling, the longest timeout used when no messages are coming (see ReceiveScheduler)
+            receive_buffer: maximum number of streamed messages waiting to be handled by the bot
+            cursor_file: JSON file where to remember the processed messages, to resume from there after a restart (see ReceiveCursor)
+            dedup_window: number of recently processed messages remembered to skip duplicates
+            send_queue_size: maximum number of messages waiting to be sent in the background ; 0 sends them synchronously
+            send_overflow: what to do with a new message when the send queue is full (see nicobot.sendqueue)
+            send_coalesce: seconds to wait for more messages to the same conversation in order to send them at once
+            daemon: if True, keeps a single signal-cli process running in JSON-RPC mode (see SignalCliDaemon)
+                    instead of running a new one for each 'send' and 'receive'
         """
 
         if not username or not signal_cli:
             raise ValueError("username and signal_cli must be provided")
-        if not recipient and not group:
-            raise ValueError("Either a recipient or a group must be given")
-        if recipient and group:
-            raise ValueError("Only one of recipient and group may be given")
+        recipients = list(dict.fromkeys( ([recipient] if recipient else []) + recipients ))
+        groups = list(dict.fromkeys( ([group] if group else []) + groups ))
+        if not recipients and not groups:
+            raise ValueError("At least a recipient or a group must be given")
+        if receive_timeout < 0 and not daemon and not stealth:
+            raise ValueError("A negative receive timeout keeps signal-cli's account locked so answers can't be sent : use the daemon mode to stream messages")
 
         self.username = username
-        self.recipient = recipient
-        self.group = group
+        # Indexes conversations by the source or group ID of incoming messages
+        self.recipients = { r: Conversation(r,None) for r in recipients }
+        self.groups = { g: Conversation(None,g) for g in groups }
+        self.conversations = list(self.recipients.values()) + list(self.groups.values())
         self.signal_cli = signal_cli
         self.config_dir = config_dir
         self.stealth = stealth
@@ -53,12 +593,60 @@ class SignalChatter(Chatter):
             logging.debug("Stealth mode : will not send message")
         self.send_timeout = send_timeout
         self.receive_timeout = receive_timeout
-
-        # Properties set elsewhere
-        self.startTime = None
+        self.scheduler = ReceiveScheduler( receive_timeout, receive_timeout_max ) if receive_timeout >= 0 else None
+        # signal-cli locks the account while running : held by each poll and each 'send' so they don't wait for each other's process
+        self.account = threading.Lock()
+
+        # Skips the messages already processed
+        self.cursor = ReceiveCursor( file=cursor_file, window=dedup_window )
+        # Discards most events before parsing them
+        self.envelopes = EnvelopeFilter( self.recipients, self.groups )
         # If True, will terminate the main loop
         self.shutdown = False
         self.bot = None
+        self.use_daemon = daemon
+        # In daemon mode : the signal-cli JSON-RPC process
+        self.daemon = None
+        # The running 'receive' process, when streaming
+        self.receiver = None
+        # In daemon and streaming modes : the received events, with the time they were read, waiting to be handled
+        if daemon:
+            # Not bounded : the daemon's reader must never wait, or the responses to the bot's requests would be blocked too
+            self.events = queue.Queue()
+        elif receive_timeout < 0:
+            self.events = queue.Queue(maxsize=receive_buffer)
+        else:
+            self.events = None
+        # Sends messages in the background
+        self.outbox = None
+        if send_queue_size > 0:
+            self.outbox = SendQueue( self.sendNow, size=send_queue_size, overflow=send_overflow, coalesce_window=send_coalesce )
+        # Sends the last messages (e.g. the bot's goodbye) before exiting
+        atexit.register(self.close)
+        self.stats = {
+            'received': 0,
+            # Seconds between reading messages and handing them to the bot
+            'max_dispatch_latency': 0,
+            'total_dispatch_latency': 0,
+            }
+
+
+    def connect( self ):
+
+        if self.use_daemon and self.daemon is None:
+            self.daemon = SignalCliDaemon( self.username, signal_cli=self.signal_cli, config_dir=self.config_dir,
+                on_notification=self.onNotification, request_timeout=self.send_timeout, prefilter=self.envelopes.accept )
+            self.daemon.start()
+
+
+    def onNotification( self, method, params ):
+        """
+            Called by the daemon for each notification ; received messages are handled in start()
+        """
+        if method == 'receive' and params:
+            self.events.put( (time.perf_counter(),params) )
+        else:
+            logging.debug("Ignoring notification %s",method)
 
 
     def start( self, bot ):
@@ -66,32 +654,140 @@ class SignalChatter(Chatter):
         self.bot = bot
         # Timestamp in Signal messages is a number of milliseconds since the epoch
         # See https://github.com/signalapp/libsignal-service-java/blob/a88d6a65330ab311079e198dedd25605b1aecc5f/java/src/main/java/org/whispersystems/signalservice/api/messages/SignalServiceDataMessage.java#L344
-        self.startTime = time.time() * 1000
-        logging.debug("Started at %f",self.startTime)
+        self.cursor.start()
+        logging.debug("Starting after %r",self.cursor.timestamp)
+
+        if self.use_daemon:
+            self.connect()
+        elif self.events is not None:
+            threading.Thread( target=self.streamMessages, name="signal-cli-receive", daemon=True ).start()
+        else:
+            while not self.shutdown:
+                self.filterMessages( self.pollMessages() )
+            logging.debug("Polling statistics : %r (average delay : %.3fs) ; envelopes : %r",self.scheduler.stats,self.scheduler.averageDelay(),self.envelopes.stats)
+            return
+
+        while not self.shutdown:
+            item = self.events.get()
+            # None is only used to wake this loop up on stop()
+            if item is None:
+                continue
+            received, event = item
+            latency = time.perf_counter() - received
+            self.stats['received'] += 1
+            self.stats['max_dispatch_latency'] = max( self.stats['max_dispatch_latency'], latency )
+            self.stats['total_dispatch_latency'] += latency
+            logging.log(TRACE,"Dispatching event read %.3fs ago",latency)
+            self.filterMessages( [event] )
+        logging.debug("Receive statistics : %r ; envelopes : %r",self.stats,self.envelopes.stats)
+
+
+    def pollMessages( self, timeout=None ):
+        """
+            Runs a single 'receive' command and returns its events once it has exited :
+            until then signal-cli holds the account, so the bot could not answer them.
+            The answers queued before are sent first.
+
+            timeout: uses the one chosen by self.scheduler by default
+        """
+
+        if self.outbox:
+            self.outbox.flush( timeout=self.send_timeout )
+        with self.account:
+            return list( self.scheduler.watch( self.receiveMessages( timeout=timeout if timeout is not None else self.scheduler.timeout ) ) )
+
+
+    def streamMessages( self ):
+        """
+            Runs a single 'receive' process and queues each event as soon as it is read ; restarts it if it exits
+        """
 
         while not self.shutdown:
-            self.filterMessages( self.receiveMessages() )
+            try:
+                for event in self.receiveMessages( timeout=self.receive_timeout ):
+                    # Waits if the bot is too slow : signal-cli will then wait too
+                    self.events.put( (time.perf_counter(),event) )
+            except Exception:
+                logging.exception("Error receiving messages")
+            if not self.shutdown:
+                logging.warning("signal-cli stopped receiving messages : restarting it in %ss",RESTART_DELAY)
+                time.sleep(RESTART_DELAY)
 
 
     def send( self,  message ):
+        """
+            Sends the given message to the conversation of the message being handled,
+            or to all conversations if not handling a message (e.g. a greeting).
+
+            Sends it in the background if there is a send queue (then returns None).
+        """
+
+        current = conversation.get()
+        targets = [ current ] if current in self.conversations else self.conversations
+        # More messages are likely to come : the next poll must not hold the account for long
+        if self.scheduler:
+            self.scheduler.reset()
+        sent = None
+        for target in targets:
+            if self.outbox:
+                self.outbox.put( message, conversation=target )
+            else:
+                sent = self.sendNow( message, target )
+        return sent
+
+
+    def sendNow( self, message, conversation ):
+        """
+            Sends the given message to the given Conversation and waits for signal-cli to return
+
+            Returns the timestamp of the sent message if known
+        """
+
+        if self.use_daemon:
+            return self.sendRequest( message, conversation )
 
         cmd = [ self.signal_cli, "-u", self.username, "send", "-m", message ]
         if self.config_dir:
             cmd = cmd + [ "--config", self.config_dir ]
-        if self.recipient:
-            cmd = cmd + [ self.recipient ]
-        elif self.group:
-            cmd = cmd + [ "-g", self.group ]
+        if conversation.recipient:
+            cmd = cmd + [ conversation.recipient ]
+        else:
+            cmd = cmd + [ "-g", conversation.group ]
 
         # throws an error in case of status <> 0
         logging.debug(cmd)
         if not self.stealth:
-            proc = subprocess.run( cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, check=True, timeout=self.send_timeout )
+            # Waits for the current poll, if any, instead of letting signal-cli wait for the account
+            with self.account:
+                proc = subprocess.run( cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, check=True, timeout=self.send_timeout )
             sent = proc.stdout
             logging.debug("Sent message : %s"%repr(sent))
         logging.debug( ">>> %s" % message )
 
 
+    def sendRequest( self, message, conversation ):
+        """
+            Sends the given message to the given Conversation through the signal-cli daemon
+
+            Returns the timestamp of the sent message
+        """
+
+        params = { 'message': message }
+        if conversation.recipient:
+            params['recipient'] = [ conversation.recipient ]
+        else:
+            params['groupId'] = conversation.group
+
+        sent = None
+        if not self.stealth:
+            self.connect()
+            result = self.daemon.request( 'send', params, timeout=self.send_timeout )
+            logging.debug("Sent message : %r",result)
+            sent = result.get('timestamp') if isinstance(result,dict) else None
+        logging.debug( ">>> %s" % message )
+        return sent
+
+
     def reply( self, source ):
         # TODO
         pass
@@ -101,71 +797,107 @@ class SignalChatter(Chatter):
 
         logging.debug("Stopping...")
         self.shutdown = True
+        if self.events is not None:
+            try:
+                self.events.put_nowait(None)
+            except queue.Full:
+                # The loop will see the shutdown flag with the next event
+                pass
+        receiver = self.receiver
+        if receiver and receiver.poll() is None:
+            receiver.terminate()
+
+
+    def close( self ):
+        """
+            Sends the queued messages and stops the signal-cli daemon if any
+        """
+
+        if self.outbox:
+            self.outbox.stop( drain=True, timeout=self.send_timeout )
+        if self.daemon:
+            self.daemon.stop()
 
 
     def receiveMessages( self, timeout=None, input=None ):
         """
+            Yields the events output by signal-cli as soon as they are read
+
             timeout: uses self.receive_timeout by default ; negative values disable timeout
+            input: a stream of JSON lines to read events from instead of running signal-cli
         """
 
-        if not timeout:
+        if timeout is None:
             timeout = self.receive_timeout
 
         cmd = [ self.signal_cli, "-u", self.username, "receive", "--json" ]
         if self.config_dir:
             cmd = cmd + [ "--config", self.config_dir ]
-        if timeout:
-            cmd = cmd + [ "-t", str(timeout) ]
+        # Always given : signal-cli has its own default timeout
+        cmd = cmd + [ "-t", str(timeout) ]
 
+        proc = None
         if not input:
             # This log can be very verbose and unuseful when reading empty responses every few seconds
             logging.log(TRACE,cmd)
             proc = subprocess.Popen( cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE )
+            self.receiver = proc
             input = proc.stdout
-        events = []
-        for bline in iter(input.readline, b''):
-            logging.debug("Read line : %s" % bline)
-            # try:
-            #     line = bline.decode()
-            # except (UnicodeDecodeError, AttributeError):
-            #     line = bline
-            events = events + [json.loads(bline.rstrip())]
-
-        return events
+        try:
+            for bline in iter(input.readline, b''):
+                logging.log(TRACE,"Read line : %r",bline)
+                event = self.envelopes.parse(bline)
+                if event is not None:
+                    yield event
+        finally:
+            if proc:
+                # The generator may be closed before the end of the output
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.wait()
+                proc.stdout.close()
+                self.receiver = None
 
 
     def filterMessages( self, events ):
 
         for event in events:
-            logging.debug("Filtering message : %s" % repr(event))
+            logging.log(TRACE,"Filtering message : %r",event)
             envelope = event['envelope']
-            if envelope['timestamp'] > self.startTime:
+            if self.cursor.accept(envelope):
                 # TODO This test prevents sending and receiving with the same number
                 # See https://github.com/nicolabs/nicobot/issues/34
-                if envelope['dataMessage']:
+                if envelope.get('dataMessage'):
                     dataMessage = envelope['dataMessage']
-                    if dataMessage['message']:
+                    if dataMessage.get('message'):
                         message = event['envelope']['dataMessage']['message']
-                        if self.recipient:
-                            if envelope['source'] == self.recipient:
-                                logging.debug("<<< %s" % message)
-                                self.bot.onMessage(message)
-                            else:
-                                logging.debug("Discarding message not from recipient %s"%self.recipient)
-                        elif self.group:
-                            if dataMessage['groupInfo'] and dataMessage['groupInfo']['groupId']:
-                                logging.debug("<<< %s" % message)
+                        # Messages in a group come from one of its members : the group is the conversation
+                        groupInfo = dataMessage.get('groupInfo')
+                        if groupInfo and groupInfo.get('groupId'):
+                            found = self.groups.get( groupInfo['groupId'] )
+                        else:
+                            found = self.recipients.get( envelope.get('source') )
+                        if found:
+                            logging.debug("<<< %s" % message)
+                            # Answers will go back to this conversation
+                            token = conversation.set(found)
+                            try:
                                 self.bot.onMessage(message)
-                            else:
-                                logging.debug("Discarding message not from group %s" % self.group)
+                            finally:
+                                conversation.reset(token)
+                                # Even if the bot failed, so a message that makes it fail is not processed again and again
+                                self.cursor.commit(envelope)
                         else:
-                            raise ValueError("Neither a recipient nor a group was configured : we should not be here")
+                            self.envelopes.discard(DISCARD_UNKNOWN_CONVERSATION)
+                            logging.debug("Discarding message not from one of my conversations")
                     else:
+                        self.envelopes.discard(DISCARD_NO_TEXT)
                         logging.debug("Discarding message without text")
                 else:
+                    self.envelopes.discard(DISCARD_NO_DATA)
                     logging.debug("Discarding message without data")
             else:
-                logging.debug("Discarding message that was sent before I started")
+                logging.debug("Discarding message already processed or sent before I started")
 
 
 
@@ -180,6 +912,12 @@ class ArgsHelper:
         # Default configuration (some defaults still need to be set up after command line has been parsed)
         self.__dict__.update({
             'signal_cli': shutil.which("signal-cli"),
+            'signal_daemon': False,
+            'signal_receive_timeout': RECEIVE_TIMEOUT,
+            'signal_receive_timeout_max': RECEIVE_TIMEOUT_MAX,
+            'signal_send_coalesce': COALESCE_WINDOW,
+            'signal_send_overflow': OVERFLOW_BLOCK,
+            'signal_send_queue': SEND_QUEUE_SIZE,
             'signal_stealth': False,
             })
 
@@ -193,9 +931,16 @@ class ArgsHelper:
         # Signal-specific arguments
         parser.add_argument('--signal-cli', dest='signal_cli', default=self.signal_cli, help="Path to `signal-cli` if not in PATH")
         parser.add_argument('--signal-username', dest='signal_username', help="Username when using the Signal backend (overrides --username)")
-        parser.add_argument('--signal-group', dest='signal_group', help="Group's ID (for Signal : a base64 string (e.g. 'mPC9JNVoKDGz0YeZMsbL1Q==')")
+        parser.add_argument('--signal-group', dest='signal_groups', action='append', default=[], help="Group's ID (for Signal : a base64 string (e.g. 'mPC9JNVoKDGz0YeZMsbL1Q==') ; may be given several times")
         parser.add_argument('--signal-recipient', dest='signal_recipients', action='append', default=[], help="Recipient when using the Signal backend (overrides --recipient)")
         parser.add_argument('--signal-stealth', dest='signal_stealth', action="store_true", default=self.signal_stealth, help="Activate Signal chatter's specific stealth mode")
+        parser.add_argument('--signal-daemon', dest='signal_daemon', action="store_true", default=self.signal_daemon, help="Keep a single signal-cli process running in JSON-RPC mode (requires signal-cli 0.9+)")
+        parser.add_argument('--signal-receive-timeout', dest='signal_receive_timeout', type=float, default=self.signal_receive_timeout, help="Seconds each signal-cli 'receive' waits for messages ; if negative (only with --signal-stealth), a single process streams them : use --signal-daemon to stream messages and answer them")
+        parser.add_argument('--signal-receive-timeout-max', dest='signal_receive_timeout_max', type=float, default=self.signal_receive_timeout_max, help="When polling (see --signal-receive-timeout), the longest timeout used when no messages are coming")
+        parser.add_argument('--signal-send-queue', dest='signal_send_queue', type=int, default=self.signal_send_queue, help="Maximum number of messages waiting to be sent in the background (0 to send them synchronously)")
+        parser.add_argument('--signal-send-overflow', dest='signal_send_overflow', choices=OVERFLOW_POLICIES, default=self.signal_send_overflow, help="What to do with a new message when the send queue is full")
+        parser.add_argument('--signal-send-coalesce', dest='signal_send_coalesce', type=float, default=self.signal_send_coalesce, help="Seconds to wait for more messages to the same conversation in order to send them at once (0 to disable)")
+        parser.add_argument('--signal-cursor-file', dest='signal_cursor_file', default=None, help="File where to remember the processed messages, to resume from there after a restart (defaults to .signal-cursor.json in the first config directory)")
         parser.add_argument('--signal-config-dir', dest='signal_config_dir', default=None, help="Directory where to store Signal configuration and sensitive data")
 
         return parser
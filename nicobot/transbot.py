@@ -6,6 +6,7 @@
 """
 
 import argparse
+import asyncio
 import logging
 import sys
 import os
@@ -14,39 +15,64 @@ import json
 import i18n
 import re
 import locale
-import requests
 import random
-# Provides an easy way to get the unicode sequence for country flags
-import flag
+import concurrent.futures
 import yaml
 import urllib.request
 
 # Own classes
 from .helpers import *
-from .bot import Bot
+from .cache import TranslationCache, MISS, CACHE_SIZE, CACHE_TTL
+from .keywords import KeywordIndex
+from .ibmcloud import IbmCloudTranslator, CONNECT_TIMEOUT, READ_TIMEOUT, POOL_SIZE, RETRIES
+from .glossary import GlossaryTranslator
+from .commands import CommandRouter
+from .languages import LanguageIndex, FlagTable, ALIASES
+from .bot import Bot, SyncBotAdapter
 from .bot import ArgsHelper as BotArgsHelper
+from .chatter import SyncChatterAdapter
+from .dispatcher import serve, QUEUE_SIZE
 from .console import ConsoleChatter
 from .jabber import JabberChatter
 from .jabber import arg_parser as jabber_arg_parser
-from .signalcli import SignalChatter
+from .signalcli import SignalChatter, RECEIVE_TIMEOUT, RECEIVE_TIMEOUT_MAX
 from .signalcli import ArgsHelper as SignalArgsHelper
 from .stealth import StealthChatter
 
 
 
-# Default timeout for requests in seconds
-# Note : More than 10s recommended (30s ?) on IBM Cloud with a free account
-TIMEOUT = 60
-
 # Set to None to translate keywords in all available languages
 # Set to something > 0 to limit the number of translations for the keywords (for tests)
 LIMIT_KEYWORDS = None
 
+# Maximum number of translations into random languages to run in parallel when answering a keyword
+HEDGE_FANOUT = 5
+# Maximum number of different random languages to try when answering a keyword (at least HEDGE_FANOUT)
+HEDGE_TRIES = 5
+# Seconds to wait for a translation before trying another random language in parallel (0 to try them all at once)
+HEDGE_DELAY = 0
+
+# Commands with the lowest priority are tried first on each message
+COMMAND_PRIORITY_SHUTDOWN = 0
+COMMAND_PRIORITY_TRANSLATE = 10
+COMMAND_PRIORITY_TRANSLATE_DEFAULT_LOCALE = 20
+COMMAND_PRIORITY_KEYWORD = 100
+
+# Number of messages handled at the same time ; 0 handles them one after the other, in the chatter's loop
+WORKERS = 0
+
+# Maximum number of concurrent requests when translating keywords
+KEYWORDS_WORKERS = 4
+# Maximum number of requests per second when translating keywords (None for no limit)
+KEYWORDS_RATE = 5
+
 # See https://github.com/nicolabs/nicobot/issues/8
 # Description : https://unicode.org/reports/tr35/#Likely_Subtags
 # Original XML version : http://cldr.unicode.org/index/cldr-spec/language-tag-equivalences
 # This is the URL to the JSON version
 LIKELY_SUBTAGS_URL = "https://raw.githubusercontent.com/unicode-cldr/cldr-core/master/supplemental/likelySubtags.json"
+# Seconds to wait when downloading it
+LIKELY_SUBTAGS_TIMEOUT = 10
 
 
 log = logging.getLogger(__name__)
@@ -58,36 +84,51 @@ class Config:
     def __init__(self):
         self.__dict__.update({
             'backend': "console",
+            'cache_file': None,
+            'cache_size': CACHE_SIZE,
+            'cache_ttl': CACHE_TTL,
+            'command_locales': [],
             'config_file': None,
             'config_dirs': [os.getcwd()],
+            'flags_file': None,
+            'glossary_file': None,
             'group': None,
+            'hedge_delay': HEDGE_DELAY,
+            'hedge_fanout': HEDGE_FANOUT,
+            'hedge_tries': HEDGE_TRIES,
             'ibmcloud_url': None,
             'ibmcloud_apikey': None,
+            'ibmcloud_connect_timeout': CONNECT_TIMEOUT,
+            'ibmcloud_pool_size': POOL_SIZE,
+            'ibmcloud_read_timeout': READ_TIMEOUT,
+            'ibmcloud_retries': RETRIES,
             'input_file': sys.stdin,
             'keywords': [],
             'keywords_files': [],
+            'keywords_rate': KEYWORDS_RATE,
+            'keywords_workers': KEYWORDS_WORKERS,
+            'language_aliases': {},
             'languages': [],
             'languages_file': None,
             'languages_likely': None,
             # e.g. locale.getlocale() may return ('en_US','UTF-8') : we only keep the 'en_US' part here (the same as the expected command-line parameter)
             'locale': locale.getlocale()[0],
+            'queue_size': QUEUE_SIZE,
             'recipient': None,
             'shutdown': None,
             'signal_cli': shutil.which("signal-cli"),
+            'signal_daemon': False,
+            'signal_receive_timeout': RECEIVE_TIMEOUT,
+            'signal_receive_timeout_max': RECEIVE_TIMEOUT_MAX,
             'signal_stealth': False,
             'stealth': False,
+            'translator': "ibmcloud",
             'username': None,
-            'verbosity': "WARNING"
+            'verbosity': "WARNING",
+            'workers': WORKERS
             })
 
 
-"""
-    TODO Find a better way to log requests.Response objects
-"""
-def _logResponse( r ):
-    log.debug("<<< Response : %s\tbody: %s", repr(r), r.content )
-
-
 def sanitizeNotPattern( string ):
     """
         Returns a string with all 'non-word' characters escaped with backslash
@@ -104,28 +145,46 @@ class TransBot(Bot):
         Sample bot that translates text.
 
         It only answers messages containing defined keywords.
-        It uses IBM Watson™ Language Translator (see API docs : https://cloud.ibm.com/apidocs/language-translator) to translate the text.
+        It uses IBM Watson™ Language Translator (see API docs : https://cloud.ibm.com/apidocs/language-translator) to translate the text,
+        or any other nicobot.translator.Translator.
     """
 
 
     def __init__( self,
         chatter, ibmcloud_url, ibmcloud_apikey,
-        keywords=[], keywords_files=[],
+        keywords=[], keywords_files=[], keywords_workers=KEYWORDS_WORKERS, keywords_rate=KEYWORDS_RATE,
         languages=[], languages_file=None, languages_likely=None,
+        languages_names_files=[], language_aliases={}, flags_file=None,
         locale=re.split(r'[_-]',locale.getlocale()[0]),
-        shutdown_pattern=r'bye nicobot' ):
+        shutdown_pattern=r'bye nicobot', command_locales=[],
+        cache=None, translator=None,
+        hedge_fanout=HEDGE_FANOUT, hedge_delay=HEDGE_DELAY, hedge_tries=HEDGE_TRIES,
+        workers=WORKERS, queue_size=QUEUE_SIZE ):
         """
             keywords: list of keywords that will trigger this bot (in any supported language)
-            keywords_files: list of JSON files with each a list of keywords (or write into)
+            keywords_files: list of JSON files with keywords and their translations (or write into)
+            keywords_workers: maximum number of concurrent requests when translating keywords
+            keywords_rate: maximum number of requests per second when translating keywords
             languages: List of supported languages in this format : https://cloud.ibm.com/apidocs/language-translator#list-identifiable-languages
             languages_file: JSON file where to find the list of target languages (or write into)
-            languages_likely: JSON URI where to find Unicode's likely subtags (or write into)
+            languages_likely: JSON URI where to find Unicode's likely subtags (or write into) ; only read if 'flags_file' is missing or incomplete
+            languages_names_files: other languages files (e.g. in other locales) whose names are also recognized as target languages
+            language_aliases: dict of { alternative name : language code } recognized as target languages, in addition to the default ones
+            flags_file: JSON file where to find the country and flag of each language (or write into)
             locale: overrides the default locale ; tuple like : ('en','GB')
             shutdown_pattern: a regular expression pattern that terminates this bot
+            command_locales: other locales whose i18n command patterns are also recognized
             chatter: the backend chat engine
-            ibmcloud_url (required): IBM Cloud API base URL (e.g. 'https://api.eu-de.language-translator.watson.cloud.ibm.com/instances/xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxx')
-            ibmcloud_apikey (required): IBM Cloud API key (e.g. 'dG90byBlc3QgZGFucyBsYSBwbGFjZQo')
+            ibmcloud_url (required unless 'translator' is given): IBM Cloud API base URL (e.g. 'https://api.eu-de.language-translator.watson.cloud.ibm.com/instances/xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxx')
+            ibmcloud_apikey (required unless 'translator' is given): IBM Cloud API key (e.g. 'dG90byBlc3QgZGFucyBsYSBwbGFjZQo')
             store_path: Base directory where to cache files
+            cache: a TranslationCache to use in front of the translation service ; defaults to an in-memory one
+            translator: the client to the translation service ; defaults to an IbmCloudTranslator built from ibmcloud_url and ibmcloud_apikey
+            hedge_fanout: maximum number of random languages to try in parallel when answering a keyword
+            hedge_delay: seconds to wait for a translation before trying another random language in parallel (0 to start 'hedge_fanout' of them at once)
+            hedge_tries: maximum number of different random languages to try when answering a keyword ; at least 'hedge_fanout'
+            workers: number of messages handled at the same time, while the chatter keeps receiving (0 to handle them one by one in the chatter's loop)
+            queue_size: maximum number of received messages waiting to be handled when 'workers' > 0
         """
 
         self.status = {'events':[]}
@@ -133,31 +192,85 @@ class TransBot(Bot):
         self.ibmcloud_url = ibmcloud_url
         self.ibmcloud_apikey = ibmcloud_apikey
         self.chatter = chatter
+        # Must be set before any call to self.translate()
+        self.cache = cache if cache is not None else TranslationCache()
+        self.translator = translator if translator is not None else IbmCloudTranslator(ibmcloud_url,ibmcloud_apikey)
 
         self.locale = locale
         self.languages = languages
         if languages_file:
             # Only after IBM credentials have been set can we retrieve the list of supported languages
             self.languages = self.loadLanguages(file=languages_file,locale=locale[0])
+        # Resolves target languages from their code, name or alias
+        self.languages_index = LanguageIndex( self.languages, aliases={ **ALIASES, **language_aliases } )
+        for file in languages_names_files:
+            try:
+                with open(file,'r') as f:
+                    self.languages_index.addNames( json.load(f)['languages'] )
+            except:
+                log.warning("Could not read languages names from %s" % file)
+        self.hedge_fanout = max(1,hedge_fanout)
         # How many different languages to try to translate to
-        self.tries = 5
+        self.tries = max(self.hedge_fanout,hedge_tries)
+        self.hedge_delay = hedge_delay
+        self.workers = workers
+        self.queue_size = queue_size
+        # Runs the parallel translation attempts (of all the messages handled at the same time)
+        self.executor = concurrent.futures.ThreadPoolExecutor( max_workers=self.hedge_fanout * max(1,self.workers) )
 
-        self.likelyLanguages = self.loadLikelyLanguages(languages_likely)
+        self.flags = self.loadFlags(file=flags_file,likely=languages_likely)
 
-        self.re_keywords = None
         # After self.languages has been set, we can iterate over it to translate keywords
-        kws = self.loadKeywords( keywords=keywords, files=keywords_files, limit=LIMIT_KEYWORDS )
-        if kws:
-            # And build a regular expression pattern with all keywords and their translations
-            pattern = r'\b%s\b' % sanitizeNotPattern(kws[0])
-            for keyword in kws[1:]:
-                pattern = pattern + r'|\b%s\b' % sanitizeNotPattern(keyword)
-            # Built regular expression pattern that triggers an answer from this bot
-            self.re_keywords = pattern
+        kws = self.loadKeywords( keywords=keywords, files=keywords_files, limit=LIMIT_KEYWORDS, workers=keywords_workers, rate=keywords_rate )
+        # And index all keywords and their translations ; a match triggers an answer from this bot
+        self.keywords = KeywordIndex()
+        for keyword, translations in kws.items():
+            self.keywords.add(keyword)
+            for language, translation in translations.items():
+                self.keywords.add(translation,keyword=keyword,language=language)
+        # Before any search : messages may be handled in several threads
+        self.keywords.build()
+        log.debug("Indexed %d keywords and translations",len(self.keywords))
 
         # Regular expression pattern of messages that stop the bot
         self.re_shutdown = shutdown_pattern
 
+        # Commands are tried in this order on each message
+        # Patterns are read from the i18n files of the current locale and the additional 'command_locales'
+        self.command_locales = list(dict.fromkeys( [self.locale[0]] + command_locales ))
+        self.commands = CommandRouter()
+        self.commands.register( 'shutdown', self.onShutdown,
+            patterns=[self.re_shutdown] + self._localizedPatterns('Shutdown',self.command_locales[1:]),
+            priority=COMMAND_PRIORITY_SHUTDOWN )
+        for name, priority in [ ('translate',COMMAND_PRIORITY_TRANSLATE), ('translate_default_locale',COMMAND_PRIORITY_TRANSLATE_DEFAULT_LOCALE) ]:
+            patterns = self._localizedPatterns(name,self.command_locales)
+            # Without i18n files the bot still answers keywords
+            if patterns:
+                self.commands.register( name, self.onTranslate, patterns=patterns, priority=priority )
+            else:
+                log.warning("No i18n pattern for command %s : disabled",name)
+        self.commands.register( 'keyword', self.answerKeyword,
+            matcher=self.keywords.search,
+            priority=COMMAND_PRIORITY_KEYWORD )
+
+
+    def _localizedPatterns( self, key, locales ):
+        """
+            Returns the list of patterns found with the given i18n key in the given locales
+        """
+        patterns = []
+        for l in locales:
+            try:
+                pattern = i18n.t(key,locale=l)
+            except KeyError:
+                pattern = None
+            # When the translation is missing, i18n may return the key itself
+            if pattern and pattern != key:
+                patterns.append(pattern)
+            else:
+                log.debug("No pattern %s for locale %s",key,l)
+        return patterns
+
 
     def _logEvent( self, event ):
 
@@ -187,19 +300,9 @@ class TransBot(Bot):
                 pass
 
         # Else, gets the list from the cloud
-        # curl --user apikey:{apikey} "{url}/v3/identifiable_languages?version=2018-05-01"
-        url = "%s/v3/identifiable_languages?version=2018-05-01" % self.ibmcloud_url
-        headers = {
-            'Accept': 'application/json',
-            'X-Watson-Learning-Opt-Out': 'true'
-            }
         # FIXME Since IBM API doesn't support an Accept-Language header to get the languages name in the locale, we need to query it again
-        log.debug(">>> GET %s, %s",url,repr(headers))
-        r = requests.get(url, headers=headers, auth=('apikey',self.ibmcloud_apikey), timeout=TIMEOUT)
-        _logResponse(r)
-
-        if r.status_code == requests.codes.ok:
-            languages_root = r.json()
+        languages_root = self.translator.identifiableLanguages()
+        if languages_root:
             languages = languages_root['languages']
 
             # IBM Cloud always returns language names in english
@@ -228,54 +331,111 @@ class TransBot(Bot):
                 log.debug("Not saving languages as no file was given")
 
             return languages
-        else:
-            r.raise_for_status()
 
 
-    def loadKeywords( self, keywords=[], files=[], limit=None ):
+    def _readKeywords( self, files ):
         """
-            Generates a list of translations from a list of keywords.
+            Reads and merges keywords files into a dict like { keyword: { language: translation } }
+        """
+
+        kws = {}
+        for file in files:
+            log.debug("Reading from %s..." % file)
+            # May throw an error
+            with open(file,'r') as f:
+                loaded = json.load(f)
+            # Older files are a flat list of keywords and translations, without their language
+            if isinstance(loaded,list):
+                loaded = { keyword:{} for keyword in loaded }
+            for keyword, translations in loaded.items():
+                kws.setdefault(keyword,{}).update(translations)
+        log.debug("Read keyword list : %s",repr(kws))
+        return kws
+
+
+    def loadKeywords( self, keywords=[], files=[], limit=None, workers=KEYWORDS_WORKERS, rate=KEYWORDS_RATE ):
+        """
+            Generates translations from a list of keywords.
 
             Requires self.languages to be filled before !
 
             If 'keywords' is not empty, will download the translations from IBM Cloud
             and if a single 'file' was given, will save them into it.
+            If this file already exists, only the missing translations are downloaded.
             Otherwise, will read from all the given 'files'
+
+            All keywords are sent in one request per target language ;
+            at most 'workers' requests are run concurrently and at most 'rate' per second.
+
+            Returns a dict like { keyword: { language: translation } }
         """
 
         # TODO It starts with the same code as in loadLanguages : make it a function
 
-        kws = []
-
         # Gets the list from a local file
         if len(keywords) == 0:
-            for file in files:
-                log.debug("Reading from %s..." % file)
-                # May throw an error
-                with open(file,'r') as f:
-                    kws = kws + json.load(f)
-            log.debug("Read keyword list : %s",repr(kws))
-            return kws
+            return self._readKeywords(files)
 
-        # TODO remove duplicates
+        kws = {}
+        if files and len(files) == 1 and os.path.exists(files[0]):
+            try:
+                kws = self._readKeywords(files)
+            except:
+                log.exception("Could not read existing keywords translations from %s : starting over", files[0])
+        # Removes duplicate keywords but keeps their order
+        keywords = list(dict.fromkeys(keywords))
         for keyword in keywords:
-            log.debug("Init %s...",keyword)
-            kws = kws + [ keyword ]
-
-            for lang in self.languages:
-                # For tests, in order not to use all credits, we can limit the number of calls here
-                if limit and len(kws) >= limit:
-                    break
+            kws.setdefault(keyword,{})
+
+        # For tests, in order not to use all credits, we can limit the number of calls here
+        languages = self.languages[:limit] if limit else self.languages
+        # Only the missing (keyword,language) pairs are requested
+        missing = {}
+        for lang in languages:
+            target = lang['language']
+            missing_keywords = [ keyword for keyword in keywords if target not in kws[keyword] ]
+            if missing_keywords:
+                missing[target] = missing_keywords
+        log.debug("Translating %d keywords into %d languages (%d already known)...",
+            len(keywords), len(missing), len(languages)-len(missing) )
+
+        limiter = RateLimiter(rate)
+        def translateInto( target, missing_keywords ):
+            limiter.acquire()
+            translation = self.translate( missing_keywords, target=target )
+            if translation is None and len(missing_keywords) > 1:
+                # The whole request fails if only one keyword cannot be translated
+                # (e.g. because it is already in the target language) : tries them one by one
+                log.debug("Could not translate %s into %s at once : trying one by one", missing_keywords, target)
+                translations = []
+                for keyword in missing_keywords:
+                    limiter.acquire()
+                    t = self.translate( [keyword], target=target )
+                    # Failed pairs stay missing so they are requested again next time
+                    translations.append( t['translations'][0] if t else None )
+                translation = { 'translations': translations }
+            return translation
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = { executor.submit(translateInto,target,missing_keywords): target for target, missing_keywords in missing.items() }
+            for future in concurrent.futures.as_completed(futures):
+                target = futures[future]
                 try:
-                    translation = self.translate( [keyword], target=lang['language'] )
-                    if translation:
-                        for t in translation['translations']:
-                            translated = t['translation'].strip()
-                            log.debug("Adding translation %s in %s for %s", t, lang, keyword)
-                            kws = kws + [ translated ]
+                    translation = future.result()
                 except:
-                    log.exception("Could not translate %s into %s", keyword, repr(lang))
-                    pass
+                    log.exception("Could not translate %s into %s", missing[target], target)
+                    continue
+                if not translation:
+                    log.debug("No translation into %s", target)
+                    continue
+                # IBM Cloud returns the translations in the same order as the input texts
+                for keyword, t in zip( missing[target], translation['translations'] ):
+                    if t is None:
+                        log.debug("No translation into %s for %s", target, keyword)
+                        continue
+                    translated = t['translation'].strip()
+                    log.debug("Adding translation %s in %s for %s", translated, target, keyword)
+                    kws[keyword][target] = translated
         log.debug("Keywords : %s", repr(kws))
 
         # TODO ? Save the translations for each keyword into a separate file ?
@@ -293,10 +453,38 @@ class TransBot(Bot):
         return kws
 
 
+    def loadFlags( self, file=None, likely=None ):
+        """
+            Returns the FlagTable of the languages in self.languages.
+
+            Reads it from the given file if it covers all languages ;
+            otherwise builds it from Unicode's likely subtags (see loadLikelyLanguages) and saves it into the file.
+            If the likely subtags could not be loaded, the flags are guessed from the language codes and not saved,
+            so the table is built again on the next start.
+
+            Requires self.languages to be filled before !
+        """
+
+        flags = FlagTable()
+        codes = [ l['language'] for l in self.languages ]
+        if file and flags.load(file) and flags.covers(codes):
+            return flags
+
+        log.debug("Building the flags table of %d languages...",len(codes))
+        likelySubtags = self.loadLikelyLanguages(likely)
+        flags.update( codes, likelySubtags )
+        if file and likelySubtags is not None:
+            flags.save(file)
+        elif file:
+            log.debug("Not saving guessed flags into %s",file)
+        return flags
+
+
     def loadLikelyLanguages( self, file ):
         """
             Returns a dict from a Likely Subtags JSON structure in the given file.
             If the file cannot be read, will download it from LIKELY_SUBTAGS_URL and save it with the given filename.
+            Returns None if it could not be downloaded either.
         """
 
         try:
@@ -305,17 +493,22 @@ class TransBot(Bot):
                 return json.load(f)
         except:
             log.debug("Downloading likely subtags from %s",LIKELY_SUBTAGS_URL)
-            with urllib.request.urlopen(LIKELY_SUBTAGS_URL) as response:
-                likelySubtags = response.read()
-                log.log(TRACE,"Got likely subtags : %s",repr(likelySubtags))
-                # Saves it for the next time
+            try:
+                with urllib.request.urlopen(LIKELY_SUBTAGS_URL,timeout=LIKELY_SUBTAGS_TIMEOUT) as response:
+                    likelySubtags = response.read()
+            except Exception:
+                log.warning("Could not download likely subtags from %s : flags will be guessed from language codes",LIKELY_SUBTAGS_URL,exc_info=True)
+                return None
+            log.log(TRACE,"Got likely subtags : %s",repr(likelySubtags))
+            # Saves it for the next time
+            if file:
                 try:
                     log.debug("Saving likely subtags into %s",file)
                     with open(file,'w') as f:
                         f.write(likelySubtags.decode())
                 except:
                     log.exception("Error saving the likely languages into %s",repr(file))
-                return json.loads(likelySubtags)
+            return json.loads(likelySubtags)
 
 
     # TODO Return more context as a second return value
@@ -326,42 +519,60 @@ class TransBot(Bot):
         """
             Translates a given list of messages.
 
+            Translations are first looked up in self.cache ; only the missing ones are sent to the remote service.
+
             target: Target language short code (e.g. 'en')
             source: Source language short code ; if not given will try to guess
 
             Returns the full JSON translation as per the IBM cloud service or None if no translation could be found.
+            When some translations come from the cache, the JSON only has the 'translations' entry.
         """
 
-        # curl -X POST -u "apikey:{apikey}" --header "Content-Type: application/json" --data "{\"text\": [\"Hello, world! \", \"How are you?\"], \"model_id\":\"en-es\"}" "{url}/v3/translate?version=2018-05-01"
-        url = "%s/v3/translate?version=2018-05-01" % self.ibmcloud_url
-        body = {
-            "text": messages,
-            "target": target
-            }
-        if source:
-            body['source'] = source
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'X-Watson-Learning-Opt-Out': 'true'
-            }
-        log.debug(">>> POST %s, %s, %s",url,repr(body),repr(headers))
-        r = requests.post(url, json=body, headers=headers, auth=('apikey',self.ibmcloud_apikey), timeout=TIMEOUT)
-        # TODO Log full response when it's usefull (i.e. when a message is going to be answered)
-        _logResponse(r)
-        if r.status_code == requests.codes.ok:
-            return r.json()
-        # A 404 can happen if there is no translation available
-        elif r.status_code == requests.codes.not_found:
-            return None
+        translations = [ self.cache.get(m,target=target,source=source) for m in messages ]
+        missing = [ m for m, t in zip(messages,translations) if t is MISS ]
+        if len(missing) == 0:
+            log.debug("Found all translations in cache for %r into %s",messages,target)
+            if all( t is None for t in translations ):
+                return None
+            # From my tests seems that IBM cloud returns the original text if it could not translate it
+            return { 'translations': [ {'translation': t if t is not None else m} for m, t in zip(messages,translations) ] }
+
+        response = self._requestTranslation( missing, target=target, source=source )
+        if response:
+            fetched = [ t['translation'] for t in response['translations'] ]
+            for m, t in zip(missing,fetched):
+                self.cache.put(m,target=target,value=t,source=source)
         else:
-            r.raise_for_status()
+            fetched = [ None ] * len(missing)
+            # Remembers that there is no translation for this message
+            # (when several messages were sent we cannot tell which one(s) could not be translated)
+            if len(missing) == 1:
+                self.cache.put(missing[0],target=target,value=None,source=source)
+        # Fast path : nothing came from the cache so the response can be returned as is
+        if len(missing) == len(messages):
+            return response
+
+        fetched = iter(fetched)
+        translations = [ next(fetched) if t is MISS else t for t in translations ]
+        if all( t is None for t in translations ):
+            return None
+        return { 'translations': [ {'translation': t if t is not None else m} for m, t in zip(messages,translations) ] }
+
+
+    def _requestTranslation( self, messages, target, source=None ):
+        """
+            Calls the remote translation service, bypassing the cache.
+
+            Same arguments and return value as translate().
+        """
+
+        return self.translator.translate( messages, target=target, source=source )
 
 
     def languageToCountry( self, lang ):
         """
             Returns the most likely ISO 3361 country code from an (~ISO 639 or IBM-custom) language
-            or the given 'lang' if no country code could be identified.
+            or a guess from the code itself if no country code could be identified (see FlagTable).
 
             lang : the language returned by IBM Translator service (is it ISO 639 ?)
 
@@ -370,14 +581,7 @@ class TransBot(Bot):
             - https://unicode.org/reports/tr35/#Likely_Subtags
             - http://cldr.unicode.org/index/cldr-spec/language-tag-equivalences
         """
-        try:
-            aa_Bbbb_CC = self.likelyLanguages['supplemental']['likelySubtags'][lang]
-            log.log(TRACE,"Found likely subtags %s for language %s",aa_Bbbb_CC,lang)
-            # The last part is the ISO 3361 country code
-            return re.split( r'[_-]', aa_Bbbb_CC )[-1]
-        except:
-            log.warning("Could not find a country code for %s : returning itself",lang, exc_info=True)
-            return lang
+        return self.flags.country(lang)
 
 
     def formatTranslation( self, translation, target ):
@@ -389,38 +593,24 @@ class TransBot(Bot):
         """
 
         text = translation['translations'][0]['translation'].strip()
-        try:
-            # Note : translation['detected_language'] is the detected source language, if guessed
-            country = self.languageToCountry(target)
-            lang_emoji = flag.flag(country)
-        except ValueError:
-            log.debug("Error looking for flag %s",target,exc_info=True)
-            lang_emoji= "🏳️‍🌈"
+        # Note : translation['detected_language'] is the detected source language, if guessed
+        lang_emoji = self.flags.flag(target)
         answer = "%s %s" % (text,lang_emoji)
         return i18n.t('all_messages',message=answer)
 
 
     def identifyLanguage( self, language_name ):
         """
-            Finds the language code from its name
+            Finds the language code from its code, name (in any indexed locale) or alias
         """
-        # TODO should be at 'trace' level
-        log.debug("identifyLanguage(%s)",language_name)
+        log.log(TRACE,"identifyLanguage(%s)",language_name)
 
-        # First checks if this is already the language's code (more accurate)
-        if language_name in [ l['language'] for l in self.languages ]:
-            log.debug("Identified language is already a code : %s",language_name)
-            return language_name
-        # Else, really try with the language's name
+        language = self.languages_index.resolve(language_name)
+        if language:
+            log.debug("Identified language %s as %s",language_name,language)
         else:
-            matching_names = [ l for l in self.languages if re.search(language_name.strip(),l['name'],re.IGNORECASE) ]
-            log.debug("Identified languages by name : %s",matching_names)
-            if len(matching_names) > 0:
-                # Only take the first one
-                return matching_names[0]['language']
-            else:
-                log.warning("Could not identify language %s",language_name)
-                return None
+            log.warning("Could not identify language %s",language_name)
+        return language
 
 
     def onMessage( self, message ):
@@ -439,86 +629,120 @@ class TransBot(Bot):
 
             For use cases 2 and 3 it will also include the flag of the target language.
 
+            Each use case is a command of self.commands, tried in this order ; more commands can be registered there.
+
             message: A plain text message
             Returns nothing (calls self.chatter.send)
         """
         log.debug("onMessage(%s)",message)
 
-        # Preparing the 'translate a message' case
+        if not self.commands.dispatch(message):
+            log.debug("Message did not match any known pattern")
+            self._logEvent({ 'type':'ignored', 'message':message })
+
+
+    def onShutdown( self, message, matched ):
+        """
+            Stops the bot (command 'shutdown')
+        """
+        log.debug("Shutdown asked")
+        self._logEvent({ 'type':'shutdown', 'message':message })
+        self.chatter.stop()
+
+
+    def onTranslate( self, message, matched ):
+        """
+            Translates the text given in the message (commands 'translate' and 'translate_default_locale')
+
+            matched: the regular expression match ; its 'message' group is the text to translate
+                and its optional 'language' group is the target language (the current locale if not given)
+        """
+
         to_lang = self.locale[0]
-        matched_translate = re.search( i18n.t('translate'), message.strip(), flags=re.IGNORECASE )
         # Case where the target language is given
-        if matched_translate:
+        if matched.groupdict().get('language'):
             log.debug("Detected 'translate a message with target' case")
-            to_lang = self.identifyLanguage( matched_translate.group('language') )
+            to_lang = self.identifyLanguage( matched.group('language') )
             log.debug("Found target language in message : %s"%to_lang)
         # Case where the target language is not given ; we will simply use the current locale
         else:
-            matched_translate = re.search( i18n.t('translate_default_locale'), message.strip(), flags=re.IGNORECASE )
-            if matched_translate:
-                log.debug("Detected 'translate a message' case")
-
-        ###
-        #
-        # Case 'shutdown'
-        #
-        # FIXME re.compile((i18n.t('Shutdown'),re.IGNORECASE).search(message) does not work
-        # as expected so we use re.search(...)
-        if re.search( self.re_shutdown, message, re.IGNORECASE ):
-            log.debug("Shutdown asked")
-            self._logEvent({ 'type':'shutdown', 'message':message })
-            self.chatter.stop()
-
-        ###
-        #
-        # Case 'translate a message'
-        #
-        elif matched_translate:
-            status_event = { 'type':'translate', 'message':message, 'target_lang':to_lang }
-            self._logEvent(status_event)
-            if to_lang:
-                translation = self.translate( [matched_translate.group('message')],target=to_lang )
-                log.debug("Got translation : %s",repr(translation))
-                status_event['translation'] = translation
-                if translation and len(translation['translations'])>0:
-                    answer = self.formatTranslation(translation,target=to_lang)
-                    log.debug(">> %s" % answer)
-                    status_event['answer'] = answer
-                    self.chatter.send(answer)
-                else:
-                    # TODO Make translate throw an error with details
-                    log.warning("Did not get a translation in %s for %s",to_lang,message)
-                    answer = i18n.t('all_messages',message=i18n.t('IDontKnow'))
-                    status_event['error'] = 'no_translation'
-                    status_event['answer'] = answer
-                    self.chatter.send(answer)
+            log.debug("Detected 'translate a message' case")
+
+        status_event = { 'type':'translate', 'message':message, 'target_lang':to_lang }
+        self._logEvent(status_event)
+        if to_lang:
+            translation = self.translate( [matched.group('message')],target=to_lang )
+            log.debug("Got translation : %s",repr(translation))
+            status_event['translation'] = translation
+            if translation and len(translation['translations'])>0:
+                answer = self.formatTranslation(translation,target=to_lang)
+                log.debug(">> %s" % answer)
+                status_event['answer'] = answer
+                self.chatter.send(answer)
             else:
-                log.warning("Could not identify target language in %s",message)
+                # TODO Make translate throw an error with details
+                log.warning("Did not get a translation in %s for %s",to_lang,message)
                 answer = i18n.t('all_messages',message=i18n.t('IDontKnow'))
-                status_event['error'] = 'unknown_target_language'
+                status_event['error'] = 'no_translation'
                 status_event['answer'] = answer
-                self.chatter.send( i18n.t('all_messages',message=i18n.t('IDontKnow')) )
+                self.chatter.send(answer)
+        else:
+            log.warning("Could not identify target language in %s",message)
+            answer = i18n.t('all_messages',message=i18n.t('IDontKnow'))
+            status_event['error'] = 'unknown_target_language'
+            status_event['answer'] = answer
+            self.chatter.send( i18n.t('all_messages',message=i18n.t('IDontKnow')) )
 
-        ###
-        #
-        # Case 'answer to keywords'
-        #
-        elif self.re_keywords and re.search( self.re_keywords, message, flags=re.IGNORECASE ):
 
-            status_translations = []
-            status_event = { 'type':'keyword', 'message':message, 'translations':status_translations }
-            self._logEvent( status_event )
+    def answerKeyword( self, message, matched_keyword ):
+        """
+            Translates the whole message into a random language
 
-            # Selects a few random target languages each time
-            langs = random.choices( self.languages, k=self.tries )
+            matched_keyword: the KeywordMatch found in the message
+        """
 
-            for lang in langs:
-                # Gets a translation in this random language
-                translation = self.translate( [message], target=lang['language'] )
+        log.debug("Found keyword %r",matched_keyword)
+        status_translations = []
+        status_event = {
+            'type':'keyword',
+            'message':message,
+            'keyword':matched_keyword.keyword,
+            'keyword_language':matched_keyword.language,
+            'translations':status_translations
+            }
+        self._logEvent( status_event )
+
+        # Selects a few different random target languages each time
+        langs = random.sample( self.languages, k=min(self.tries,len(self.languages)) )
+        candidates = iter(langs)
+        # Maps each running translation to its target language
+        pending = {}
+
+        def tryNext():
+            lang = next(candidates,None)
+            if lang is not None:
+                pending[ self.executor.submit( self.translate, [message], target=lang['language'] ) ] = lang
+
+        # Without hedging delay, starts all the allowed attempts at once
+        for i in range( 1 if self.hedge_delay else self.hedge_fanout ):
+            tryNext()
+
+        while pending:
+            done, not_done = concurrent.futures.wait( pending, timeout=self.hedge_delay or None, return_when=concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                lang = pending.pop(future)
+                try:
+                    translation = future.result()
+                except:
+                    log.exception("Could not translate %s into %s", message, lang['language'])
+                    translation = None
                 log.debug("Got translation : %s",repr(translation))
                 status_translation = { 'target_language':lang['language'], 'translation':translation }
                 status_translations.append(status_translation)
                 if translation and len(translation['translations'])>0:
+                    # The other attempts are ignored (and cancelled if not started yet)
+                    for other in pending:
+                        other.cancel()
                     answer = self.formatTranslation(translation,target=lang['language'])
                     log.debug(">> %s" % answer)
                     status_translation['answer'] = answer
@@ -526,22 +750,25 @@ class TransBot(Bot):
                     # Returns as soon as one translation was done
                     return
                 else:
-                    log.debug("No translation for %s in %r",message,langs)
+                    log.debug("No translation for %s in %s",message,lang['language'])
                     status_translation['error'] = 'no_translation'
-                    pass
+            # Replaces each failed attempt ; if none completed before the hedging delay, adds one more attempt in parallel
+            for i in range( max(len(done),1) ):
+                if len(pending) < self.hedge_fanout:
+                    tryNext()
 
-            log.warning("Could not find a translation in %s for %s",repr(langs),message)
-
-        else:
-            log.debug("Message did not match any known pattern")
-            self._logEvent({ 'type':'ignored', 'message':message })
+        log.warning("Could not find a translation in %s for %s",repr(langs),message)
 
 
     def onExit( self ):
 
         log.debug("Exiting...")
+        log.debug("Commands statistics : %r",self.commands.stats())
         status_shutdown = { 'type':'shutdown' }
         self._logEvent(status_shutdown)
+        self.executor.shutdown(wait=False)
+        self.cache.close()
+        self.translator.close()
 
         # TODO Better use gettext in the end
         try:
@@ -558,6 +785,21 @@ class TransBot(Bot):
             pass
 
 
+    def serve( self ):
+        """
+            Runs the chatter's loop in a thread and handles up to self.workers messages at the same time in other threads
+        """
+
+        bot = SyncBotAdapter( self, workers=self.workers )
+        loop = asyncio.new_event_loop()
+        try:
+            stats = loop.run_until_complete( serve( bot, SyncChatterAdapter(self.chatter), workers=self.workers, queue_size=self.queue_size ) )
+            self._logEvent({ 'type':'dispatcher', 'stats':stats })
+        finally:
+            bot.close()
+            loop.close()
+
+
     def run( self ):
         """
             Starts the bot :
@@ -585,7 +827,10 @@ class TransBot(Bot):
             pass
 
         self.registerExitHandler()
-        self.chatter.start(self)
+        if self.workers > 0:
+            self.serve()
+        else:
+            self.chatter.start(self)
         log.debug("Chatter loop ended")
         return self.status
 
@@ -606,12 +851,30 @@ def run( args=sys.argv[1:] ):
     # Core arguments for this bot
     parser.add_argument("--keyword", "-k", dest="keywords", action="append", help="A keyword a bot should react to, in any language (will write them & their translations into the file specified with --keywords-file)")
     parser.add_argument("--keywords-file", dest="keywords_files", action="append", help="File to load from and write keywords to")
+    parser.add_argument("--keywords-workers", dest="keywords_workers", type=int, default=config.keywords_workers, help="Maximum number of concurrent requests when translating keywords")
+    parser.add_argument("--keywords-rate", dest="keywords_rate", type=float, default=config.keywords_rate, help="Maximum number of requests per second when translating keywords")
     parser.add_argument('--locale', '-l', dest='locale', default=config.locale, help="Change default locale (e.g. 'fr_FR')")
     parser.add_argument("--languages-file", dest="languages_file", help="File to load from and write languages to")
     parser.add_argument("--languages-likely", dest="languages_likely", default=config.languages_likely, help="URI to Unicode's Likely Subtags (best language <-> country matches) in JSON format")
+    parser.add_argument("--flags-file", dest="flags_file", default=config.flags_file, help="File to load from and write the flag of each language to (defaults to languages.<locale>.flags.json next to the languages file)")
     parser.add_argument("--shutdown", dest="shutdown", help="Shutdown keyword regular expression pattern")
+    parser.add_argument("--command-locale", dest="command_locales", action="append", default=config.command_locales, help="Also recognize the commands of this locale (e.g. 'fr'), as defined in its i18n file")
+    parser.add_argument("--translator", dest="translator", choices=['ibmcloud','glossary'], default=config.translator, help="Translation service to use ('glossary' works offline with --glossary-file)")
+    parser.add_argument("--glossary-file", dest="glossary_file", default=config.glossary_file, help="JSON glossary to translate with when using --translator glossary (see nicobot.glossary)")
     parser.add_argument("--ibmcloud-url", dest="ibmcloud_url", help="IBM Cloud API base URL (get it from your resource https://cloud.ibm.com/resources)")
     parser.add_argument("--ibmcloud-apikey", dest="ibmcloud_apikey", help="IBM Cloud API key (get it from your resource : https://cloud.ibm.com/resources)")
+    parser.add_argument("--hedge-fanout", dest="hedge_fanout", type=int, default=config.hedge_fanout, help="Maximum number of random languages to try in parallel when answering a keyword")
+    parser.add_argument("--workers", dest="workers", type=int, default=config.workers, help="Number of messages handled at the same time while still receiving new ones (0 to handle them one by one)")
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=config.queue_size, help="Maximum number of received messages waiting to be handled (with --workers)")
+    parser.add_argument("--hedge-tries", dest="hedge_tries", type=int, default=config.hedge_tries, help="Maximum number of different random languages to try when answering a keyword (at least --hedge-fanout)")
+    parser.add_argument("--hedge-delay", dest="hedge_delay", type=float, default=config.hedge_delay, help="Seconds to wait for a translation before trying another random language in parallel (0 to try them all at once)")
+    parser.add_argument("--ibmcloud-pool-size", dest="ibmcloud_pool_size", type=int, default=config.ibmcloud_pool_size, help="Maximum number of connections kept alive to IBM Cloud")
+    parser.add_argument("--ibmcloud-connect-timeout", dest="ibmcloud_connect_timeout", type=float, default=config.ibmcloud_connect_timeout, help="Timeout in seconds to connect to IBM Cloud")
+    parser.add_argument("--ibmcloud-read-timeout", dest="ibmcloud_read_timeout", type=float, default=config.ibmcloud_read_timeout, help="Timeout in seconds to read a response from IBM Cloud")
+    parser.add_argument("--ibmcloud-retries", dest="ibmcloud_retries", type=int, default=config.ibmcloud_retries, help="Number of retries (with backoff) on connection errors and 429 / 5xx responses from IBM Cloud")
+    parser.add_argument("--cache-file", dest="cache_file", default=config.cache_file, help="SQLite file where to persist translations (in-memory cache only if not given)")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=config.cache_size, help="Maximum number of translations to keep in memory (0 to disable)")
+    parser.add_argument("--cache-ttl", dest="cache_ttl", type=int, default=config.cache_ttl, help="Number of seconds a cached translation is valid (0 for no expiry)")
 
     #
     # Two-pass arguments parsing
@@ -648,10 +911,14 @@ def run( args=sys.argv[1:] ):
     if not config.shutdown:
         config.shutdown = i18n.t('Shutdown')
 
-    if not config.ibmcloud_url:
-        raise ValueError("Missing required parameter : --ibmcloud-url")
-    if not config.ibmcloud_apikey:
-        raise ValueError("Missing required parameter : --ibmcloud-apikey")
+    if config.translator == 'glossary':
+        if not config.glossary_file:
+            raise ValueError("Missing required parameter : --glossary-file")
+    else:
+        if not config.ibmcloud_url:
+            raise ValueError("Missing required parameter : --ibmcloud-url")
+        if not config.ibmcloud_apikey:
+            raise ValueError("Missing required parameter : --ibmcloud-apikey")
 
     # config.keywords is used if given
     # else, check for an existing keywords_file
@@ -669,7 +936,7 @@ def run( args=sys.argv[1:] ):
                 should_exist=True,
                 fallback_to=None )
             if found:
-                keywords_files_filtered = keywords_files_filtered + found[0]
+                keywords_files_filtered = keywords_files_filtered + [ found[0] ]
         config.keywords_files = keywords_files_filtered
         log.debug("Found the following keywords files : %s", repr(config.keywords_files))
         # Convenience check to better warn the user and allow filenames relative to config dirs
@@ -689,6 +956,15 @@ def run( args=sys.argv[1:] ):
     if not config.languages_file:
         raise ValueError("Missing language file : please use only --languages-file to generate it automatically or --language for each target language")
 
+    # Also recognizes languages names from the languages files of the other command locales
+    config.languages_names_files = filter_files(
+        [ os.path.join( dir, "languages.%s.json"%l ) for l in config.command_locales for dir in config.config_dirs ],
+        should_exist=True )
+
+    # The flags table is kept next to the languages file
+    if not config.flags_file:
+        config.flags_file = "%s.flags.json" % os.path.splitext(config.languages_file)[0]
+
     # Finds a "likely language" file
     config.languages_likely = filter_files(
         [ config.languages_likely ]
@@ -698,6 +974,17 @@ def run( args=sys.argv[1:] ):
 
     log.debug( "Final configuration : %s", repr(obfuscate(vars(config))) )
 
+    cache = TranslationCache( max_size=config.cache_size, ttl=config.cache_ttl, file=config.cache_file )
+    if config.translator == 'glossary':
+        translator = GlossaryTranslator( file=config.glossary_file )
+    else:
+        translator = IbmCloudTranslator(
+            config.ibmcloud_url, config.ibmcloud_apikey,
+            pool_size=config.ibmcloud_pool_size,
+            connect_timeout=config.ibmcloud_connect_timeout,
+            read_timeout=config.ibmcloud_read_timeout,
+            retries=config.ibmcloud_retries )
+
     # Creates the chat engine depending on the 'backend' parameter
     chatter = BotArgsHelper.chatter(config)
 
@@ -707,11 +994,18 @@ def run( args=sys.argv[1:] ):
 
     bot = TransBot(
         keywords=config.keywords, keywords_files=config.keywords_files,
+        keywords_workers=config.keywords_workers, keywords_rate=config.keywords_rate,
         languages_file=config.languages_file, languages_likely=config.languages_likely,
+        languages_names_files=config.languages_names_files, language_aliases=config.language_aliases,
+        flags_file=config.flags_file,
         locale=lang,
         ibmcloud_url=config.ibmcloud_url, ibmcloud_apikey=config.ibmcloud_apikey,
-        shutdown_pattern=config.shutdown,
-        chatter=chatter
+        shutdown_pattern=config.shutdown, command_locales=config.command_locales,
+        chatter=chatter,
+        cache=cache,
+        translator=translator,
+        hedge_fanout=config.hedge_fanout, hedge_delay=config.hedge_delay, hedge_tries=config.hedge_tries,
+        workers=config.workers, queue_size=config.queue_size
         )
     status_result = bot.run()
     status = { 'args':obfuscate(vars(config)), 'result':status_result }
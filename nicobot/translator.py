@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+class Translator:
+    """
+        Translation service interface
+
+        Results follow the JSON structures of IBM Watson™ Language Translator (see https://cloud.ibm.com/apidocs/language-translator)
+    """
+
+    def translate( self, messages, target, source=None ):
+        """
+            Translates a given list of messages.
+
+            target: Target language short code (e.g. 'en')
+            source: Source language short code ; if not given will try to guess
+
+            Returns a dict like { 'translations': [ {'translation':'...'}, ... ] } with one translation per message
+            or None if no translation could be found.
+        """
+        pass
+
+    def identifiableLanguages( self ):
+        """
+            Returns the known languages as a dict like { 'languages': [ {'language':'fr', 'name':'French'}, ... ] }
+        """
+        pass
+
+    def identify( self, text ):
+        """
+            Guesses the language of the given text.
+
+            Returns a dict like { 'languages': [ {'language':'fr', 'confidence':0.9}, ... ] }, most likely language first
+        """
+        pass
+
+    def close( self ):
+        """
+            Releases any resource held by this translator
+        """
+        pass
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+import time
+
+from nicobot.cache import TranslationCache, MISS
+
+
+class TestTranslationCache(unittest.TestCase):
+
+    def test_miss_then_hit(self):
+        cache = TranslationCache()
+        self.assertIs( MISS, cache.get("Hello",target='fr') )
+        cache.put("Hello",target='fr',value="Bonjour")
+        self.assertEqual( "Bonjour", cache.get("Hello",target='fr') )
+        # The source language is part of the key
+        self.assertIs( MISS, cache.get("Hello",target='fr',source='en') )
+        self.assertEqual( 1, cache.stats['hits'] )
+        self.assertEqual( 2, cache.stats['misses'] )
+
+    def test_no_translation_is_cached(self):
+        cache = TranslationCache()
+        cache.put("Hello",target='en',value=None)
+        self.assertIsNone( cache.get("Hello",target='en') )
+
+    def test_lru_eviction(self):
+        cache = TranslationCache(max_size=2)
+        cache.put("one",target='fr',value="un")
+        cache.put("two",target='fr',value="deux")
+        # Makes "one" the most recently used
+        cache.get("one",target='fr')
+        cache.put("three",target='fr',value="trois")
+        self.assertEqual( "un", cache.get("one",target='fr') )
+        self.assertIs( MISS, cache.get("two",target='fr') )
+        self.assertEqual( 1, cache.stats['evicted'] )
+
+    def test_ttl(self):
+        cache = TranslationCache(ttl=1)
+        cache.put("Hello",target='fr',value="Bonjour")
+        cache.entries[('Hello','','fr')] = ("Bonjour",time.time()-2)
+        self.assertIs( MISS, cache.get("Hello",target='fr') )
+        self.assertEqual( 1, cache.stats['expired'] )
+
+    def test_file_layer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir,"cache.db")
+            cache = TranslationCache(file=file)
+            cache.put("Hello",target='fr',value="Bonjour")
+            cache.close()
+            # A new instance reads from the file only
+            cache = TranslationCache(file=file)
+            self.assertEqual( "Bonjour", cache.get("Hello",target='fr') )
+            self.assertEqual( 1, cache.stats['file_hits'] )
+            # Then it is also found in memory
+            self.assertEqual( "Bonjour", cache.get("Hello",target='fr') )
+            self.assertEqual( 1, cache.stats['hits'] )
+            cache.close()
+
+    def test_file_size_limit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = TranslationCache(max_size=0,file=os.path.join(tmpdir,"cache.db"),max_file_size=2)
+            cache.put("one",target='fr',value="un")
+            cache.put("two",target='fr',value="deux")
+            cache.put("three",target='fr',value="trois")
+            self.assertEqual( 2, cache.db.execute("SELECT COUNT(*) FROM translations").fetchone()[0] )
+            cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from nicobot.commands import CommandRouter
+
+
+class TestCommandRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.router = CommandRouter()
+        handler = lambda name: lambda message, match: self.handled.append((name,message))
+        self.router.register( 'keyword', handler('keyword'), matcher=lambda text: 'hello' in text, priority=100 )
+        self.router.register( 'translate', handler('translate'), patterns=[r'^nicobot\s+(?P<message>.+)\s+in\s+(?P<language>.+)$', r'^nicobot\s+(?P<message>.+)\s+en\s+(?P<language>.+)$'], priority=10 )
+        self.router.register( 'shutdown', handler('shutdown'), patterns=[r'bye nicobot'], priority=0 )
+
+    def test_priority_order(self):
+        self.assertEqual( 'shutdown', self.router.dispatch("hello, bye nicobot") )
+        self.assertEqual( 'translate', self.router.dispatch("  NICOBOT hello in french ") )
+        self.assertEqual( 'keyword', self.router.dispatch("hello") )
+        self.assertIsNone( self.router.dispatch("nothing to do") )
+        # Handlers receive the original message
+        self.assertEqual( ('translate',"  NICOBOT hello in french "), self.handled[1] )
+
+    def test_all_locales(self):
+        self.assertEqual( 'translate', self.router.dispatch("nicobot bonjour en anglais") )
+
+    def test_stats(self):
+        self.router.dispatch("hello")
+        stats = self.router.stats()
+        self.assertEqual( 1, stats['shutdown']['tried'] )
+        self.assertEqual( 0, stats['shutdown']['matched'] )
+        self.assertEqual( 1, stats['keyword']['matched'] )
+
+    def test_register_replaces(self):
+        self.router.register( 'keyword', lambda message, match: None, patterns=['other'], priority=100 )
+        self.assertEqual( 3, len(self.router.commands) )
+        self.assertIsNone( self.router.dispatch("hello") )
+
+    def test_no_matcher(self):
+        with self.assertRaises(ValueError):
+            self.router.register( 'empty', lambda message, match: None )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import threading
+import unittest
+
+from nicobot.bot import Bot, AsyncBot, SyncBotAdapter
+from nicobot.chatter import AsyncChatter, SyncChatterAdapter, Chatter, conversation
+from nicobot.console import ConsoleChatter
+from nicobot.dispatcher import serve
+
+
+class ListChatter(AsyncChatter):
+    """
+        Gives a fixed list of messages to the bot
+    """
+    def __init__( self, messages ):
+        self.messages = messages
+    async def start( self, bot ):
+        for message in self.messages:
+            await bot.onMessage(message)
+
+
+class SlowBot(AsyncBot):
+
+    def __init__( self, delay ):
+        self.delay = delay
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+
+    async def onMessage( self, message ):
+        self.running += 1
+        self.max_running = max(self.max_running,self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        if message == 'fail':
+            raise ValueError(message)
+        self.handled.append(message)
+
+
+class BlockingBot(Bot):
+    """
+        Each message waits until 'parties' messages are being handled at the same time
+    """
+
+    def __init__( self, parties ):
+        self.barrier = threading.Barrier( parties, timeout=5 )
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def onMessage( self, message ):
+        self.barrier.wait()
+        with self.lock:
+            self.handled.append(message)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def run_loop( self, coroutine ):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_concurrent_handlers( self ):
+        bot = SlowBot(0.05)
+        messages = [ str(i) for i in range(20) ] + ['fail']
+        stats = self.run_loop( serve( bot, ListChatter(messages), workers=4, queue_size=2 ) )
+        self.assertEqual( 4, bot.max_running )
+        self.assertEqual( sorted(messages[:-1]), sorted(bot.handled) )
+        self.assertEqual( 21, stats['received'] )
+        self.assertEqual( 20, stats['handled'] )
+        self.assertEqual( 1, stats['errors'] )
+        self.assertLessEqual( stats['max_queued'], 2 )
+
+    def test_sync_adapters( self ):
+        bot = BlockingBot(4)
+        chatter = ConsoleChatter( input=io.StringIO("a\nb\nc\nd\n"), output=io.StringIO() )
+        adapter = SyncBotAdapter( bot, workers=4 )
+        try:
+            self.run_loop( serve( adapter, SyncChatterAdapter(chatter), workers=4 ) )
+        finally:
+            adapter.close()
+        # The 4 messages were handled at the same time and all of them before returning
+        self.assertFalse( bot.barrier.broken )
+        self.assertEqual( ['a','b','c','d'], sorted(bot.handled) )
+
+    def test_conversation_propagation( self ):
+
+        class ConversationsChatter(Chatter):
+            def start( self, bot ):
+                for name in ('alice','bob'):
+                    token = conversation.set(name)
+                    bot.onMessage("Hello")
+                    conversation.reset(token)
+
+        answers = []
+        class AnsweringBot(Bot):
+            def onMessage( self, message ):
+                answers.append( (conversation.get(),message) )
+
+        adapter = SyncBotAdapter( AnsweringBot(), workers=2 )
+        try:
+            self.run_loop( serve( adapter, SyncChatterAdapter(ConversationsChatter()), workers=2 ) )
+        finally:
+            adapter.close()
+        self.assertEqual( [('alice',"Hello"),('bob',"Hello")], sorted(answers) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import shutil
+import tempfile
+import threading
+import unittest
+import xml.etree.ElementTree as ET
+
+from slixmpp import ClientXMPP
+from slixmpp.exceptions import IqError
+from slixmpp.xmlstream.handler import Callback
+from slixmpp.xmlstream.matcher import MatchXPath
+from slixmpp.stanza import Message
+from slixmpp_omemo.stanza import Encrypted
+
+from nicobot.chatter import conversation
+from nicobot.fakexmpp import FakeXmpp
+from nicobot.jabber import OmemoCache, SenderFilter, SliXmppClient, JabberChatter, Conversation, UNKNOWN_LIMIT
+from nicobot.loopmonitor import LagMonitor
+
+
+RECIPIENT = 'alice@example.com'
+OTHER = 'bob@example.com'
+ROOM = 'room@conference.example.com'
+
+
+class FakeOmemo:
+    """
+        Stands for the 'xep_0384' plugin : devices 1 and 2 have a bundle, device 3 doesn't
+    """
+
+    def __init__( self ):
+        self.bundles = {}
+        self.devices = {}
+        self.fetched = []
+
+    async def _fetch_bundle( self, jid, device ):
+        self.fetched.append( ('bundle',jid,device) )
+        return None if device == 3 else "bundle %d" % device
+
+    async def _fetch_device_list( self, jid ):
+        self.fetched.append( ('devices',jid.bare) )
+        return await self._read_device_list( jid, [1,2,3] )
+
+    async def _read_device_list( self, jid, items ):
+        self.devices[jid.bare] = items
+
+    def get_device_list( self, jid ):
+        return self.devices.get( jid.bare, [] )
+
+
+class TestJabber(unittest.TestCase):
+
+    def test_omemo_cache( self ):
+        omemo = FakeOmemo()
+        cache = OmemoCache( omemo, bad_device_ttl=60 )
+        asyncio.run( cache.prewarm([RECIPIENT]) )
+        self.assertEqual( { 1:"bundle 1", 2:"bundle 2" }, omemo.bundles[RECIPIENT] )
+        self.assertEqual( 4, cache.stats['iq'] )
+        self.assertEqual( [3], list(cache.problems([RECIPIENT]).values())[0] )
+
+        # Nothing is fetched again while the device list is fresh
+        asyncio.run( cache.refresh([RECIPIENT]) )
+        self.assertEqual( 4, cache.stats['iq'] )
+
+        # Bad devices are tried again after a while
+        cache.bad_devices[RECIPIENT][3] = 0
+        self.assertEqual( {}, cache.problems([RECIPIENT]) )
+
+    def test_omemo_prewarm_errors( self ):
+        omemo = FakeOmemo()
+        fetch_bundle = omemo._fetch_bundle
+        async def failing_fetch_bundle( jid, device ):
+            if device == 2:
+                raise RuntimeError("No answer")
+            return await fetch_bundle( jid, device )
+        omemo._fetch_bundle = failing_fetch_bundle
+        cache = OmemoCache( omemo )
+        with self.assertLogs( 'nicobot.jabber', level='WARNING' ) as logs:
+            asyncio.run( cache.prewarm([RECIPIENT]) )
+        # The other devices are still fetched
+        self.assertEqual( { 1:"bundle 1" }, omemo.bundles[RECIPIENT] )
+        self.assertIn( "device 2 of "+RECIPIENT, "\n".join(logs.output) )
+
+        def broken( jid ):
+            raise RuntimeError("Plugin error")
+        omemo.get_device_list = broken
+        with self.assertLogs( 'nicobot.jabber', level='WARNING' ):
+            asyncio.run( cache.prewarm([OTHER]) )
+
+    def test_sender_filter( self ):
+        message = lambda sender, type='chat': Message( sfrom=sender, stype=type )
+        senders = SenderFilter( recipients=[RECIPIENT], rooms=[ROOM] )
+        self.assertTrue( senders.accept( message(RECIPIENT+'/phone') ) )
+        self.assertTrue( senders.accept( message(ROOM+'/carol','groupchat') ) )
+        self.assertFalse( senders.accept( message('room@conference.other.com/carol','groupchat') ) )
+        self.assertFalse( senders.accept( message(RECIPIENT,'error') ) )
+        self.assertFalse( senders.accept( message(OTHER) ) )
+        self.assertEqual( { 'recipient':1, 'room':1, 'ignored_type':1, 'unknown_dropped':2, 'unknown_allowed':0, 'rate_limited':0 }, senders.stats )
+
+        # Each unknown sender has its own budget
+        senders = SenderFilter( recipients=[RECIPIENT], unknown=UNKNOWN_LIMIT, rate=60, burst=2, budgets=2 )
+        self.assertEqual( [True,True,False], [ senders.accept(message(OTHER)) for i in range(3) ] )
+        self.assertTrue( senders.accept(message('carol@example.com')) )
+        self.assertEqual( { 'unknown_allowed':3, 'rate_limited':1 }, { k: senders.stats[k] for k in ('unknown_allowed','rate_limited') } )
+        # The budget is refilled over time
+        tokens, updated = senders.senders[OTHER]
+        senders.senders[OTHER] = ( tokens, updated - 1 )
+        self.assertTrue( senders.accept(message(OTHER)) )
+        # Only the most recent senders are remembered
+        senders.accept(message('dave@example.com'))
+        self.assertEqual( [OTHER,'dave@example.com'], list(senders.senders) )
+
+    def test_filter_before_decryption( self ):
+        dir = tempfile.mkdtemp()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            chatter = JabberChatter( 'bot@example.com', 'password', recipients=[RECIPIENT], data_dir=dir, handler_workers=0 )
+            xmpp = chatter.xmpp
+            decrypted = []
+            omemo = xmpp['xep_0384']
+            omemo.is_encrypted = lambda msg: True
+            omemo.decrypt_message = lambda encrypted, sender, allow_untrusted: decrypted.append(sender.bare) or b"hi"
+            received = []
+            xmpp.message_handler = lambda msg, body: received.append( (msg['from'].bare,body) )
+            for sender in (OTHER,RECIPIENT,'carol@example.com'):
+                loop.run_until_complete( xmpp.message( xmpp.make_message( mto='bot@example.com', mfrom=sender+'/phone', mtype='chat' ) ) )
+            self.assertEqual( [RECIPIENT], decrypted )
+            self.assertEqual( [(RECIPIENT,"hi")], received )
+            self.assertEqual( 2, xmpp.senders.stats['unknown_dropped'] )
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+            shutil.rmtree(dir)
+
+    def test_conversations( self ):
+        dir = tempfile.mkdtemp()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            chatter = JabberChatter( 'bot@example.com', 'password', recipients=[RECIPIENT,OTHER+'/phone'], rooms=[ROOM], data_dir=dir, handler_workers=0 )
+            xmpp = chatter.xmpp
+            encrypted = []
+            async def encrypt( body, recipients ):
+                encrypted.append( (body,sorted(str(r) for r in recipients)) )
+                return Encrypted()
+            xmpp.encrypt = encrypt
+            xmpp.members = lambda room: [ 'carol@example.com', RECIPIENT ]
+            stanzas = []
+            xmpp.send = lambda stanza, *args, **kwargs: stanzas.append(stanza)
+            xmpp.online.set()
+
+            class EchoBot:
+                def onMessage( self, message ):
+                    chatter.send( "echo %s" % message )
+            chatter.bot = EchoBot()
+
+            async def converse():
+                chatter.on_xmpp_message( xmpp.make_message( mto='bot@example.com', mfrom=OTHER+'/laptop', mtype='chat' ), "one" )
+                chatter.on_xmpp_message( xmpp.make_message( mto='bot@example.com', mfrom=ROOM+'/carol', mtype='groupchat' ), "two" )
+                chatter.send("Hello")
+                await asyncio.sleep(0.01)
+            loop.run_until_complete( converse() )
+
+            # Answers go back to where the messages came from
+            self.assertEqual( [ ("echo one",[OTHER]), ("echo two",[RECIPIENT,'carol@example.com']) ], encrypted[:2] )
+            self.assertEqual( [ (OTHER,'chat'), (ROOM,'groupchat') ], [ (s['to'].bare,s['type']) for s in stanzas[:2] ] )
+            # A message to all conversations is encrypted once and sent in one stanza per conversation
+            self.assertEqual( ("Hello",[RECIPIENT,OTHER,'carol@example.com']), encrypted[2] )
+            self.assertEqual( [ (RECIPIENT,'chat'), (OTHER,'chat'), (ROOM,'groupchat') ], [ (s['to'].bare,s['type']) for s in stanzas[2:] ] )
+            self.assertEqual( [ Conversation(RECIPIENT,'chat'), Conversation(OTHER,'chat'), Conversation(ROOM,'groupchat') ], chatter.conversations )
+
+            # Delivery receipts are requested in 1:1 conversations
+            self.assertEqual( [True,False,True,True,False], [ bool(s['request_receipt']) for s in stanzas ] )
+            receipt = xmpp.make_message( mto='bot@example.com', mfrom=OTHER+'/laptop' )
+            receipt['receipt'] = stanzas[0]['id']
+            xmpp.receipt_received(receipt)
+            self.assertEqual( 1, xmpp.delivery['delivered'] )
+            self.assertEqual( 3, xmpp.delivery['requested'] )
+
+            # Unknown senders only get their own answer ; messages from unknown rooms are dropped
+            del encrypted[:]
+            del stanzas[:]
+            async def strangers():
+                chatter.on_xmpp_message( xmpp.make_message( mto='bot@example.com', mfrom='stranger@example.com/phone', mtype='chat' ), "three" )
+                chatter.on_xmpp_message( xmpp.make_message( mto='bot@example.com', mfrom='other@conference.example.com/eve', mtype='groupchat' ), "four" )
+                await asyncio.sleep(0.01)
+            loop.run_until_complete( strangers() )
+            self.assertEqual( [ ("echo three",['stranger@example.com']) ], encrypted )
+            self.assertEqual( [ ('stranger@example.com','chat') ], [ (s['to'].bare,s['type']) for s in stanzas ] )
+
+            loop.run_until_complete( chatter.outbox.stop() )
+            self.assertEqual( 4, chatter.outbox.stats['sent'] )
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+            shutil.rmtree(dir)
+
+    def test_handlers( self ):
+        dir = tempfile.mkdtemp()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            chatter = JabberChatter( 'bot@example.com', 'password', recipients=[RECIPIENT,OTHER], data_dir=dir, handler_workers=2 )
+            self.addCleanup( chatter.executor.shutdown )
+            xmpp = chatter.xmpp
+            handled = []
+            lock = threading.Lock()
+            running = [0]
+            max_running = [0]
+            # The first message of each sender waits for this
+            release = threading.Event()
+            self.addCleanup( release.set )
+            class BlockingBot:
+                def onMessage( self, message ):
+                    with lock:
+                        running[0] += 1
+                        max_running[0] = max( max_running[0], running[0] )
+                    if message == '0':
+                        release.wait(5)
+                    handled.append( (conversation.get().jid,message) )
+                    with lock:
+                        running[0] -= 1
+            chatter.bot = BlockingBot()
+            lag = LagMonitor( interval=0.01 )
+
+            async def until( condition ):
+                while not condition():
+                    await asyncio.sleep(0.01)
+
+            async def receive():
+                lag.start()
+                for i in range(4):
+                    for sender in (RECIPIENT,OTHER):
+                        chatter.on_xmpp_message( xmpp.make_message( mto='bot@example.com', mfrom=sender+'/phone', mtype='chat' ), str(i) )
+                # Both senders are being handled at the same time while the event loop keeps running
+                await until( lambda: running[0] == 2 and lag.stats['samples'] > 0 )
+                self.assertEqual( [], handled )
+                release.set()
+                await until( lambda: len(handled) == 8 )
+                lag.stop()
+            loop.run_until_complete( asyncio.wait_for( receive(), 10 ) )
+
+            # Each sender in order, never more handlers than workers
+            for sender in (RECIPIENT,OTHER):
+                self.assertEqual( ['0','1','2','3'], [ m for s, m in handled if s == sender ] )
+            self.assertEqual( 2, max_running[0] )
+            self.assertEqual( {}, chatter.handling )
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+            shutil.rmtree(dir)
+
+    def test_reconnect( self ):
+        dir = tempfile.mkdtemp()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            xmpp = JabberChatter( 'bot@example.com', 'password', recipients=[RECIPIENT], data_dir=dir ).xmpp
+            delays = []
+            class Loop:
+                def call_later( self, delay, callback ):
+                    delays.append(delay)
+                    callback()
+            xmpp.loop = Loop()
+            xmpp.connect = lambda: None
+            xmpp.online_again()
+            for i in range(10):
+                xmpp.on_disconnected("test")
+            self.assertFalse( xmpp.online.is_set() )
+            # Exponential backoff with jitter
+            for i, delay in enumerate(delays):
+                maximum = min( 2**i, 120 )
+                self.assertTrue( maximum / 2 <= delay <= maximum, (i,delay) )
+            xmpp.session_resumed(None)
+            self.assertTrue( xmpp.online.is_set() )
+            self.assertEqual( 0, xmpp.attempts )
+            self.assertEqual( { 'disconnections':10, 'reconnects':10, 'resumed':1, 'failed_attempts':0 },
+                { k: v for k, v in xmpp.connection.items() if 'downtime' not in k } )
+            self.assertGreater( xmpp.connection['total_downtime'], 0 )
+            # No reconnection when stopping on purpose
+            xmpp.stopping = True
+            xmpp.on_disconnected("test")
+            self.assertEqual( 10, len(delays) )
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+            shutil.rmtree(dir)
+
+
+
+class TestFakeXmpp(unittest.TestCase):
+
+    def setUp( self ):
+        self.server = FakeXmpp( accounts={ 'bot@localhost':'password', 'me@localhost':'secret' } ).start()
+        self.dir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.clients = []
+
+    def tearDown( self ):
+        for client in self.clients:
+            client.abort()
+        # The clients' tasks would complain when the loop is closed
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete( asyncio.gather( *tasks, return_exceptions=True ) )
+        self.server.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.dir)
+
+    def client( self, jid, password, plugins=[] ):
+        """
+            Returns a plain slixmpp client, connecting
+        """
+        client = ClientXMPP( jid, password )
+        for plugin in plugins:
+            client.register_plugin(plugin)
+        client['feature_mechanisms'].unencrypted_plain = True
+        client.started = asyncio.Event()
+        client.add_event_handler( 'session_start', lambda event: client.started.set() )
+        client.add_event_handler( 'failed_auth', lambda event: client.started.set() )
+        client.connect( self.server.address, force_starttls=False, disable_starttls=True )
+        self.clients.append(client)
+        return client
+
+    def wait( self, condition, timeout=5 ):
+        async def waiting():
+            while not condition():
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete( asyncio.wait_for( waiting(), timeout ) )
+
+    def test_pep( self ):
+        alice = self.client( 'bot@localhost', 'password', ['xep_0060'] )
+        bob = self.client( 'me@localhost', 'secret', ['xep_0060'] )
+        intruder = self.client( 'me@localhost', 'wrong' )
+        self.wait( lambda: alice.started.is_set() and bob.started.is_set() and intruder.started.is_set() )
+        self.assertEqual( 1, self.server.stats['auth_failures'] )
+        self.assertEqual( 2, self.server.stats['sessions'] )
+
+        events = []
+        bob.add_event_handler( 'pubsub_publish', lambda msg: events.append( msg['pubsub_event']['items']['node'] ) )
+        async def publish():
+            item = ET.Element('{urn:test}keys')
+            item.text = "42"
+            await alice['xep_0060'].publish( 'bot@localhost', 'keys', id='current', payload=item )
+            return await bob['xep_0060'].get_items( 'bot@localhost', 'keys' )
+        items = self.loop.run_until_complete( publish() )
+        self.assertEqual( "42", items['pubsub']['items']['substanzas'][0]['payload'].text )
+        self.wait( lambda: events )
+        self.assertEqual( ['keys'], events )
+        with self.assertRaises(IqError):
+            self.loop.run_until_complete( bob['xep_0060'].get_items( 'bot@localhost', 'missing' ) )
+
+    def test_chatter( self ):
+        chatter = JabberChatter( 'bot@localhost', 'password', recipients=['me@localhost'], data_dir=self.dir,
+            server='127.0.0.1:%d' % self.server.port, tls=False )
+        # The installed OMEMO library may not be usable here : encryption is only checked by its result
+        async def encrypt( body, recipients ):
+            encrypted = Encrypted()
+            encrypted['payload']['value'] = body
+            return encrypted
+        chatter.xmpp.encrypt = encrypt
+        chatter.connect()
+        self.clients.append(chatter.xmpp)
+        me = self.client( 'me@localhost', 'secret', ['xep_0184'] )
+        received = []
+        # Without the OMEMO plugin, messages without a body are only seen by a handler of their own
+        me.register_handler( Callback( 'Encrypted', MatchXPath('{jabber:client}message/{%s}encrypted' % SliXmppClient.eme_ns), received.append ) )
+        self.wait( lambda: me.started.is_set() )
+
+        class EchoBot:
+            def onMessage( self, message ):
+                chatter.send( "echo %s" % message )
+        chatter.bot = EchoBot()
+        me.make_message( mto='bot@localhost', mbody="hello", mtype='chat' ).send()
+        me.make_message( mto='bot@localhost', mbody="spam", mtype='headline' ).send()
+        self.wait( lambda: received and chatter.xmpp.delivery['delivered'] )
+
+        self.assertEqual( "echo hello", received[0]['omemo_encrypted']['payload']['value'] )
+        self.assertEqual( 'bot@localhost', received[0]['from'].bare )
+        self.assertEqual( 1, chatter.xmpp.senders.stats['recipient'] )
+        self.assertEqual( 1, chatter.xmpp.senders.stats['ignored_type'] )
+        self.loop.run_until_complete( chatter.outbox.stop() )
+        chatter.executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from nicobot.keywords import KeywordIndex
+
+
+class TestKeywordIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = KeywordIndex()
+        self.index.add("Hello",keyword="hello",language="en")
+        self.index.add("Hallo?",keyword="hello",language="de")
+        self.index.add("ハロー",keyword="hello",language="ja")
+        self.index.add("สวัสดี",keyword="hello",language="th")
+        self.index.add("Goodbye")
+
+    def test_whole_words_only(self):
+        match = self.index.search("Oh HELLO there")
+        self.assertEqual( "hello", match.keyword )
+        self.assertEqual( "en", match.language )
+        self.assertIsNone( self.index.search("Othello") )
+        self.assertIsNone( self.index.search("hellos") )
+
+    def test_punctuation_is_ignored(self):
+        match = self.index.search("Hallo, Welt")
+        self.assertEqual( "de", match.language )
+        self.assertEqual( "Hallo?", match.variant )
+
+    def test_scripts_without_spaces(self):
+        self.assertEqual( "ja", self.index.search("ハローさん").language )
+        self.assertEqual( "th", self.index.search("สวัสดีครับ").language )
+
+    def test_keyword_defaults_to_variant(self):
+        match = self.index.search("goodbye everyone")
+        self.assertEqual( "Goodbye", match.keyword )
+        self.assertIsNone( match.language )
+
+    def test_finditer(self):
+        found = [ m.language for m in self.index.finditer("hello and hallo") ]
+        self.assertEqual( ["en","de"], found )
+
+    def test_concurrent_first_searches(self):
+        found = []
+        barrier = threading.Barrier(8)
+        def search():
+            barrier.wait()
+            found.append( self.index.search("Hallo, Welt").keyword )
+        threads = [ threading.Thread(target=search) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual( ["hello"] * 8, found )
+
+    def test_empty_index(self):
+        self.assertIsNone( KeywordIndex().search("hello") )
+
+
+if __name__ == '__main__':
+    unittest.main()
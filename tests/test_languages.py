@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from nicobot.languages import LanguageIndex, FlagTable, DEFAULT_FLAG, fold
+
+
+LANGUAGES = [
+    { 'language': 'de', 'name': 'German' },
+    { 'language': 'en', 'name': 'English' },
+    { 'language': 'es', 'name': 'Spanish' },
+    { 'language': 'fr', 'name': 'French' },
+    { 'language': 'zh', 'name': 'Chinese (Simplified)' },
+    { 'language': 'zh-TW', 'name': 'Chinese (Traditional)' },
+]
+
+LANGUAGES_FR = [
+    { 'language': 'de', 'name': 'Allemand' },
+    { 'language': 'en', 'name': 'Anglais' },
+    { 'language': 'es', 'name': 'Espagnol' },
+    { 'language': 'fr', 'name': 'Français' },
+    { 'language': 'xx', 'name': 'Unknown' },
+]
+
+
+class TestLanguageIndex(unittest.TestCase):
+
+    def setUp( self ):
+        self.index = LanguageIndex( LANGUAGES )
+        self.index.addNames( LANGUAGES_FR )
+
+    def test_fold( self ):
+        self.assertEqual( 'francais', fold(' FRANÇAIS ') )
+
+    def test_codes( self ):
+        self.assertEqual( 'fr', self.index.resolve('fr') )
+        self.assertEqual( 'zh-TW', self.index.resolve('ZH-tw') )
+
+    def test_names( self ):
+        self.assertEqual( 'de', self.index.resolve('german') )
+        self.assertEqual( 'de', self.index.resolve('Allemand') )
+        self.assertEqual( 'fr', self.index.resolve('francais') )
+        self.assertIsNone( self.index.resolve('Unknown') )
+
+    def test_aliases( self ):
+        self.assertEqual( 'es', self.index.resolve('Castellano') )
+        self.assertEqual( 'zh', self.index.resolve('Mandarin') )
+        # Aliases of languages that are not known are ignored
+        self.assertIsNone( self.index.resolve('Farsi') )
+
+    def test_prefix( self ):
+        self.assertEqual( 'es', self.index.resolve('span') )
+        self.assertEqual( 'zh-TW', self.index.resolve('chinese (trad') )
+        # Too short to be looked up as a prefix
+        self.assertIsNone( self.index.resolve('g') )
+
+    def test_fuzzy( self ):
+        self.assertEqual( 'de', self.index.resolve('Germna') )
+        self.assertIsNone( self.index.resolve('Klingon') )
+
+
+
+LIKELY_SUBTAGS = { 'supplemental': { 'likelySubtags': { 'fr': 'fr-Latn-FR', 'ja': 'ja-Jpan-JP' } } }
+
+
+class TestFlagTable(unittest.TestCase):
+
+    def test_likely_subtags( self ):
+        flags = FlagTable()
+        flags.update( ['fr','ja'], LIKELY_SUBTAGS )
+        self.assertTrue( flags.covers(['fr','ja']) )
+        self.assertEqual( ('JP','🇯🇵'), tuple(flags.lookup('ja')) )
+
+    def test_fallback( self ):
+        flags = FlagTable()
+        flags.update( ['zh-TW'], None )
+        self.assertEqual( 'TW', flags.country('zh-TW') )
+        self.assertEqual( DEFAULT_FLAG, flags.flag('x') )
+        # Unknown languages are memoized but not part of the table
+        self.assertFalse( flags.covers(['x']) )
+        self.assertIn( 'x', flags.fallbacks )
+
+    def test_save_load( self ):
+        flags = FlagTable()
+        flags.update( ['fr'], LIKELY_SUBTAGS )
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir,'languages.en.flags.json')
+            flags.save(file)
+            loaded = FlagTable()
+            self.assertTrue( loaded.load(file) )
+            self.assertEqual( '🇫🇷', loaded.flag('fr') )
+            self.assertFalse( FlagTable().load(os.path.join(dir,'missing.json')) )
+
+
+if __name__ == '__main__':
+    unittest.main()
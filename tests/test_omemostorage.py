@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from omemo.implementations import JSONFileStorage
+
+from nicobot.omemostorage import SQLiteStorage, storage, STORAGE_JSON, STORAGE_SQLITE, SQLITE_FILE
+
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+
+
+async def fill( storage ):
+    await storage.storeOwnData( 'bot@example.com', 42 )
+    await storage.storeState( { 'keys': [1,2,3] } )
+    for jid in (ALICE,BOB):
+        await storage.storeActiveDevices( jid, [1,2] )
+        await storage.storeInactiveDevices( jid, { 3: 1600000000 } )
+        for device in (1,2):
+            await storage.storeSession( jid, device, { 'session': "%s/%d" % (jid,device) } )
+            await storage.storeTrust( jid, device, { 'key': "key%d" % device, 'trusted': True } )
+
+
+async def dump( storage ):
+    data = [ await storage.loadOwnData(), await storage.loadState() ]
+    for jid in (ALICE,BOB):
+        data += [
+            await storage.loadActiveDevices(jid),
+            await storage.loadInactiveDevices(jid),
+            await storage.loadSessions(jid,[1,2,3]),
+            await storage.loadTrusts(jid,[1,2,3]),
+            ]
+    return data
+
+
+class TestOmemoStorage(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def test_sqlite( self ):
+        sqlite = SQLiteStorage( os.path.join(self.dir,SQLITE_FILE) )
+        self.assertIsNone( asyncio.run( sqlite.loadOwnData() ) )
+        self.assertEqual( set(), asyncio.run( sqlite.loadActiveDevices(ALICE) ) )
+        asyncio.run( fill(sqlite) )
+        data = asyncio.run( dump(sqlite) )
+        self.assertEqual( { 'own_bare_jid': 'bot@example.com', 'own_device_id': 42 }, data[0] )
+        self.assertEqual( { 1: { 'session': ALICE+"/1" }, 2: { 'session': ALICE+"/2" }, 3: None }, data[4] )
+        self.assertEqual( { 3: 1600000000 }, data[3] )
+
+        asyncio.run( sqlite.deleteSession(ALICE,1) )
+        self.assertIsNone( asyncio.run( sqlite.loadSession(ALICE,1) ) )
+        asyncio.run( sqlite.deleteJID(BOB) )
+        self.assertEqual( [ JSONFileStorage.getHashForBareJID(ALICE) ], asyncio.run( sqlite.listJIDs() ) )
+        sqlite.close()
+
+        # Everything is still there after a restart
+        sqlite = SQLiteStorage( os.path.join(self.dir,SQLITE_FILE) )
+        self.assertEqual( { 'session': ALICE+"/2" }, asyncio.run( sqlite.loadSession(ALICE,2) ) )
+        sqlite.close()
+
+    def test_migrate( self ):
+        asyncio.run( fill( JSONFileStorage(self.dir) ) )
+        # Written by slixmpp_omemo itself, not by the storage
+        with open( os.path.join(self.dir,'device_id.json'), 'w' ) as f:
+            f.write("42")
+        expected = asyncio.run( dump( JSONFileStorage(self.dir) ) )
+
+        sqlite = storage( STORAGE_SQLITE, self.dir )
+        self.assertEqual( expected, asyncio.run( dump(sqlite) ) )
+        # Only once
+        asyncio.run( sqlite.storeSession( ALICE, 1, { 'session': "new" } ) )
+        self.assertEqual( 0, sqlite.migrate(self.dir) )
+        self.assertEqual( { 'session': "new" }, asyncio.run( sqlite.loadSession(ALICE,1) ) )
+        sqlite.close()
+
+        self.assertIsNone( storage( STORAGE_JSON, self.dir ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
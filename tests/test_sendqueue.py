@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+import threading
+import time
+import unittest
+
+from nicobot.sendqueue import SendQueue, AsyncSendQueue, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def setUp( self ):
+        self.sent = []
+        # Blocks the sender until released, to fill the queue
+        self.release = threading.Event()
+
+    def send( self, message, conversation ):
+        self.release.wait()
+        self.sent.append( (conversation,message) )
+
+    def test_order( self ):
+        self.release.set()
+        queue = SendQueue( self.send )
+        for i in range(20):
+            queue.put( str(i), conversation=i%3 )
+        queue.stop()
+        self.assertEqual( [ (i%3,str(i)) for i in range(20) ], self.sent )
+        self.assertEqual( 20, queue.stats['sent'] )
+
+    def fill( self, queue ):
+        queue.put("first")
+        # Waits for the sender to take the first message
+        while not queue.sending:
+            time.sleep(0.001)
+        return [ queue.put(m) for m in ("a","b","c") ]
+
+    def test_drop_newest( self ):
+        queue = SendQueue( self.send, size=2, overflow=OVERFLOW_DROP_NEWEST )
+        self.assertEqual( [True,True,False], self.fill(queue) )
+        self.release.set()
+        queue.stop()
+        self.assertEqual( ["first","a","b"], [ m for c, m in self.sent ] )
+        self.assertEqual( 1, queue.stats['dropped'] )
+
+    def test_drop_oldest( self ):
+        queue = SendQueue( self.send, size=2, overflow=OVERFLOW_DROP_OLDEST )
+        self.assertEqual( [True,True,True], self.fill(queue) )
+        self.release.set()
+        queue.stop()
+        self.assertEqual( ["first","b","c"], [ m for c, m in self.sent ] )
+
+    def test_coalesce( self ):
+        self.release.set()
+        queue = SendQueue( self.send, coalesce_window=0.2 )
+        queue.put( "Hello", conversation='alice' )
+        queue.put( "world", conversation='alice' )
+        queue.put( "Hi", conversation='bob' )
+        queue.put( "again", conversation='alice' )
+        queue.stop()
+        self.assertEqual( [ ('alice',"Hello\nworld"), ('bob',"Hi"), ('alice',"again") ], self.sent )
+        self.assertEqual( 1, queue.stats['coalesced'] )
+
+
+
+class TestAsyncSendQueue(unittest.TestCase):
+
+    def test_order( self ):
+        sent = []
+        sending = []
+        rand = random.Random(0)
+        async def send( message, conversations ):
+            sending.append(message)
+            self.assertLessEqual( len(sending), 3 )
+            await asyncio.sleep( rand.random() / 100 )
+            sending.remove(message)
+            sent.extend( (c,message) for c in conversations )
+        async def run():
+            queue = AsyncSendQueue( send, size=5, workers=3 )
+            queue.start()
+            for i in range(30):
+                await queue.put( i, conversations=[i%4] )
+            # Sent to several conversations at once, after the previous messages to them
+            await queue.put( 'all', conversations=[0,1,2,3] )
+            await queue.put( 30, conversations=[0] )
+            await queue.stop()
+            return queue
+        queue = asyncio.run( run() )
+        for c in range(4):
+            self.assertEqual( [ i for i in range(30) if i%4 == c ] + ['all'] + ([30] if c == 0 else []), [ m for d, m in sent if d == c ] )
+        self.assertEqual( 32, queue.stats['sent'] )
+        self.assertEqual( 0, queue.stats['dropped'] )
+
+    def test_drain_timeout( self ):
+        async def send( message, conversations ):
+            await asyncio.sleep(10)
+        async def run():
+            queue = AsyncSendQueue( send, workers=1, overflow=OVERFLOW_DROP_NEWEST, size=2 )
+            queue.start()
+            results = [ await queue.put("first") ]
+            await asyncio.sleep(0.01)
+            results += [ await queue.put(str(i)) for i in range(3) ]
+            await queue.stop( timeout=0.05 )
+            return queue, results
+        queue, results = asyncio.run( run() )
+        # One message is being sent, two are waiting : the last one doesn't fit
+        self.assertEqual( [True,True,True,False], results )
+        self.assertEqual( 0, queue.stats['sent'] )
+        self.assertEqual( 3, queue.stats['dropped'] + queue.stats['errors'] )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from nicobot.signalcli import SignalChatter, SignalCliDaemon, SignalCliError, ReceiveCursor, EnvelopeFilter, ReceiveScheduler
+
+
+FAKE_SIGNAL_CLI = os.path.join( os.path.dirname(__file__), 'fake-signal-cli' )
+
+USERNAME = '+33100000000'
+RECIPIENT = '+33200000000'
+
+
+class EchoBot:
+
+    def __init__( self, chatter ):
+        self.chatter = chatter
+        self.received = []
+
+    def onMessage( self, message ):
+        self.received.append(message)
+        if message == 'bye':
+            self.chatter.stop()
+        else:
+            self.chatter.send( "echo %s" % message )
+
+
+class TestSignalCli(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.inbox = os.path.join(self.dir,'inbox')
+        os.makedirs(self.inbox)
+        self.outbox = os.path.join(self.dir,'outbox.jsonl')
+        self.environ = dict(os.environ)
+        os.environ['FAKE_SIGNAL_INBOX'] = self.inbox
+        os.environ['FAKE_SIGNAL_OUTBOX'] = self.outbox
+        os.environ['FAKE_SIGNAL_LOCK'] = os.path.join(self.dir,'account.lock')
+        self.count = 0
+        self.timestamp = 0
+
+    def tearDown( self ):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def receive( self, message, source=RECIPIENT, group=None, timestamp=None ):
+        """
+            Makes the fake signal-cli receive a message
+        """
+        self.count += 1
+        if timestamp is None:
+            # Like Signal, each message has a distinct timestamp
+            self.timestamp = timestamp = max( int(time.time()*1000), self.timestamp + 1 )
+        groupInfo = { 'groupId':group, 'type':'DELIVER' } if group else None
+        event = { 'envelope': { 'source':source, 'sourceDevice':1, 'timestamp':timestamp, 'dataMessage':{ 'message':message, 'groupInfo':groupInfo } } }
+        tmp = os.path.join(self.dir,'event.json')
+        with open(tmp,'w') as f:
+            json.dump(event,f)
+        os.rename( tmp, os.path.join(self.inbox,'%06d.json' % self.count) )
+
+    def sent( self ):
+        if not os.path.exists(self.outbox):
+            return []
+        with open(self.outbox,'r') as f:
+            return [ json.loads(l) for l in f ]
+
+    def waitFor( self, condition, timeout=5 ):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timeout")
+            time.sleep(0.01)
+
+    def test_daemon_requests( self ):
+        notifications = []
+        daemon = SignalCliDaemon( USERNAME, signal_cli=FAKE_SIGNAL_CLI, restart_delay=0.01,
+            on_notification=lambda method, params: notifications.append((method,params)) ).start()
+        try:
+            result = daemon.request( 'send', { 'recipient':[RECIPIENT], 'message':"Hello" } )
+            self.assertIn( 'timestamp', result )
+            self.assertEqual( [{ 'recipient':[RECIPIENT], 'message':"Hello" }], self.sent() )
+            with self.assertRaises(SignalCliError):
+                daemon.request( 'unknownMethod' )
+
+            self.receive("Hi")
+            self.waitFor( lambda: len(notifications) == 1 )
+            self.assertEqual( 'receive', notifications[0][0] )
+            self.assertEqual( "Hi", notifications[0][1]['envelope']['dataMessage']['message'] )
+
+            # The process is restarted after a crash
+            with self.assertRaises(SignalCliError):
+                daemon.request( 'send', { 'recipient':[RECIPIENT], 'message':"crash" } )
+            self.waitFor( lambda: daemon.stats['restarts'] == 1 )
+            self.waitFor( lambda: self._requestWorks(daemon) )
+        finally:
+            daemon.stop()
+
+    def _requestWorks( self, daemon ):
+        try:
+            daemon.request( 'send', { 'recipient':[RECIPIENT], 'message':"Again" } )
+            return True
+        except SignalCliError:
+            return False
+
+    def test_chatter_daemon( self ):
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, daemon=True )
+        try:
+            self.converse(chatter)
+        finally:
+            chatter.daemon.stop()
+
+    def test_chatter_stream( self ):
+        # The 'receive' process would keep the account locked, so answers could not be sent
+        with self.assertRaises(ValueError):
+            SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=-1 )
+
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=-1, stealth=True )
+        bot = EchoBot(chatter)
+        thread = threading.Thread( target=chatter.start, args=(bot,) )
+        thread.start()
+        try:
+            self.waitFor( lambda: chatter.cursor.timestamp is not None )
+            time.sleep(0.01)
+            self.receive("one")
+            self.receive("not for me", source='+33300000000')
+            self.receive("bye")
+            thread.join(timeout=5)
+            self.assertFalse( thread.is_alive() )
+            self.assertEqual( ["one","bye"], bot.received )
+            # The message from an unknown source was discarded before being parsed
+            self.assertEqual( 2, chatter.stats['received'] )
+            self.assertEqual( 1, chatter.envelopes.stats['unknown_conversation'] )
+            # Nothing was sent in stealth mode
+            self.assertEqual( [], self.sent() )
+        finally:
+            chatter.stop()
+        # The receive process was stopped
+        self.waitFor( lambda: chatter.receiver is None )
+
+    def converse( self, chatter ):
+        """
+            Runs an EchoBot with the given chatter until it receives 'bye'
+        """
+        bot = EchoBot(chatter)
+        chatter.connect()
+        thread = threading.Thread( target=chatter.start, args=(bot,) )
+        thread.start()
+        try:
+            self.waitFor( lambda: chatter.cursor.timestamp is not None )
+            # Messages sent before the chatter started are discarded
+            time.sleep(0.01)
+            self.receive("one")
+            self.receive("not for me", source='+33300000000')
+            self.receive("two")
+            self.receive("bye")
+            thread.join(timeout=5)
+            self.assertFalse( thread.is_alive() )
+            self.assertEqual( ["one","two","bye"], bot.received )
+            chatter.outbox.flush(timeout=5)
+            self.assertEqual( ["echo one","echo two"], [ s['message'] for s in self.sent() ] )
+            self.assertEqual( [RECIPIENT], self.sent()[0]['recipient'] )
+        finally:
+            chatter.stop()
+
+    def test_conversations( self ):
+        other = '+33300000000'
+        group = 'mABCDNVoEFGz0YeZM1234Q=='
+        chatter = SignalChatter( USERNAME, recipients=[RECIPIENT,other], groups=[group], signal_cli=FAKE_SIGNAL_CLI )
+        bot = EchoBot(chatter)
+        chatter.bot = bot
+        try:
+            chatter.send("Hello")
+            self.receive("one")
+            self.receive("two", source=other)
+            self.receive("three", source='+33400000000', group=group)
+            self.receive("unknown source", source='+33400000000')
+            self.receive("unknown group", group='xxxx')
+            chatter.filterMessages( chatter.pollMessages(timeout=0.1) )
+            chatter.outbox.flush(timeout=5)
+            sent = self.sent()
+            # The greeting goes to all conversations
+            self.assertEqual( [ {'recipient':[RECIPIENT],'message':"Hello"}, {'recipient':[other],'message':"Hello"}, {'groupId':group,'message':"Hello"} ], sent[:3] )
+            # Answers go back to where the messages came from
+            self.assertEqual( [ {'recipient':[RECIPIENT],'message':"echo one"}, {'recipient':[other],'message':"echo two"}, {'groupId':group,'message':"echo three"} ], sent[3:] )
+        finally:
+            chatter.close()
+
+    def test_chatter_processes( self ):
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=0.1 )
+        bot = EchoBot(chatter)
+        chatter.bot = bot
+        self.receive("one")
+        chatter.filterMessages( chatter.pollMessages() )
+        self.assertEqual( ["one"], bot.received )
+        chatter.close()
+        self.assertEqual( [{ 'recipient':[RECIPIENT], 'message':"echo one" }], self.sent() )
+
+    def test_receive_command( self ):
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=0 )
+        try:
+            with mock.patch( 'subprocess.Popen', wraps=subprocess.Popen ) as popen:
+                chatter.pollMessages()
+                chatter.pollMessages( timeout=0.1 )
+            # A timeout of 0 is given too, otherwise signal-cli would use its own default
+            self.assertEqual( [
+                [ FAKE_SIGNAL_CLI, "-u", USERNAME, "receive", "--json", "-t", "0" ],
+                [ FAKE_SIGNAL_CLI, "-u", USERNAME, "receive", "--json", "-t", "0.1" ],
+                ], [ call.args[0] for call in popen.call_args_list ] )
+        finally:
+            chatter.close()
+
+    def test_cursor( self ):
+        file = os.path.join(self.dir,'cursor.json')
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=0.1, cursor_file=file )
+        bot = EchoBot(chatter)
+        chatter.bot = bot
+        self.receive("one", timestamp=1000)
+        self.receive("two", timestamp=2000)
+        chatter.filterMessages( chatter.pollMessages() )
+        chatter.close()
+        self.assertEqual( ["one","two"], bot.received )
+
+        # After a restart, the same messages are skipped but late ones are still accepted
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=0.1, cursor_file=file )
+        bot = EchoBot(chatter)
+        chatter.bot = bot
+        chatter.cursor.start()
+        self.receive("two", timestamp=2000)
+        self.receive("late", timestamp=1500)
+        self.receive("three", timestamp=3000)
+        self.receive("too old", timestamp=3000 - 61000)
+        chatter.filterMessages( chatter.pollMessages() )
+        chatter.close()
+        self.assertEqual( ["late","three"], bot.received )
+        self.assertEqual( 1, chatter.cursor.stats['duplicates'] )
+        self.assertEqual( 1, chatter.cursor.stats['too_old'] )
+
+    def test_envelope_filter( self ):
+        group = 'mABCDNVoEFGz0YeZM1234Q=='
+        envelopes = EnvelopeFilter( recipients={RECIPIENT:None}, groups={group:None} )
+        lines = [
+            { 'envelope': { 'source':RECIPIENT, 'timestamp':1, 'receiptMessage':{ 'isDelivery':True } } },
+            { 'envelope': { 'source':RECIPIENT, 'timestamp':2, 'dataMessage':None, 'typingMessage':{ 'action':'STARTED' } } },
+            { 'envelope': { 'source':RECIPIENT, 'timestamp':3, 'dataMessage':{ 'message':None, 'attachments':[{}] } } },
+            { 'envelope': { 'source':'+33300000000', 'timestamp':4, 'dataMessage':{ 'message':"Hi" } } },
+            { 'envelope': { 'source':'+33300000000', 'timestamp':5, 'dataMessage':{ 'message':"Hi", 'groupInfo':{ 'groupId':'xxxx' } } } },
+            { 'envelope': { 'source':'+33300000000', 'timestamp':6, 'dataMessage':{ 'message':"Hi", 'groupInfo':{ 'groupId':group } } } },
+            { 'envelope': { 'source':RECIPIENT, 'timestamp':7, 'dataMessage':{ 'message':'"source":"+33300000000"' } } },
+            ]
+        events = [ envelopes.parse( (json.dumps(l)+"\n").encode('utf-8') ) for l in lines ]
+        events.append( envelopes.parse(b'{"envelope":{"dataMessage":{"message":"truncated\n') )
+        self.assertEqual( [ None, None, None, None, None, lines[5], lines[6], None ], events )
+        self.assertEqual( { 'lines':8, 'parsed':2, 'invalid':1, 'no_data':2, 'no_text':1, 'unknown_conversation':2 }, envelopes.stats )
+
+    def test_dedup_window( self ):
+        cursor = ReceiveCursor( window=2 )
+        envelopes = [ { 'source':RECIPIENT, 'sourceDevice':1, 'timestamp':t } for t in (1,2,3) ]
+        for envelope in envelopes:
+            self.assertTrue( cursor.accept(envelope) )
+            cursor.commit(envelope)
+            self.assertFalse( cursor.accept(envelope) )
+        # The oldest one was forgotten
+        self.assertEqual( 2, len(cursor.seen) )
+        self.assertNotIn( (RECIPIENT,1,1), cursor.seen )
+
+    def test_receive_scheduler( self ):
+        scheduler = ReceiveScheduler( 5, 30 )
+        timeouts = []
+        for events in ( [], [], [], [], [{ 'envelope':{ 'timestamp':(time.time()-2)*1000 } }], [] ):
+            list( scheduler.watch(events) )
+            timeouts.append( scheduler.timeout )
+        # Longer while idle, shorter as soon as messages come
+        self.assertEqual( [10,20,30,30,5,10], timeouts )
+        self.assertEqual( 6, scheduler.stats['polls'] )
+        self.assertEqual( 5, scheduler.stats['empty_polls'] )
+        self.assertAlmostEqual( 2, scheduler.averageDelay(), delta=0.5 )
+
+        # Without a shortest timeout, idle polls still get longer
+        scheduler = ReceiveScheduler( 0, 30 )
+        list( scheduler.watch([]) )
+        self.assertEqual( 1, scheduler.timeout )
+        scheduler.reset()
+        self.assertEqual( 0, scheduler.timeout )
+
+    def test_chatter_polling( self ):
+        for timeout in ( 0.05, 0 ):
+            with self.subTest(timeout=timeout):
+                self.poll( timeout )
+
+    def poll( self, timeout ):
+        if os.path.exists(self.outbox):
+            os.remove(self.outbox)
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=timeout, receive_timeout_max=0.2 )
+        bot = EchoBot(chatter)
+        thread = threading.Thread( target=chatter.start, args=(bot,) )
+        thread.start()
+        try:
+            # Waits longer and longer while idle
+            self.waitFor( lambda: chatter.scheduler.stats['empty_polls'] >= 2 )
+            self.assertGreater( chatter.scheduler.timeout, timeout )
+            self.receive("one")
+            self.receive("bye")
+            thread.join(timeout=5)
+            self.assertFalse( thread.is_alive() )
+            self.assertEqual( ["one","bye"], bot.received )
+            self.assertEqual( 2, chatter.scheduler.stats['messages'] )
+        finally:
+            chatter.close()
+        # The answer was sent once the 'receive' command had released the account
+        self.assertEqual( [{ 'recipient':[RECIPIENT], 'message':"echo one" }], self.sent() )
+
+    def test_answers_after_receive( self ):
+        chatter = SignalChatter( USERNAME, recipient=RECIPIENT, signal_cli=FAKE_SIGNAL_CLI, receive_timeout=0.5, receive_timeout_max=0.5 )
+        bot = EchoBot(chatter)
+        thread = threading.Thread( target=chatter.start, args=(bot,) )
+        thread.start()
+        try:
+            # Messages come at the beginning of a poll : the answer must still wait for the end of the 'receive' command
+            self.waitFor( lambda: chatter.receiver is not None )
+            self.receive("one")
+            self.waitFor( lambda: self.sent() )
+            self.receive("bye")
+            thread.join(timeout=5)
+            self.assertFalse( thread.is_alive() )
+        finally:
+            chatter.close()
+        self.assertEqual( [{ 'recipient':[RECIPIENT], 'message':"echo one" }], self.sent() )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import i18n
+
+from nicobot.glossary import GlossaryTranslator
+from nicobot.keywords import KeywordMatch
+from nicobot.translator import Translator
+from nicobot.transbot import TransBot
+
+
+GLOSSARY = 'tests/fixtures/glossary.json'
+
+LIKELY_SUBTAGS = { 'supplemental': { 'likelySubtags': {
+    'de': 'de-Latn-DE', 'en': 'en-Latn-US', 'es': 'es-Latn-ES', 'fr': 'fr-Latn-FR', 'it': 'it-Latn-IT', 'ja': 'ja-Jpan-JP' } } }
+
+
+class RecordingTranslator(GlossaryTranslator):
+    """
+        Keeps the requests sent to the translation service
+    """
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self.requests = []
+
+    def translate( self, messages, target, source=None ):
+        self.requests.append( (target,list(messages)) )
+        return super().translate( messages, target=target, source=source )
+
+
+class ScriptedTranslator(Translator):
+    """
+        Answers with a fixed translation (or None) for each target language ;
+        translations into the 'blocked' languages wait until 'release' is set
+    """
+
+    def __init__( self, answers, blocked=[] ):
+        self.answers = answers
+        self.blocked = blocked
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+    def translate( self, messages, target, source=None ):
+        with self.lock:
+            self.started.append(target)
+            self.running += 1
+            self.max_running = max(self.max_running,self.running)
+        try:
+            if target in self.blocked:
+                self.release.wait(5)
+            answer = self.answers.get(target)
+            return { 'translations': [ {'translation':answer} ] } if answer else None
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def identifiableLanguages( self ):
+        return { 'languages': [ { 'language':code, 'name':code } for code in self.answers ] }
+
+
+class RecordingChatter:
+    """
+        Keeps the messages sent by the bot
+    """
+
+    def __init__( self ):
+        self.sent = []
+
+    def send( self, message ):
+        self.sent.append(message)
+
+    def stop( self ):
+        pass
+
+
+class TestTransBot(unittest.TestCase):
+
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, self.dir )
+        self.likely = os.path.join(self.dir,'likelySubtags.json')
+        with open(self.likely,'w') as f:
+            json.dump(LIKELY_SUBTAGS,f)
+        self.flags = os.path.join(self.dir,'languages.en.flags.json')
+        i18n.add_translation( 'all_messages', r'%{message}' )
+
+    def bot( self, translator=None, **kwargs ):
+        translator = translator or GlossaryTranslator(file=GLOSSARY)
+        kwargs.setdefault( 'languages', translator.identifiableLanguages()['languages'] )
+        kwargs.setdefault( 'languages_likely', self.likely )
+        bot = TransBot( RecordingChatter(), None, None, locale=['en'], translator=translator, **kwargs )
+        self.addCleanup( bot.executor.shutdown )
+        return bot
+
+    def readJson( self, file ):
+        with open(file,'r') as f:
+            return json.load(f)
+
+
+class TestFlags(TestTransBot):
+
+    def test_built( self ):
+        bot = self.bot( flags_file=self.flags )
+        self.assertEqual( 'JP', bot.languageToCountry('ja') )
+        self.assertEqual( ['US','🇺🇸'], self.readJson(self.flags)['en'] )
+
+    def test_cached( self ):
+        with open(self.flags,'w') as f:
+            json.dump( { l:['XX','🏳'] for l in ('de','en','es','fr','it','ja') }, f )
+        os.remove(self.likely)
+        with mock.patch( 'urllib.request.urlopen', side_effect=OSError("offline") ) as urlopen:
+            bot = self.bot( flags_file=self.flags )
+        urlopen.assert_not_called()
+        self.assertEqual( 'XX', bot.languageToCountry('fr') )
+
+    def test_download_failed( self ):
+        os.remove(self.likely)
+        with mock.patch( 'urllib.request.urlopen', side_effect=OSError("offline") ):
+            bot = self.bot( flags_file=self.flags )
+        # Guessed from the code only
+        self.assertEqual( 'ja', bot.languageToCountry('ja') )
+        self.assertFalse( os.path.exists(self.flags) )
+
+        # Built again on the next start
+        with open(self.likely,'w') as f:
+            json.dump(LIKELY_SUBTAGS,f)
+        bot = self.bot( flags_file=self.flags )
+        self.assertEqual( 'JP', bot.languageToCountry('ja') )
+        self.assertEqual( 'JP', self.readJson(self.flags)['ja'][0] )
+
+
+class TestKeywords(TestTransBot):
+
+    def setUp( self ):
+        super().setUp()
+        self.keywords = os.path.join(self.dir,'keywords.json')
+        self.translator = RecordingTranslator(file=GLOSSARY)
+
+    def languages( self, *codes ):
+        return [ { 'language':code, 'name':code } for code in codes ]
+
+    def test_batched( self ):
+        self.bot( translator=self.translator, languages=self.languages('fr','es'),
+            keywords=['Hello','cat','Hello'], keywords_files=[self.keywords], keywords_rate=None )
+        # One request per language, without duplicates
+        self.assertEqual( [ ('es',['Hello','cat']), ('fr',['Hello','cat']) ], sorted(self.translator.requests) )
+        self.assertEqual( { 'Hello': { 'fr':'Bonjour', 'es':'Hola' }, 'cat': { 'fr':'chat', 'es':'gato' } }, self.readJson(self.keywords) )
+
+    def test_missing_only( self ):
+        with open(self.keywords,'w') as f:
+            json.dump( { 'Hello': { 'fr':'Salut', 'es':'Hola' } }, f )
+        self.bot( translator=self.translator, languages=self.languages('fr','es'),
+            keywords=['Hello','cat'], keywords_files=[self.keywords], keywords_rate=None )
+        self.assertEqual( [ ('es',['cat']), ('fr',['cat']) ], sorted(self.translator.requests) )
+        self.assertEqual( { 'fr':'Salut', 'es':'Hola' }, self.readJson(self.keywords)['Hello'] )
+
+        # Nothing is missing anymore
+        self.translator.requests.clear()
+        self.bot( translator=self.translator, languages=self.languages('fr','es'),
+            keywords=['Hello','cat'], keywords_files=[self.keywords], keywords_rate=None )
+        self.assertEqual( [], self.translator.requests )
+
+    def test_one_by_one( self ):
+        # 'Hallo' is already German so the whole request fails
+        self.bot( translator=self.translator, languages=self.languages('de'),
+            keywords=['Hello','Hallo','cat'], keywords_files=[self.keywords], keywords_rate=None )
+        self.assertEqual( [ ('de',['Hello','Hallo','cat']), ('de',['Hello']), ('de',['Hallo']), ('de',['cat']) ], self.translator.requests )
+        self.assertEqual( { 'Hello': { 'de':'Hallo' }, 'Hallo': {}, 'cat': { 'de':'Katze' } }, self.readJson(self.keywords) )
+
+        # The failed pair is requested again
+        self.translator.requests.clear()
+        self.bot( translator=self.translator, languages=self.languages('de'),
+            keywords=['Hello','Hallo','cat'], keywords_files=[self.keywords], keywords_rate=None )
+        self.assertEqual( [ ('de',['Hallo']) ], self.translator.requests )
+
+
+class TestAnswerKeyword(TestTransBot):
+
+    ANSWERS = { 'de':None, 'it':None, 'fr':"Bonjour", 'es':"Hola", 'ja':"こんにちは" }
+
+    def answer( self, targets, blocked=[], answers=ANSWERS, **kwargs ):
+        """
+            Answers a keyword, trying the given target languages in this order.
+            Returns the bot, once all translations have ended
+        """
+        translator = ScriptedTranslator( answers, blocked=blocked )
+        bot = self.bot( translator=translator, **kwargs )
+        languages = [ { 'language':code, 'name':code } for code in targets ]
+        with mock.patch( 'random.sample', return_value=languages ):
+            bot.answerKeyword( "Hello", KeywordMatch( 'Hello', 'en', 'Hello', 0, 5 ) )
+        translator.release.set()
+        bot.executor.shutdown(wait=True)
+        return bot
+
+    def test_first_success( self ):
+        bot = self.answer( ['de','fr','es','it','ja'], blocked=['es','ja'], hedge_fanout=5 )
+        # The slower successful attempts are ignored
+        self.assertEqual( ["Bonjour 🇫🇷"], bot.chatter.sent )
+        self.assertEqual( 'fr', bot.status['events'][-1]['translations'][-1]['target_language'] )
+
+    def test_cancels_pending( self ):
+        # With a single thread, only the first attempts can start before the answer
+        translator = ScriptedTranslator( self.ANSWERS, blocked=['de'] )
+        bot = self.bot( translator=translator, hedge_fanout=3 )
+        bot.executor = concurrent.futures.ThreadPoolExecutor( max_workers=1 )
+        languages = [ { 'language':code, 'name':code } for code in ('fr','de','es') ]
+        with mock.patch( 'random.sample', return_value=languages ):
+            bot.answerKeyword( "Hello", KeywordMatch( 'Hello', 'en', 'Hello', 0, 5 ) )
+        translator.release.set()
+        bot.executor.shutdown(wait=True)
+        self.assertEqual( ["Bonjour 🇫🇷"], bot.chatter.sent )
+        self.assertNotIn( 'es', translator.started )
+
+    def test_replaces_failures( self ):
+        # Only the 4th language can be translated : it starts once 2 attempts have failed
+        answers = { 'de':None, 'it':None, 'es':None, 'fr':"Bonjour", 'ja':None }
+        bot = self.answer( ['de','it','es','fr','ja'], answers=answers, hedge_fanout=2 )
+        self.assertEqual( ["Bonjour 🇫🇷"], bot.chatter.sent )
+        self.assertIn( 'fr', bot.translator.started )
+        self.assertLessEqual( bot.translator.max_running, 2 )
+        errors = [ t['target_language'] for t in bot.status['events'][-1]['translations'] if t.get('error') ]
+        self.assertGreaterEqual( len(errors), 2 )
+        self.assertNotIn( 'fr', errors )
+
+    def test_hedge_delay( self ):
+        # The first attempt is too slow : another one is started in parallel
+        bot = self.answer( ['es','fr','de','it','ja'], blocked=['es'], hedge_fanout=3, hedge_delay=0.05 )
+        self.assertEqual( ["Bonjour 🇫🇷"], bot.chatter.sent )
+        self.assertEqual( ['es','fr'], bot.translator.started[:2] )
+        self.assertGreaterEqual( bot.translator.max_running, 2 )
+
+    def test_all_failed( self ):
+        with self.assertLogs( 'nicobot.transbot', level='WARNING' ) as logs:
+            bot = self.answer( ['de','it','es','fr','ja'], answers=dict.fromkeys(self.ANSWERS), hedge_fanout=2 )
+        self.assertEqual( [], bot.chatter.sent )
+        self.assertEqual( 5, len(bot.status['events'][-1]['translations']) )
+        self.assertIn( "Could not find a translation", logs.output[-1] )
+
+    def test_different_languages( self ):
+        # Each language is tried at most once ; a larger fanout tries more of them
+        translator = ScriptedTranslator( dict.fromkeys(['de','en','es','fr','it','ja']) )
+        bot = self.bot( translator=translator, hedge_fanout=8 )
+        self.assertEqual( 8, bot.tries )
+        bot.answerKeyword( "Hello", KeywordMatch( 'Hello', 'en', 'Hello', 0, 5 ) )
+        self.assertEqual( ['de','en','es','fr','it','ja'], sorted(translator.started) )
+
+        bot = self.bot( translator=translator, hedge_fanout=2, hedge_tries=4 )
+        translator.started.clear()
+        bot.answerKeyword( "Hello", KeywordMatch( 'Hello', 'en', 'Hello', 0, 5 ) )
+        self.assertEqual( 4, len(set(translator.started)) )
+        self.assertEqual( 4, len(translator.started) )
+
+
+if __name__ == '__main__':
+    unittest.main()
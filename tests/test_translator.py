@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from nicobot.fakecloud import FakeCloud
+from nicobot.glossary import GlossaryTranslator
+from nicobot.ibmcloud import IbmCloudTranslator
+
+
+class TestGlossaryTranslator(unittest.TestCase):
+
+    def setUp(self):
+        self.translator = GlossaryTranslator(file='tests/fixtures/glossary.json')
+
+    def test_translate(self):
+        translation = self.translator.translate(["Hello world","thank you"],target='fr')
+        self.assertEqual( ["Bonjour monde","merci"], [ t['translation'] for t in translation['translations'] ] )
+
+    def test_same_language(self):
+        self.assertIsNone( self.translator.translate(["Hello"],target='en') )
+
+    def test_unknown_words(self):
+        self.assertIsNone( self.translator.translate(["xyzzy"],target='fr') )
+
+    def test_identify(self):
+        self.assertEqual( 'de', self.translator.identify("Hallo Welt")['languages'][0]['language'] )
+
+
+class TestFakeCloud(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = FakeCloud( GlossaryTranslator(file='tests/fixtures/glossary.json'), apikey="secret" ).start()
+
+    def tearDown(self):
+        self.cloud.stop()
+
+    def test_ibmcloud_translator(self):
+        translator = IbmCloudTranslator( self.cloud.url, "secret" )
+        translation = translator.translate(["my friend"],target='es')
+        self.assertEqual( "mi amigo", translation['translations'][0]['translation'] )
+        # A 404 means there is no translation
+        self.assertIsNone( translator.translate(["xyzzy"],target='es') )
+        self.assertEqual( 6, len(translator.identifiableLanguages()['languages']) )
+        self.assertEqual( 'fr', translator.identify("Bonjour mon ami")['languages'][0]['language'] )
+        self.assertEqual( 4, translator.stats['requests'] )
+        translator.close()
+
+    def test_retries_on_errors(self):
+        self.cloud.error_rate = 0.5
+        self.cloud.random.seed(0)
+        translator = IbmCloudTranslator( self.cloud.url, "secret", retries=10, backoff_factor=0 )
+        for i in range(5):
+            self.assertIsNotNone( translator.translate(["cat"],target='it') )
+        self.assertGreater( self.cloud.stats['errors'], 0 )
+        translator.close()
+
+
+if __name__ == '__main__':
+    unittest.main()